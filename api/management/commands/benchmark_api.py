@@ -0,0 +1,162 @@
+import asyncio, ssl, time
+from statistics import median, quantiles
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+
+
+class HttpConnection():
+    '''minimal HTTP/1.1 keep-alive client of one connection, response body is read and dropped'''
+    def __init__(self, host, port, cookie, ssl_context=None):
+        self.host = host
+        self.port = port
+        self.cookie = cookie
+        self.ssl_context = ssl_context
+        self.reader = self.writer = None
+
+    async def get(self, path):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl_context)
+        self.writer.write(f'GET {path} HTTP/1.1\r\nHost: {self.host}\r\nCookie: {self.cookie}\r\n\r\n'.encode('latin-1'))
+        await self.writer.drain()
+        status_line = await self.reader.readline()
+        if not status_line:
+            self.close()
+            raise ConnectionError('CONNECTION CLOSED BY SERVER')
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip().lower()
+        if 'content-length' in headers:
+            await self.reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding', '') == 'chunked':
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                await self.reader.readexactly(size + 2)
+                if not size:
+                    break
+        else:
+            await self.reader.read()
+            headers['connection'] = 'close'
+        if headers.get('connection', '') == 'close':
+            self.close()
+        return int(status_line.split()[1])
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+class AsgiConnection(HttpConnection):
+    '''request to ASGI application in current process, without network'''
+    def __init__(self, application, host, cookie):
+        super().__init__(host, 80, cookie)
+        self.application = application
+
+    async def get(self, path):
+        path, _, query = path.partition('?')
+        scope = {'type':'http', 'asgi':{'version':'3.0'}, 'http_version':'1.1', 'method':'GET', 'scheme':'http', 'path':path, 'raw_path':path.encode(), 'query_string':query.encode(), 'root_path':'', 'headers':[(b'host', self.host.encode()), (b'cookie', self.cookie.encode())], 'client':('127.0.0.1', 0), 'server':(self.host, self.port)}
+        status, received = 0, False
+
+        async def receive():
+            nonlocal received
+            if not received:
+                received = True
+                return {'type':'http.request', 'body':b'', 'more_body':False}
+            await asyncio.Event().wait()
+
+        async def send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+
+        await self.application(scope, receive, send)
+        return status
+
+
+class Command(BaseCommand):
+    help = 'compare requests per second of sync views /api/<path> and async views /api/async/<path> under concurrent connections'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', default=['products/?limit=50', 'products/cash/?limit=50', 'docs/'], help='paths of api with query string, for example "product/1/"')
+        parser.add_argument('--url', default='', help='base url of running server, for example https://127.0.0.1:9443 (daphne), default - in-process ASGI application')
+        parser.add_argument('--insecure', action='store_true', default=False, help='do not verify certificate of https server')
+        parser.add_argument('--username', default='', help='user of requests, default - first superuser')
+        parser.add_argument('--concurrency', type=int, default=100, help='count of concurrent connections')
+        parser.add_argument('--requests', type=int, default=2000, help='count of requests per path and mode')
+
+    def get_cookie(self, username):
+        User = get_user_model()
+        user = User.objects.filter(username=username).first() if username else User.objects.filter(is_superuser=True).order_by('id').first()
+        if not user:
+            raise CommandError(f'USER "{username}" NOT FOUND')
+        client = Client()
+        client.force_login(user)
+        return f'{settings.SESSION_COOKIE_NAME}={client.cookies[settings.SESSION_COOKIE_NAME].value}'
+
+    def http_connection(self, url, cookie, insecure):
+        parts = urlsplit(url)
+        ssl_context = None
+        if parts.scheme == 'https':
+            ssl_context = ssl.create_default_context()
+            if insecure:
+                ssl_context.check_hostname = False
+                ssl_context.verify_mode = ssl.CERT_NONE
+        port = parts.port or (443 if ssl_context else 80)
+        return lambda: HttpConnection(parts.hostname, port, cookie, ssl_context)
+
+    def asgi_connection(self, cookie):
+        application = get_asgi_application()
+        host = settings.ALLOWED_HOSTS[0] if settings.ALLOWED_HOSTS and settings.ALLOWED_HOSTS[0] != '*' else 'localhost'
+        return lambda: AsgiConnection(application, host, cookie)
+
+    async def measure(self, new_connection, path, concurrency, total):
+        '''result - (requests per second, latencies in seconds, count of errors)'''
+        latencies, errors, counter = [], 0, iter(range(total))
+
+        async def worker():
+            nonlocal errors
+            connection = new_connection()
+            for i in counter:
+                started = time.perf_counter()
+                try:
+                    status = await connection.get(path)
+                except Exception as e:
+                    status = 0
+                    self.stderr.write(f'{path}::{e}')
+                latencies.append(time.perf_counter() - started)
+                if status != 200:
+                    errors += 1
+            connection.close()
+
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for i in range(concurrency)])
+        return total / (time.perf_counter() - started), latencies, errors
+
+    async def run(self, new_connection, paths, concurrency, total):
+        self.stdout.write(f'{"PATH":<40}{"MODE":<8}{"RPS":>10}{"P50 ms":>10}{"P95 ms":>10}{"ERRORS":>8}')
+        for path in paths:
+            for mode, prefix in (('sync', '/api/'), ('async', '/api/async/')):
+                await self.measure(new_connection, f'{prefix}{path}', min(concurrency, total), min(concurrency, total))
+                rps, latencies, errors = await self.measure(new_connection, f'{prefix}{path}', concurrency, total)
+                p95 = quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0]
+                self.stdout.write(f'{path:<40}{mode:<8}{rps:>10.1f}{median(latencies) * 1000:>10.1f}{p95 * 1000:>10.1f}{errors:>8}')
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1 or options['requests'] < 1:
+            raise CommandError('CONCURRENCY AND REQUESTS MUST BE POSITIVE')
+        cookie = self.get_cookie(options['username'])
+        paths = [p.lstrip('/') for p in options['paths']]
+        if options['url']:
+            new_connection = self.http_connection(options['url'], cookie, options['insecure'])
+        else:
+            new_connection = self.asgi_connection(cookie)
+        asyncio.run(self.run(new_connection, paths, options['concurrency'], options['requests']))
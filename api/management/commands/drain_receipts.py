@@ -0,0 +1,35 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone as django_timezone
+
+from core.models import ReceiptQueue
+from api.views import DocsCashBatchView
+
+
+class Command(BaseCommand):
+    help = 'save receipts accepted by /api/doc/cash/ in write-behind mode (API_CASH_WRITE_BEHIND), run as service with --loop or periodically (cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help='count of receipts saved by one batch of inserts')
+        parser.add_argument('--loop', action='store_true', default=False, help='wait for new receipts forever')
+        parser.add_argument('--interval', type=float, default=1.0, help='seconds between checks of empty queue in loop mode')
+        parser.add_argument('--purge-days', type=int, default=0, help='delete processed receipts older than count of days')
+
+    def handle(self, *args, **options):
+        worker = DocsCashBatchView()
+        if options['purge_days']:
+            count, deleted = ReceiptQueue.objects.filter(status=ReceiptQueue.DONE, processed_at__lt=django_timezone.now() - timedelta(days=options['purge_days'])).delete()
+            self.stdout.write(f'DELETED {count} PROCESSED RECEIPTS')
+        total = 0
+        while True:
+            count = worker.drain(options['batch_size'])
+            total += count
+            if count:
+                self.stdout.write(f'PROCESSED {count} RECEIPTS')
+            elif options['loop']:
+                time.sleep(options['interval'])
+            else:
+                break
+        self.stdout.write(self.style.SUCCESS(f'PROCESSED {total} RECEIPTS'))
@@ -1,7 +1,11 @@
 import json
 from datetime import datetime
+from io import StringIO
 
 from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.core.management import call_command
+from django.db import connection
 from django.core.exceptions import MultipleObjectsReturned
 from django.contrib.auth import get_user_model
 #from django.contrib.auth.models import Group
@@ -12,6 +16,8 @@ from django.test import Client
 
 from html.parser import HTMLParser
 
+from .views import DocsCashBatchView
+
 
 def get_model(app_model):
     app_name, model_name = app_model.split('.')
@@ -204,3 +210,221 @@ class Usr(TransactionTestCase):
         print('Request♥', response.request)
         print('Response♡', response, response.headers)
         print('DATA⋆', eval(response.content))
+
+
+class CashFixture():
+    'Companies, document type, user and products with codes shared by cash test cases'
+    reset_sequences = True
+
+    def setUp(self):
+        get_model('refs.Currency')().save()
+        get_model('refs.Unit')(label='pcs', name='pieces').save()
+        get_model('refs.Tax')(name='NO').save()
+        get_model('refs.Company')(name='Own').save()
+        get_model('refs.Company')(name='Cash').save()
+        self.user = get_user_model().objects.create_superuser('admin', 'admin@localhost', 'admin', role=get_model('users.Role').objects.create(value='test'))
+        self.doc_type = get_model('refs.DocType').objects.create(alias='receipt', name='Receipt', income=True, auto_register=True)
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def add_products(self, count):
+        doc = get_model('core.Doc').objects.create(type=self.doc_type)
+        for i in range(get_model('refs.Product').objects.count(), get_model('refs.Product').objects.count() + count):
+            product = get_model('refs.Product').objects.create(name=f'P{i}')
+            product.barcodes.add(get_model('refs.BarCode').objects.create(id=f'{4600000000000 + i}'))
+            product.qrcodes.add(get_model('refs.QrCode').objects.create(id=f'qr{i}'))
+            get_model('core.Record').objects.create(doc=doc, product=product, count=i + 1)
+
+    def get_page(self):
+        response = self.client.get('/api/products/cash/', {'limit':100})
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.json())
+
+
+class ProductsCash(CashFixture, TransactionTestCase):
+    'Cash catalog of products'
+
+    def test_page_queries(self):
+        self.add_products(3)
+        with CaptureQueriesContext(connection) as queries:
+            data = self.get_page()
+        self.assertEqual(len(data), 3)
+        self.add_products(30)
+        with self.assertNumQueries(len(queries)):
+            data = self.get_page()
+        self.assertEqual(len(data), 33)
+        item = next(it for it in data if it['name'] == 'P5')
+        self.assertEqual(item['barcodes'], ['4600000000005'])
+        self.assertEqual(item['qrcodes'], ['qr5'])
+        self.assertEqual(float(item['count']), 6)
+
+
+class DocCash(CashFixture, TransactionTestCase):
+    'Cash receipt with constant count of queries'
+
+    def post_receipt(self, products):
+        data = {'sum_final':'0', 'registered_at':django_timezone.now().isoformat(), 'records':[{'product':id_product, 'count':1, 'price':'2'} for id_product in products]}
+        response = self.client.post('/api/doc/cash/', json.dumps(data), 'application/json')
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def test_receipt_queries(self):
+        get_model('refs.Company').objects.filter(name='Cash').update(extinfo={'default_cash_contractor':True})
+        get_model('refs.DocType').objects.create(alias='sale', name='Sale', income=False, auto_register=True)
+        self.add_products(40)
+        ids = list(get_model('refs.Product').objects.values_list('id', flat=True))
+        self.post_receipt(ids[:1])
+        with CaptureQueriesContext(connection) as queries:
+            self.post_receipt(ids[:2] + [9001])
+        with self.assertNumQueries(len(queries)):
+            result = self.post_receipt(ids + [9002])
+        self.assertEqual(result['records_count'], 41)
+        doc = get_model('core.Doc').objects.get(id=result['doc'])
+        self.assertEqual(doc.contractor.name, 'Cash')
+        self.assertEqual(get_model('refs.Product').objects.get(id=9002).name, 'unknown-product-9002')
+        self.assertEqual(get_model('core.ProductStock').get_quantity(ids[0]), -2)
+        self.assertEqual(get_model('core.ProductStock').get_quantity(9002), -1)
+        found = json.loads(self.client.get('/api/products/search', {'q':'unknown-product-9002'}).json())
+        self.assertEqual([item['id'] for item in found], [9002])
+
+    def test_idempotency_key(self):
+        get_model('refs.DocType').objects.create(alias='sale', name='Sale', income=False, auto_register=True)
+        self.add_products(5)
+        ids = list(get_model('refs.Product').objects.values_list('id', flat=True))
+        quantity = get_model('core.ProductStock').get_quantity(ids[0])
+        data = {'sum_final':'0', 'registered_at':django_timezone.now().isoformat(), 'records':[{'product':id_product, 'count':1, 'price':'2'} for id_product in ids]}
+        result = self.client.post('/api/doc/cash/', json.dumps(data), 'application/json', headers={'Idempotency-Key':'pos1-1'}).json()
+        records, registers = get_model('core.Record').objects.count(), get_model('core.Register').objects.count()
+        with self.assertNumQueries(3):
+            replay = self.client.post('/api/doc/cash/', json.dumps(data), 'application/json', headers={'Idempotency-Key':'pos1-1'}).json()
+        self.assertEqual(replay, result | {'replay':True})
+        data['idempotency_key'] = 'pos1-2'
+        second = self.client.post('/api/doc/cash/', json.dumps(data), 'application/json').json()
+        self.assertNotEqual(second['doc'], result['doc'])
+        self.assertEqual(self.client.post('/api/doc/cash/', json.dumps(data), 'application/json').json()['doc'], second['doc'])
+        receipts = [data, data | {'idempotency_key':'pos1-3'}, data | {'idempotency_key':'pos1-3'}, data | {'idempotency_key':'x' * 200}]
+        batch = self.client.post('/api/docs/cash/batch/', json.dumps(receipts), 'application/json').json()
+        self.assertEqual(batch['docs_count'], 3)
+        self.assertEqual(batch['receipts'][0]['doc'], second['doc'])
+        self.assertTrue(batch['receipts'][0]['replay'])
+        self.assertEqual(batch['receipts'][2]['doc'], batch['receipts'][1]['doc'])
+        self.assertEqual(batch['receipts'][3]['result'], 'error; request data invalid')
+        self.assertEqual(get_model('core.Doc').objects.filter(idempotency_key__startswith='pos1-').count(), 3)
+        self.assertEqual(get_model('core.Record').objects.count(), records + 2 * len(ids))
+        self.assertEqual(get_model('core.Register').objects.count(), registers + 2 * len(ids))
+        self.assertEqual(get_model('core.ProductStock').get_quantity(ids[0]), quantity - 3)
+
+
+class DocCashBatch(CashFixture, TransactionTestCase):
+    'Batch of offline cash receipts'
+
+    def test_batch(self):
+        get_model('refs.Company').objects.filter(name='Cash').update(extinfo={'default_cash_contractor':True})
+        get_model('refs.DocType').objects.create(alias='sale', name='Sale', income=False, auto_register=True)
+        self.add_products(10)
+        ids = list(get_model('refs.Product').objects.values_list('id', flat=True))
+        quantity = get_model('core.ProductStock').get_quantity(ids[0])
+        registers = get_model('core.Register').objects.count()
+        receipt = lambda products, name: {'sum_final':'0', 'registered_at':django_timezone.now().isoformat(), 'customer':{'name':name}, 'records':[{'product':id_product, 'count':1, 'price':'2'} for id_product in products]}
+        receipts = [receipt(ids[:2], 'Bob'), {'records':'invalid'}, receipt(ids + [9003], 'Alice')]
+        response = self.client.post('/api/docs/cash/batch/', json.dumps(receipts), 'application/json')
+        self.assertEqual(response.status_code, 200, response.content)
+        result = response.json()
+        self.assertEqual(result['docs_count'], 2)
+        self.assertEqual([r['result'] for r in result['receipts']], ['success', 'error; request data invalid', 'success'])
+        self.assertEqual(result['receipts'][2]['records_count'], 11)
+        self.assertEqual(get_model('core.ProductStock').get_quantity(ids[0]), quantity - 2)
+        self.assertEqual(get_model('core.ProductStock').get_quantity(9003), -1)
+        self.assertEqual(get_model('core.Register').objects.count(), registers + 13)
+        ndjson = lambda count, prefix: '\n'.join(json.dumps(receipt(ids[:2], f'{prefix}{i}')) for i in range(count))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post('/api/docs/cash/batch/', ndjson(2, 'Eve'), 'application/x-ndjson')
+        with self.assertNumQueries(len(queries)):
+            response = self.client.post('/api/docs/cash/batch/', ndjson(20, 'Dan'), 'application/x-ndjson')
+        self.assertEqual(response.json()['docs_count'], 20)
+        response = self.client.post('/api/docs/cash/batch/', '[{"records":', 'application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_bad_receipt(self):
+        get_model('refs.DocType').objects.create(alias='sale', name='Sale', income=False, auto_register=True)
+        self.add_products(3)
+        ids = list(get_model('refs.Product').objects.values_list('id', flat=True))
+        docs = get_model('core.Doc').objects.count()
+        receipt = lambda records, **kwargs: {'sum_final':'0', 'registered_at':django_timezone.now().isoformat(), 'records':records} | kwargs
+        record = lambda id_product, count=1: {'product':id_product, 'count':count, 'price':'2'}
+        receipts = [receipt([record(ids[0])]), receipt([record(ids[1], 'x')]), receipt([record('abc')]), receipt([record(ids[2], 'NaN')]), receipt([record(ids[2])])]
+        response = self.client.post('/api/docs/cash/batch/', json.dumps(receipts), 'application/json')
+        self.assertEqual(response.status_code, 200, response.content)
+        result = response.json()
+        self.assertEqual(result['docs_count'], 2)
+        self.assertEqual([r['result'] for r in result['receipts'][:3]], ['success', 'error; request data invalid', 'error; request data invalid'])
+        self.assertIn('error', result['receipts'][3])
+        self.assertEqual(result['receipts'][4]['result'], 'success')
+        self.assertEqual(get_model('core.Doc').objects.count(), docs + 2)
+        Doc, Record = get_model('core.Doc'), get_model('core.Record')
+        built = {0:(Doc(type=self.doc_type, sum_final=0), [Record(product_id=ids[0], count=1)]), 1:(Doc(type=self.doc_type, sum_final=None), [Record(product_id=ids[1], count=1)])}
+        errors = {}
+        DocsCashBatchView().post_built(built, errors)
+        self.assertEqual((list(built), list(errors)), ([0], [1]))
+        self.assertEqual(Doc.objects.count(), docs + 3)
+
+
+class AsyncApi(CashFixture, TransactionTestCase):
+    'Async views return the same data as sync views'
+
+    def test_same_data(self):
+        get_model('refs.DocType').objects.create(alias='sale', name='Sale', income=False, auto_register=True)
+        self.add_products(12)
+        id_product = get_model('refs.Product').objects.values_list('id', flat=True).first()
+        for path, params in (('products/', {'limit':5, 'page':2}), ('products/cash/', {'limit':100}), (f'product/{id_product}/', {}), ('docs/', {})):
+            response, async_response = self.client.get(f'/api/{path}', params), self.client.get(f'/api/async/{path}', params)
+            self.assertEqual(async_response.status_code, response.status_code, path)
+            self.assertEqual(async_response.json(), response.json(), path)
+            self.assertEqual(async_response.headers.get('count'), response.headers.get('count'), path)
+        self.assertEqual(self.client.get('/api/async/products/', {'limit':5, 'page':9}).status_code, 400)
+        self.assertEqual(self.client.head(f'/api/async/product/{id_product}/').headers['count'], '1.000')
+        data = {'sum_final':'0', 'registered_at':django_timezone.now().isoformat(), 'customer':{'name':'Bob'}, 'records':[{'product':id_product, 'count':1, 'price':'2'}, {'product':9004, 'count':1, 'price':'3'}]}
+        result = self.client.post('/api/async/doc/cash/', json.dumps(data), 'application/json', headers={'Idempotency-Key':'async-1'}).json()
+        self.assertEqual(result['records_count'], 2)
+        replay = self.client.post('/api/async/doc/cash/', json.dumps(data), 'application/json', headers={'Idempotency-Key':'async-1'}).json()
+        self.assertEqual(replay, result | {'replay':True})
+        doc = get_model('core.Doc').objects.get(id=result['doc'])
+        self.assertEqual(doc.customer.name, 'Bob')
+        self.assertEqual(get_model('core.ProductStock').get_quantity(id_product), 0)
+        self.assertEqual(get_model('core.ProductStock').get_quantity(9004), -1)
+
+
+class WriteBehind(CashFixture, TransactionTestCase):
+    'Receipts accepted into queue and saved by worker'
+
+    def test_queue(self):
+        get_model('refs.DocType').objects.create(alias='sale', name='Sale', income=False, auto_register=True)
+        self.add_products(3)
+        ids = list(get_model('refs.Product').objects.values_list('id', flat=True))
+        quantity = get_model('core.ProductStock').get_quantity(ids[0])
+        receipt = lambda name: {'sum_final':'6', 'registered_at':django_timezone.now().isoformat(), 'customer':{'name':name}, 'records':[{'product':id_product, 'count':1, 'price':'2'} for id_product in ids]}
+        docs = get_model('core.Doc').objects.count()
+        with self.settings(API_CASH_WRITE_BEHIND=True):
+            tickets = []
+            for i in range(5):
+                response = self.client.post('/api/doc/cash/', json.dumps(receipt(f'C{i}')), 'application/json')
+                self.assertEqual(response.status_code, 202, response.content)
+                tickets.append(response.json()['ticket'])
+            response = self.client.post('/api/doc/cash/', json.dumps(receipt('C0')), 'application/json', headers={'Idempotency-Key':'wb-1'})
+            self.assertEqual(self.client.post('/api/doc/cash/', json.dumps(receipt('C0')), 'application/json', headers={'Idempotency-Key':'wb-1'}).json()['ticket'], response.json()['ticket'])
+            bad = receipt('C9')
+            bad['records'][0]['count'] = 'x'
+            self.assertEqual(self.client.post('/api/doc/cash/', json.dumps(bad), 'application/json').status_code, 400)
+        self.assertEqual(get_model('core.Doc').objects.count(), docs)
+        self.assertEqual(self.client.get(f'/api/doc/cash/ticket/{tickets[0]}/').json()['status'], 'pending')
+        out = StringIO()
+        call_command('drain_receipts', batch_size=4, stdout=out)
+        self.assertIn('PROCESSED 6 RECEIPTS', out.getvalue())
+        self.assertEqual(get_model('core.Doc').objects.count(), docs + 6)
+        self.assertEqual(get_model('core.ProductStock').get_quantity(ids[0]), quantity - 6)
+        ticket = self.client.get(f'/api/doc/cash/ticket/{tickets[0]}/').json()
+        self.assertEqual(ticket['status'], 'done')
+        self.assertEqual(get_model('core.Doc').objects.get(id=ticket['doc_id']).customer.name, 'C0')
+        self.assertEqual(get_model('core.ReceiptQueue').objects.filter(status=get_model('core.ReceiptQueue').DONE).count(), 6)
+        with self.settings(API_CASH_WRITE_BEHIND=True):
+            self.assertEqual(self.client.post('/api/doc/cash/', json.dumps(receipt('C0')), 'application/json', headers={'Idempotency-Key':'wb-1'}).json()['replay'], True)
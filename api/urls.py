@@ -7,11 +7,21 @@ urlpatterns = [
     path('login/', views.url_login),
     path('logout/', views.url_logout),
     path('product/<int:pk>/', views.ProductView.as_view()),
+    path('product/<int:pk>/balance', views.ProductBalanceView.as_view(), name='product-balance'),
     path('products/', views.ProductsView.as_view()),
+    path('products/balance/', views.ProductsBalanceView.as_view(), name='products-balance'),
     path('products/cash/', views.ProductsCashView.as_view(), name='products-cash'),
+    path('products/search', views.ProductsSearchView.as_view(), name='products-search'),
     path('docs/', views.DocsView.as_view()),
+    path('docs/cash/batch/', views.DocsCashBatchView.as_view(), name='docs-cash-batch'),
     path('doc/<int:pk>/', views.DocView.as_view()),
     path('doc/<int:pk>/sales_receipt', views.DocViewSalesReceipt.as_view()),
     path('doc/cash/', views.DocCashAddView.as_view(), name='doc-cash'),
-    path('customers/', views.CustomersView.as_view(), name='customer')
+    path('doc/cash/ticket/<uuid:ticket>/', views.ReceiptTicketView.as_view(), name='doc-cash-ticket'),
+    path('customers/', views.CustomersView.as_view(), name='customer'),
+    path('async/product/<int:pk>/', views.AsyncProductView.as_view(), name='async-product'),
+    path('async/products/', views.AsyncProductsView.as_view(), name='async-products'),
+    path('async/products/cash/', views.AsyncProductsCashView.as_view(), name='async-products-cash'),
+    path('async/docs/', views.AsyncDocsView.as_view(), name='async-docs'),
+    path('async/doc/cash/', views.AsyncDocCashAddView.as_view(), name='async-doc-cash')
 ]
@@ -1,6 +1,8 @@
-import json, logging, locale, re, sys
+import codecs, json, logging, locale, re, sys
 from decimal import Decimal
 
+from asgiref.sync import sync_to_async
+
 from django.http import JsonResponse, HttpResponse
 from django.views import View
 from django.views.generic import ListView, DetailView
@@ -14,14 +16,19 @@ from django.utils.decorators import method_decorator
 from django.views.decorators.http import require_http_methods
 from django.core.paginator import EmptyPage, Paginator
 from django.conf import settings
-from django.db.models import F, Q, Sum
+from django.db import transaction
+from django.db.utils import IntegrityError
+from django.db.models import F, Q, Sum, Value, DecimalField
+from django.db.models.functions import Coalesce
 from django.utils.dateparse import parse_datetime
+from django.utils import timezone as django_timezone
 from django.shortcuts import get_object_or_404
 from django.template import Context, Template
 
-from users.models import User, RoleField
-from refs.models import Company, Customer, DocType, Product, PrintTemplates
-from core.models import Doc, Record, Register
+from users.models import User, RoleMatrix
+from refs.models import Company, Customer, DocType, Product, ProductSearch, PrintTemplates
+from core.models import Doc, Record, Register, ProductStock, ProductBalanceSnapshot, ReceiptQueue
+from core.posting import post_doc, post_docs
 
 
 @csrf_exempt
@@ -121,10 +128,8 @@ class ProductView(DetailView, LogMixin):
         return obj
 
     def get_obj_count(self, instance):
-        SumIncome=Sum('rec__count', filter=Q(rec__doc__type__income=True), default=0)
-        SumExpense=Sum('rec__count', filter=Q(rec__doc__type__income=False), default=0)
         try:
-            count = Register.objects.filter(rec__product_id=instance.id).aggregate(count=SumIncome-SumExpense)['count']
+            count = ProductStock.get_quantity(instance.id)
         except Exception as e:
             self.loge(e)
         else:
@@ -138,11 +143,11 @@ class ProductView(DetailView, LogMixin):
         if not request.user:
             return JsonResponse({'error':'USER NOT FOUND'}, status=401)
         u = request.user
-        if not u.role:
+        if not u.role_id:
             return JsonResponse({'error':'USER ROLE NOT ACCESSIBLE'}, status=403)
         obj = self.get_obj_or_404(**kwargs)
         if obj:
-            role_fields = tuple(RoleField.objects.filter(role=u.role, role_model__app='refs', role_model__model=obj.__class__.__name__, read=True).values_list('value', flat=True))
+            role_fields = tuple(RoleMatrix.get(u.role_id).readable(f'refs.{obj.__class__.__name__}'))
             data = serialize('json', [obj], fields=role_fields)
             return JsonResponse(data, safe=False, headers={'count':self.get_obj_count(obj)})
         return JsonResponse({'error':'NOT FOUND'}, status=404)
@@ -157,6 +162,52 @@ class ProductView(DetailView, LogMixin):
         return response
 
 
+class ProductBalanceView(View, LogMixin):
+
+    @method_decorator([ensure_csrf_cookie])
+    def get(self, request, pk=None):
+        if not request.user.role:
+            return JsonResponse({'error':'USER ROLE NOT ACCESSIBLE'}, status=403)
+        if not Product.objects.filter(pk=pk).exists():
+            return JsonResponse({'error':'NOT FOUND'}, status=404)
+        at = ProductBalanceSnapshot.parse_at(request.GET.get('at', '')) or django_timezone.now()
+        try:
+            balance = ProductBalanceSnapshot.get_balance(pk, at)
+        except Exception as e:
+            self.loge(e, pk, at)
+            return JsonResponse({'error':f'{e}'}, status=500)
+        return JsonResponse({'product':pk, 'at':at, 'balance':balance})
+
+
+class ProductsBalanceView(View, LogMixin):
+    limit_default = 100
+    page_num_default = 1
+
+    @method_decorator([ensure_csrf_cookie])
+    def get(self, request, *args, **kwargs):
+        if not request.user.role:
+            return JsonResponse({'error':'USER ROLE NOT ACCESSIBLE'}, status=403)
+        at = ProductBalanceSnapshot.parse_at(request.GET.get('at', '')) or django_timezone.now()
+        page_num = int(request.GET.get('page', self.page_num_default))
+        limit = int(request.GET.get('limit', self.limit_default))
+        queryset = Product.objects.order_by('id')
+        ids = [int(i) for i in request.GET.get('ids', '').split(',') if i.strip().isdigit()]
+        if ids:
+            queryset = queryset.filter(id__in=ids)
+        if 'group' in request.GET:
+            queryset = queryset.filter(group_id=request.GET['group'])
+        paginator = Paginator(queryset.values_list('id', 'article', 'name'), limit)
+        try:
+            page = paginator.page(page_num)
+        except EmptyPage as e:
+            self.logw(e, 'limit', limit, 'page_num', page_num)
+            return JsonResponse({'error':f'{e}'}, status=400)
+        balances = ProductBalanceSnapshot.balances_at(at, [id_product for id_product, article, name in page])
+        data = [{'id':id_product, 'article':article, 'name':name, 'balance':balances[id_product]} for id_product, article, name in page]
+        rsp_hdrs = {'count':paginator.count, 'num_pages':paginator.num_pages, 'page':page_num, 'limit':limit}
+        return JsonResponse({'at':at, 'products':data}, headers=rsp_hdrs)
+
+
 class PaginatedView(View, LogMixin):
     limit_default = 10
     page_num_default = 1
@@ -183,13 +234,14 @@ class PaginatedView(View, LogMixin):
             json_data = self.serialize_handler(paginated_data, self.fields)
         return paginator, json_data, http_status
 
-    @method_decorator([ensure_csrf_cookie])
-    def get(self, request, *args, **kwargs):
+    def filter_queryset(self, request):
+        '''result - (queryset filtered by request parameters, limit, page number)'''
         if settings.DEBUG:
             self.logd('REQUEST.GET', request.GET)
         request.GET._mutable = True
         page_num = int(request.GET.pop('page', [self.page_num_default])[0])
         limit = int(request.GET.pop('limit', [self.limit_default])[0])
+        queryset = self.queryset
         if request.GET:
             filters = {}
             for k, v in request.GET.items():
@@ -199,13 +251,20 @@ class PaginatedView(View, LogMixin):
                     elif len(v) == 1:
                         v = v[0]
                 filters[k] = v
-            self.queryset = self.queryset.filter(**filters)
-        paginator, json_data, http_status = self.paginate(self.queryset, limit, page_num)
+            queryset = queryset.filter(**filters)
+        return queryset, limit, page_num
+
+    def paginated_response(self, paginator, json_data, http_status, limit, page_num):
         if settings.DEBUG:
             self.logd('JSON_DATA', json_data)
         rsp_hdrs = {'count':paginator.count, 'num_pages':paginator.num_pages, 'page_min':paginator.page_range.start, 'page_max':paginator.page_range.stop, 'page':page_num, 'limit':limit}
-        response = JsonResponse(json_data, safe=False, status=http_status, headers=rsp_hdrs)
-        return response
+        return JsonResponse(json_data, safe=False, status=http_status, headers=rsp_hdrs)
+
+    @method_decorator([ensure_csrf_cookie])
+    def get(self, request, *args, **kwargs):
+        queryset, limit, page_num = self.filter_queryset(request)
+        paginator, json_data, http_status = self.paginate(queryset, limit, page_num)
+        return self.paginated_response(paginator, json_data, http_status, limit, page_num)
 
 
 class ProductsView(PaginatedView):
@@ -215,7 +274,7 @@ class ProductsView(PaginatedView):
 
 
 class ProductsCashView(ProductsView):
-    queryset = Product.objects.prefetch_related('currency', 'barcodes', 'qrcodes', 'group', 'unit')
+    queryset = Product.objects.select_related('currency', 'group', 'unit').prefetch_related('barcodes', 'qrcodes').annotate(stock_count=Coalesce('stock__quantity', Value(0, DecimalField(max_digits=15, decimal_places=3))))
 
     def serialize_handler(self, data, field_names='__all__'):
         list_data = []
@@ -229,10 +288,20 @@ class ProductsCashView(ProductsView):
             currency = ''
             if it.currency:
                 currency = {'id':it.currency.id, 'name':it.currency.name}
-            list_data.append({'id':it.id, 'article':it.article, 'name':it.name, 'cost':0.0, 'price':it.price, 'barcodes':list(it.barcodes.values_list('id', flat=True)), 'qrcodes':list(it.qrcodes.values_list('id', flat=True)), 'currency':currency, 'grp':grp, 'unit':unit})
+            list_data.append({'id':it.id, 'article':it.article, 'name':it.name, 'cost':0.0, 'price':it.price, 'barcodes':[o.id for o in it.barcodes.all()], 'qrcodes':[o.id for o in it.qrcodes.all()], 'count':it.stock_count, 'currency':currency, 'grp':grp, 'unit':unit})
         return json.dumps(list_data, cls=DjangoJSONEncoder)
 
 
+class ProductsSearchView(ProductsCashView):
+    '''products ranked by search document, /api/products/search?q=cola&limit=10&page=1'''
+
+    def filter_queryset(self, request):
+        request.GET._mutable = True
+        term = request.GET.pop('q', [''])[0]
+        queryset, limit, page_num = super().filter_queryset(request)
+        return ProductSearch.filter(queryset, term).order_by('-search_rank', 'id'), limit, page_num
+
+
 class DocView(DetailView, LogMixin):
     context_object_name = 'doc'
     queryset = Doc.objects.none()
@@ -252,6 +321,140 @@ class DocView(DetailView, LogMixin):
 class DocCashAddView(View, LogMixin):
     context_object_name = 'doc-cash'
 
+    @staticmethod
+    def reduce_int_part(v:Decimal):
+        if v > Decimal(999999999999):
+            d = f'{v}'
+            return Decimal(f'{d[:12]}.{d[12:]}')
+        return v
+
+    def get_contractor_id(self, user, dtype):
+        id_contractor = Company.get_default_contractor_id(dtype)
+        if not id_contractor:
+            id_contractor = user.companies.values_list('id', flat=True).first()
+        return id_contractor or 2
+
+    def get_doc_type(self, alias):
+        return DocType.get_by_alias(alias)
+
+    def get_customer_id(self, customer):
+        if not isinstance(customer, dict):
+            self.logw(customer, 'CUSTOMER MUST BE AS DICTIONARY')
+            return None
+        id_customer = customer.get('id', None)
+        if id_customer is not None and Customer.objects.filter(id=id_customer).exists():
+            return id_customer
+        customer_name = customer.get('name', '')
+        if not customer_name:
+            return None
+        try:
+            dbcustomer, created = Customer.objects.get_or_create(name=customer_name)
+        except Exception as e:
+            self.loge(e, customer)
+            return None
+        return dbcustomer.id
+
+    @staticmethod
+    def get_prices(records):
+        '''result - {product id: price} of receipt records'''
+        prices = {}
+        for r in records:
+            prices.setdefault(int(r['product']), r.get('price', 0))
+        return prices
+
+    def get_unknown_products(self, prices, products):
+        return [Product(id=id_product, name=f'unknown-product-{id_product}', price=self.reduce_int_part(Decimal(price))) for id_product, price in prices.items() if id_product not in products]
+
+    def get_products(self, records):
+        '''records - list of receipt records, result - {id: product} by one query, unknown products are created by one insert'''
+        prices = self.get_prices(records)
+        products = Product.objects.in_bulk(prices.keys())
+        unknown = self.get_unknown_products(prices, products)
+        if unknown:
+            self.logw('UNKNOWN PRODUCTS', [p.id for p in unknown])
+            try:
+                Product.objects.bulk_create(unknown, ignore_conflicts=True)
+            except Exception as e:
+                self.loge(e, records)
+            else:
+                products |= Product.objects.in_bulk([p.id for p in unknown])
+                ProductSearch.refresh([p.id for p in unknown])
+        return products
+
+    @staticmethod
+    def is_valid(data):
+        return isinstance(data, dict) and data.get('sum_final', None) is not None and data.get('records', []) and data.get('registered_at', '')
+
+    @classmethod
+    def is_valid_values(cls, data):
+        '''check values of receipt before accepting it into queue, document is saved later'''
+        try:
+            if not parse_datetime(data['registered_at']):
+                return False
+            Decimal(f'{data["sum_final"]}')
+            for r in data['records']:
+                int(r['product'])
+                Decimal(f'{r["count"]}')
+                Decimal(f'{r["price"]}')
+        except Exception:
+            return False
+        return True
+
+    def enqueue(self, user, data, key):
+        '''write-behind mode, receipt is saved to queue and processed by worker'''
+        if not self.is_valid(data) or not self.is_valid_values(data):
+            return JsonResponse({'result':'error; request data invalid'}, status=400)
+        try:
+            item, created = ReceiptQueue.enqueue(user, data, key)
+        except Exception as e:
+            self.loge(e, data)
+            return JsonResponse({'result':f'error: {e}'}, status=500)
+        return JsonResponse({'result':'accepted', 'ticket':f'{item.ticket}'}, status=202)
+
+    def build_doc(self, user, data, products):
+        '''result - (doc, records) of author user not saved yet or None when request data invalid'''
+        if not self.is_valid(data):
+            return None
+        sum_final = data['sum_final']
+        records = data['records']
+        registered_at = data['registered_at']
+        id_owner = data.get('owner', user.default_company_id or 1)
+        dtype = data.get('type', 'sale')
+        doc_type = self.get_doc_type(dtype)
+        id_contractor = data.get('contractor', None) or self.get_contractor_id(user, dtype)
+        doc = Doc(type=doc_type, registered_at=parse_datetime(registered_at), owner_id=id_owner, contractor_id=id_contractor, author=user, sum_final=self.reduce_int_part(Decimal(sum_final)))
+        doc.customer_id = self.get_customer_id(data.get('customer', {'id':None, 'name':'', 'extinfo':{}}))
+        recs = []
+        for r in records:
+            p = products.get(int(r['product']))
+            if p is None:
+                self.logw('PRODUCT NOT FOUND', r)
+                continue
+            recs.append(Record(count=self.reduce_int_part(Decimal(r['count'])), cost=p.cost, price=self.reduce_int_part(Decimal(r['price'])), doc=doc, currency_id=p.currency_id, product=p))
+        return doc, recs
+
+    @staticmethod
+    def get_idempotency_key(data, header=''):
+        '''key of submission from header Idempotency-Key or field idempotency_key of receipt, result - key or None'''
+        key = f'{header or data.get("idempotency_key", None) or ""}'.strip()
+        return key or None
+
+    @staticmethod
+    def is_valid_idempotency_key(key):
+        return key is None or len(key) <= Doc._meta.get_field('idempotency_key').max_length
+
+    @staticmethod
+    def replay(saved):
+        '''result of repeated submission, saved - (doc id, count of records)'''
+        return {'result':'success', 'doc':f'{saved[0]}', 'records_count':saved[1], 'replay':True}
+
+    def save_doc(self, doc, recs):
+        '''save and register document with records by posting in one transaction, final sum of POS is kept, result - saved records'''
+        result = post_doc(doc, recs, update_sum_final=False)
+        if settings.DEBUG:
+            self.logd(doc, result)
+        return recs
+
     @method_decorator([ensure_csrf_cookie])
     def post(self, request, *args, **kwargs):
         try:
@@ -262,111 +465,229 @@ class DocCashAddView(View, LogMixin):
         except Exception as e:
             self.loge(e)
             return JsonResponse({'result':f'error: {e}'}, status=500)
-        sum_final = data.get('sum_final', None)
-        records = data.get('records', [])
-        registered_at = data.get('registered_at', '')
-        def reduce_int_part(v:Decimal):
-            if v > Decimal(999999999999):
-                d = f'{v}'
-                return Decimal(f'{d[:12]}.{d[12:]}')
-            return v
-        if sum_final is not None and records and registered_at:
-            sum_final = reduce_int_part(Decimal(sum_final))
-            id_owner = data.get('owner', request.user.default_company.id if request.user.default_company else 1)
-            dtype = data.get('type', 'sale')
-            doc_type, created = DocType.objects.get_or_create(alias=dtype, defaults={'alias':dtype, 'name':dtype.title()})
-            contractor_kwargs = {}
-            if dtype == 'order':
-                contractor_kwargs['extinfo__default_order_contractor'] = True
-            elif dtype == 'order_customer':
-                contractor_kwargs['extinfo__default_order_customer_contractor'] = True
-            else:
-                contractor_kwargs['extinfo__default_cash_contractor'] = True
-            default_contractor = None
-            if contractor_kwargs:
-                default_contractor = Company.objects.filter(**contractor_kwargs).first()
-            if not default_contractor and request.user.companies.count():
-                default_contractor = request.user.companies.first()
-            id_contractor = data.get('contractor', default_contractor.id if default_contractor else 2)
-            #################
-            doc = Doc(type=doc_type, registered_at=parse_datetime(registered_at), owner_id=id_owner, contractor_id=id_contractor, author=request.user, sum_final=sum_final)
-            customer = data.get('customer', {'id':None, 'name':'', 'extinfo':{}})
-            if not isinstance(customer, dict):
-                self.logw(customer, 'CUSTOMER MUST BE AS DICTIONARY')
-            else:
-                id_customer = customer.get('id', None)
-                if id_customer is not None and Customer.objects.filter(id=id_customer).exists():
-                    doc.customer_id = id_customer
-                else:
-                    customer_name = customer.get('name', '')
-                    if customer_name:
-                        dbcustomer = None
-                        try:
-                            dbcustomer = Customer.objects.get(name=customer_name)
-                        except Customer.DoesNotExist as e:
-                            self.logw(e)
-                            dbcustomer = Customer(name=customer_name)
-                            try:
-                                dbcustomer.save()
-                            except Exception as e:
-                                self.loge(e, customer)
-                                dbcustomer = None
-                        except Exception as e:
-                            self.loge(e, customer)
-                        if dbcustomer:
-                            doc.customer_id = dbcustomer.id
-            recs = []
-            for r in records:
-                id_product = r['product']
-                try:
-                    p = Product.objects.get(pk=id_product)
-                except Product.DoesNotExist as e:
-                    self.logw(e, r)
-                    try:
-                        Product(id=id_product, name=f'unknown-product-{id_product}', price=r['price']).save()
-                    except Exception as e:
-                        self.loge(e, r)
-                except Exception as e:
-                    self.loge(e, r, records)
-                    return JsonResponse({'result':f'error; {r}; {e}'}, status=500)
-                else:
-                    recs.append(Record(count=reduce_int_part(Decimal(r['count'])), cost=p.cost, price=reduce_int_part(Decimal(r['price'])), doc=doc, currency=p.currency, product=p))
-            if recs:
-                try:
-                    doc.save()
-                except Exception as e:
-                    self.loge(e, data)
-                    return JsonResponse({'result':f'error: {e}'}, status=500)
-                else:
-                    try:
-                        obj_recs = Record.objects.bulk_create(recs)
-                    except Exception as e:
-                        self.loge(e, doc, recs)
-                    else:
-                        if settings.DEBUG:
-                            self.logd(obj_recs)
-                        if doc_type.auto_register and obj_recs:
-                            regs = []
-                            for obj in obj_recs:
-                                regs.append(Register(rec=obj))
-                            try:
-                                obj_regs = Register.objects.bulk_create(regs)
-                            except Exception as e:
-                                self.loge(e, doc, regs)
-                            else:
-                                if settings.DEBUG:
-                                    self.logd(obj_regs)
-                                for reg in obj_regs:
-                                    try:
-                                        reg.reset_admin_product_cache()
-                                    except Exception as e:
-                                        self.loge(e, reg)
-                    return JsonResponse({'result':'success', 'doc':f'{doc.id}', 'records_count':len(obj_recs)})
+        key = self.get_idempotency_key(data, request.headers.get('Idempotency-Key', '')) if isinstance(data, dict) else None
+        if not self.is_valid_idempotency_key(key):
+            return JsonResponse({'result':'error; idempotency key is too long'}, status=400)
+        if key:
+            saved = Doc.get_by_idempotency_keys([key]).get(key, None)
+            if saved:
+                return JsonResponse(self.replay(saved))
+        if settings.API_CASH_WRITE_BEHIND:
+            return self.enqueue(request.user, data, key)
+        try:
+            built = self.build_doc(request.user, data, self.get_products(data['records'])) if self.is_valid(data) else None
+        except Exception as e:
+            self.loge(e, data)
+            return JsonResponse({'result':f'error; {e}'}, status=500)
+        if built and built[1]:
+            doc, recs = built
+            doc.idempotency_key = key
+            try:
+                obj_recs = self.save_doc(doc, recs)
+            except IntegrityError as e:
+                saved = Doc.get_by_idempotency_keys([key]).get(key, None) if key else None
+                if saved:
+                    return JsonResponse(self.replay(saved))
+                self.loge(e, data)
+                return JsonResponse({'result':f'error: {e}'}, status=500)
+            except Exception as e:
+                self.loge(e, data)
+                return JsonResponse({'result':f'error: {e}'}, status=500)
+            return JsonResponse({'result':'success', 'doc':f'{doc.id}', 'records_count':len(obj_recs)})
         if settings.DEBUG:
             self.logd(data)
         return JsonResponse({'result':'error; request data invalid'}, status=400)
 
 
+def iter_json_items(stream, chunk_size=65536):
+    '''incremental parser of JSON array or NDJSON from file-like stream, yields top level items one by one'''
+    decoder, text = json.JSONDecoder(), codecs.getincrementaldecoder('utf-8')()
+    buf, pos, eof, started = '', 0, False, False
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buf):
+            if not started and buf[pos] == '[':
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                item, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                yield item
+                continue
+        elif eof:
+            return
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buf = buf[pos:] + text.decode(chunk or b'', final=eof)
+        pos = 0
+
+
+class DocsCashBatchView(DocCashAddView):
+    context_object_name = 'docs-cash-batch'
+    batch_size = 200
+
+    def prepare_customers(self, receipts):
+        '''load and create customers of all receipts by few queries'''
+        ids, names = set(), set()
+        for data in receipts:
+            customer = data.get('customer', None)
+            if isinstance(customer, dict):
+                if customer.get('id', None) is not None:
+                    ids.add(customer['id'])
+                if customer.get('name', ''):
+                    names.add(customer['name'])
+        self.customer_ids = set(Customer.objects.filter(id__in=ids).values_list('id', flat=True)) if ids else set()
+        self.customer_names = dict(Customer.objects.filter(name__in=names).values_list('name', 'id')) if names else {}
+        missing = names - set(self.customer_names)
+        if missing:
+            Customer.objects.bulk_create([Customer(name=name) for name in missing], ignore_conflicts=True)
+            self.customer_names |= dict(Customer.objects.filter(name__in=missing).values_list('name', 'id'))
+
+    def get_customer_id(self, customer):
+        if not isinstance(customer, dict):
+            self.logw(customer, 'CUSTOMER MUST BE AS DICTIONARY')
+            return None
+        id_customer = customer.get('id', None)
+        if id_customer is not None and id_customer in self.customer_ids:
+            return id_customer
+        return self.customer_names.get(customer.get('name', ''), None)
+
+    def save_batch(self, user, receipts, results, offset):
+        '''bulk insert documents, records and registers of receipts, results of receipts are appended, invalid receipt does not stop others'''
+        valid = [(offset + i, data) for i, data in enumerate(receipts) if self.is_valid(data) and self.is_valid_values(data)]
+        keys = {i: self.get_idempotency_key(data) for i, data in valid}
+        valid = [(i, data) for i, data in valid if self.is_valid_idempotency_key(keys[i])]
+        saved = Doc.get_by_idempotency_keys({key for key in keys.values() if key}) if any(keys.values()) else {}
+        first = {}
+        for i, data in valid:
+            if keys[i] and keys[i] not in saved:
+                first.setdefault(keys[i], i)
+        valid = [(i, data) for i, data in valid if not keys[i] or first.get(keys[i], None) == i]
+        products = self.get_products([r for i, data in valid for r in data['records']])
+        self.prepare_customers([data for i, data in valid])
+        built, errors = {}, {}
+        for i, data in valid:
+            try:
+                doc_recs = self.build_doc(user, data, products)
+            except Exception as e:
+                self.loge(e, i, data)
+                errors[i] = f'{e}'
+                continue
+            if doc_recs and doc_recs[1]:
+                doc_recs[0].idempotency_key = keys[i]
+                built[i] = doc_recs
+        if built:
+            self.post_built(built, errors)
+        for i in range(offset, offset + len(receipts)):
+            key = keys.get(i, None)
+            if i in errors:
+                results.append({'index':i, 'result':f'error: {errors[i]}', 'error':errors[i]})
+            elif i in built:
+                doc, recs = built[i]
+                results.append({'index':i, 'result':'success', 'doc':f'{doc.id}', 'records_count':len(recs)})
+            elif key in saved:
+                results.append({'index':i} | self.replay(saved[key]))
+            elif key in first and first[key] in built:
+                doc, recs = built[first[key]]
+                results.append({'index':i} | self.replay((doc.id, len(recs))))
+            else:
+                results.append({'index':i, 'result':'error; request data invalid'})
+
+    def post_built(self, built, errors):
+        '''post all documents by one posting, on failure every document is posted in own savepoint and failed are moved to errors'''
+        try:
+            with transaction.atomic():
+                post_docs(list(built.values()), update_sum_final=False)
+            return
+        except Exception as e:
+            self.loge(e, len(built))
+        for i, (doc, recs) in list(built.items()):
+            doc.pk = None
+            for rec in recs:
+                rec.pk = None
+            try:
+                with transaction.atomic():
+                    post_docs([(doc, recs)], update_sum_final=False)
+            except Exception as e:
+                self.loge(e, i)
+                errors[i] = f'{e}'
+                del built[i]
+
+    def save_items(self, user, items):
+        '''save queued receipts of one author by bulk statements, on failure every receipt is saved alone'''
+        results = []
+        try:
+            with transaction.atomic():
+                self.save_batch(user, [item.payload for item in items], results, 0)
+        except Exception as e:
+            self.loge(e, user, len(items))
+            if len(items) > 1:
+                for item in items:
+                    self.save_items(user, [item])
+                return
+            results = [{'index':0, 'result':f'error: {e}'}]
+        for item, result in zip(items, results):
+            item.result = result
+            item.status = ReceiptQueue.DONE if result['result'] == 'success' else ReceiptQueue.ERROR
+            item.doc_id = int(result['doc']) if 'doc' in result else None
+
+    def drain(self, batch_size=None):
+        '''save next batch of pending receipts of queue, result - count of processed receipts'''
+        with transaction.atomic():
+            items = ReceiptQueue.claim(batch_size or self.batch_size)
+            authors = {}
+            for item in items:
+                authors.setdefault(item.author_id, []).append(item)
+            for author_items in authors.values():
+                self.save_items(author_items[0].author, author_items)
+            ReceiptQueue.finish(items)
+        return len(items)
+
+    @method_decorator([ensure_csrf_cookie])
+    def post(self, request, *args, **kwargs):
+        results, receipts = [], []
+        try:
+            with transaction.atomic():
+                for data in iter_json_items(request):
+                    receipts.append(data)
+                    if len(receipts) >= self.batch_size:
+                        self.save_batch(request.user, receipts, results, len(results))
+                        receipts = []
+                if receipts:
+                    self.save_batch(request.user, receipts, results, len(results))
+        except json.decoder.JSONDecodeError as e:
+            self.loge(e)
+            return JsonResponse({'result':f'error: {e}'}, status=400)
+        except Exception as e:
+            self.loge(e)
+            return JsonResponse({'result':f'error: {e}'}, status=500)
+        count_docs = sum(1 for r in results if r['result'] == 'success')
+        if settings.DEBUG:
+            self.logd('RECEIPTS', len(results), 'DOCS', count_docs)
+        return JsonResponse({'result':'success', 'docs_count':count_docs, 'receipts':results})
+
+
+class ReceiptTicketView(View, LogMixin):
+
+    @method_decorator([ensure_csrf_cookie])
+    def get(self, request, ticket=None):
+        queryset = ReceiptQueue.objects.filter(ticket=ticket)
+        if not request.user.is_superuser:
+            queryset = queryset.filter(author=request.user)
+        item = queryset.values('ticket', 'status', 'doc_id', 'result', 'created_at', 'processed_at').first()
+        if not item:
+            return JsonResponse({'error':'NOT FOUND'}, status=404)
+        item['status'] = ReceiptQueue.STATUS_NAMES[item['status']]
+        return JsonResponse(item)
+
+
 class DocsView(ListView, LogMixin):
     limit_default = 10
     page_num_default = 1
@@ -374,13 +695,11 @@ class DocsView(ListView, LogMixin):
     context_object_name = 'docs'
     queryset = model.objects.all()
 
-    @method_decorator([ensure_csrf_cookie])
-    def get(self, request, *args, **kwargs):
-        user = request.user
-        if not user:
-            return JsonResponse({'result':'error: Please enable cookies and try again.'}, status=401)
+    def filter_queryset(self, request, user):
+        '''result - (queryset filtered by user and request parameters, limit, page number)'''
+        queryset = self.queryset
         if not user.is_superuser:
-            self.queryset = self.queryset.filter(author=user)
+            queryset = queryset.filter(author=user)
         request.GET._mutable = True
         page_num = int(request.GET.pop('page', [self.page_num_default])[0])
         limit = int(request.GET.pop('limit', [self.limit_default])[0])
@@ -393,11 +712,12 @@ class DocsView(ListView, LogMixin):
                     elif len(v) == 1:
                         v = v[0]
                 filters[k] = v
-            self.queryset = self.queryset.filter(**filters)
+            queryset = queryset.filter(**filters)
         if settings.DEBUG:
-            self.logd(self.queryset.query)
-        paginator = Paginator(self.queryset, self.limit_default)
-        page_obj = paginator.get_page(page_num)
+            self.logd(queryset.query)
+        return queryset, limit, page_num
+
+    def page_response(self, paginator, page_obj, limit, page_num):
         if settings.DEBUG:
             self.logd(page_obj.object_list)
         json_data = serialize('json', page_obj, fields=('id', 'created_at', 'registered_at', 'owner', 'contractor', 'customer', 'type', 'tax', 'sale_point', 'sum_final', 'author'))
@@ -406,6 +726,16 @@ class DocsView(ListView, LogMixin):
         rsp_hdrs = {'count':paginator.count, 'num_pages':paginator.num_pages, 'page_min':paginator.page_range.start, 'page_max':paginator.page_range.stop, 'page':page_num, 'limit':limit}
         return JsonResponse(json_data, safe=False, headers=rsp_hdrs)
 
+    @method_decorator([ensure_csrf_cookie])
+    def get(self, request, *args, **kwargs):
+        user = request.user
+        if not user:
+            return JsonResponse({'result':'error: Please enable cookies and try again.'}, status=401)
+        queryset, limit, page_num = self.filter_queryset(request, user)
+        paginator = Paginator(queryset, self.limit_default)
+        page_obj = paginator.get_page(page_num)
+        return self.page_response(paginator, page_obj, limit, page_num)
+
 
 class DocViewSalesReceipt(View, LogMixin):
     model = Doc
@@ -489,3 +819,207 @@ class CustomersView(PaginatedView):
             except Exception as e:
                 return JsonResponse({'result':f'error: {e}'}, status=500)
         return JsonResponse({'result':'success'}, safe=False)
+
+
+class AsyncPaginatedMixin():
+    '''async handler for PaginatedView, page is loaded by async ORM'''
+
+    async def apaginate(self, data, limit, page_num):
+        json_data, http_status = '{}', 200
+        paginator = Paginator(data, limit)
+        try:
+            paginator.count = await data.acount()
+            paginated_data = paginator.page(page_num)
+            paginated_data.object_list = [obj async for obj in paginated_data.object_list.aiterator(chunk_size=max(limit, 1))]
+        except EmptyPage as e:
+            http_status = 400
+            self.logw(e, 'limit', limit, 'page_num', page_num)
+            json_data = f'{{"error":"{e}"}}'
+        except Exception as e:
+            http_status = 400
+            self.loge(e, type(e), 'limit', limit, 'page_num', page_num)
+            json_data = f'{{"error":"{e}"}}'
+        else:
+            if settings.DEBUG:
+                self.logd(paginated_data.object_list)
+            json_data = self.serialize_handler(paginated_data, self.fields)
+        return paginator, json_data, http_status
+
+    @method_decorator([ensure_csrf_cookie])
+    async def get(self, request, *args, **kwargs):
+        queryset, limit, page_num = self.filter_queryset(request)
+        paginator, json_data, http_status = await self.apaginate(queryset, limit, page_num)
+        return self.paginated_response(paginator, json_data, http_status, limit, page_num)
+
+
+class AsyncProductsView(AsyncPaginatedMixin, ProductsView):
+    queryset = ProductsView.queryset.prefetch_related('barcodes')
+
+
+class AsyncProductsCashView(AsyncPaginatedMixin, ProductsCashView):
+    pass
+
+
+class AsyncProductView(ProductView):
+
+    async def aget_obj_or_404(self, *args, **kwargs):
+        obj = None
+        try:
+            obj = await self.model.objects.prefetch_related(*[f.name for f in self.model._meta.many_to_many]).aget(**kwargs)
+        except self.model.DoesNotExist as e:
+            self.logw(e)
+        except Exception as e:
+            self.loge(e)
+        return obj
+
+    async def aget_obj_count(self, instance):
+        try:
+            count = await ProductStock.aget_quantity(instance.id)
+        except Exception as e:
+            self.loge(e)
+        else:
+            return count
+        return 0
+
+    @method_decorator([ensure_csrf_cookie])
+    async def get(self, request, *args, **kwargs):
+        u = await request.auser()
+        if settings.DEBUG:
+            self.logd(u)
+        if not u:
+            return JsonResponse({'error':'USER NOT FOUND'}, status=401)
+        if not u.role_id:
+            return JsonResponse({'error':'USER ROLE NOT ACCESSIBLE'}, status=403)
+        obj = await self.aget_obj_or_404(**kwargs)
+        if obj:
+            role_fields = tuple((await RoleMatrix.aget(u.role_id)).readable(f'refs.{obj.__class__.__name__}'))
+            data = serialize('json', [obj], fields=role_fields)
+            return JsonResponse(data, safe=False, headers={'count':await self.aget_obj_count(obj)})
+        return JsonResponse({'error':'NOT FOUND'}, status=404)
+
+    @method_decorator([ensure_csrf_cookie])
+    async def head(self, *args, **kwargs):
+        count = 0
+        obj = await self.aget_obj_or_404(**kwargs)
+        if obj:
+            count = await self.aget_obj_count(obj)
+        return JsonResponse({'status':'success'}, headers={'count': count})
+
+
+class AsyncDocsView(DocsView):
+
+    @method_decorator([ensure_csrf_cookie])
+    async def get(self, request, *args, **kwargs):
+        user = await request.auser()
+        if not user:
+            return JsonResponse({'result':'error: Please enable cookies and try again.'}, status=401)
+        queryset, limit, page_num = self.filter_queryset(request, user)
+        paginator = Paginator(queryset, self.limit_default)
+        paginator.count = await queryset.acount()
+        page_obj = paginator.get_page(page_num)
+        page_obj.object_list = [obj async for obj in page_obj.object_list.aiterator()]
+        return self.page_response(paginator, page_obj, limit, page_num)
+
+
+class AsyncDocCashAddView(DocCashAddView):
+    '''lookups by async ORM, document with records is saved in one transaction by sync_to_async because async ORM has no transactions'''
+
+    async def aget_contractor_id(self, user, dtype):
+        id_contractor = await Company.aget_default_contractor_id(dtype)
+        if not id_contractor:
+            id_contractor = await user.companies.values_list('id', flat=True).afirst()
+        return id_contractor or 2
+
+    async def aget_customer_id(self, customer):
+        if not isinstance(customer, dict):
+            self.logw(customer, 'CUSTOMER MUST BE AS DICTIONARY')
+            return None
+        id_customer = customer.get('id', None)
+        if id_customer is not None and await Customer.objects.filter(id=id_customer).aexists():
+            return id_customer
+        customer_name = customer.get('name', '')
+        if not customer_name:
+            return None
+        try:
+            dbcustomer, created = await Customer.objects.aget_or_create(name=customer_name)
+        except Exception as e:
+            self.loge(e, customer)
+            return None
+        return dbcustomer.id
+
+    async def aget_products(self, records):
+        prices = self.get_prices(records)
+        products = await Product.objects.ain_bulk(prices.keys())
+        unknown = self.get_unknown_products(prices, products)
+        if unknown:
+            self.logw('UNKNOWN PRODUCTS', [p.id for p in unknown])
+            try:
+                await Product.objects.abulk_create(unknown, ignore_conflicts=True)
+            except Exception as e:
+                self.loge(e, records)
+            else:
+                products |= await Product.objects.ain_bulk([p.id for p in unknown])
+                await sync_to_async(ProductSearch.refresh)([p.id for p in unknown])
+        return products
+
+    def get_doc_type(self, alias):
+        return self.doc_type
+
+    def get_contractor_id(self, user, dtype):
+        return self.contractor_id
+
+    def get_customer_id(self, customer):
+        return self.customer_id
+
+    async def abuild_doc(self, user, data):
+        '''load everything of document by async ORM, then build it'''
+        products = await self.aget_products(data['records'])
+        dtype = data.get('type', 'sale')
+        self.doc_type = await DocType.aget_by_alias(dtype)
+        self.contractor_id = data.get('contractor', None) or await self.aget_contractor_id(user, dtype)
+        self.customer_id = await self.aget_customer_id(data.get('customer', {'id':None, 'name':'', 'extinfo':{}}))
+        return self.build_doc(user, data, products)
+
+    @method_decorator([ensure_csrf_cookie])
+    async def post(self, request, *args, **kwargs):
+        user = await request.auser()
+        try:
+            data = json.loads(request.body)
+        except json.decoder.JSONDecodeError as e:
+            self.loge(e)
+            return JsonResponse({'result':f'error: {e}'}, status=400)
+        except Exception as e:
+            self.loge(e)
+            return JsonResponse({'result':f'error: {e}'}, status=500)
+        key = self.get_idempotency_key(data, request.headers.get('Idempotency-Key', '')) if isinstance(data, dict) else None
+        if not self.is_valid_idempotency_key(key):
+            return JsonResponse({'result':'error; idempotency key is too long'}, status=400)
+        if key:
+            saved = (await Doc.aget_by_idempotency_keys([key])).get(key, None)
+            if saved:
+                return JsonResponse(self.replay(saved))
+        if settings.API_CASH_WRITE_BEHIND:
+            return await sync_to_async(self.enqueue)(user, data, key)
+        try:
+            built = await self.abuild_doc(user, data) if self.is_valid(data) else None
+        except Exception as e:
+            self.loge(e, data)
+            return JsonResponse({'result':f'error; {e}'}, status=500)
+        if built and built[1]:
+            doc, recs = built
+            doc.idempotency_key = key
+            try:
+                obj_recs = await sync_to_async(self.save_doc)(doc, recs)
+            except IntegrityError as e:
+                saved = (await Doc.aget_by_idempotency_keys([key])).get(key, None) if key else None
+                if saved:
+                    return JsonResponse(self.replay(saved))
+                self.loge(e, data)
+                return JsonResponse({'result':f'error: {e}'}, status=500)
+            except Exception as e:
+                self.loge(e, data)
+                return JsonResponse({'result':f'error: {e}'}, status=500)
+            return JsonResponse({'result':'success', 'doc':f'{doc.id}', 'records_count':len(obj_recs)})
+        if settings.DEBUG:
+            self.logd(data)
+        return JsonResponse({'result':'error; request data invalid'}, status=400)
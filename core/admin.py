@@ -13,8 +13,9 @@ from django.utils.html import format_html, format_html_join, html_safe
 from django.utils.safestring import mark_safe
 from django.urls import path, reverse
 from django import forms
+from django.forms.models import BaseModelFormSet
 from django.http import StreamingHttpResponse, FileResponse, HttpResponseRedirect, JsonResponse
-from django.db.models import F, Q, Min, Max, Sum, Value, Count, Case, When, CharField, DecimalField
+from django.db.models import F, Q, Min, Max, Sum, Value, Count, Case, When, Exists, OuterRef, Prefetch, Subquery, CharField, DecimalField
 from django.db.models.query import QuerySet
 from django.db import connections, transaction
 from django.contrib.auth.forms import ReadOnlyPasswordHashField
@@ -22,17 +23,23 @@ from django.contrib import admin, messages
 from django.contrib.admin.models import LogEntry
 from django.contrib.admin.sites import AdminSite
 from django.contrib.admin.views.autocomplete import AutocompleteJsonView
+from django.contrib.admin.widgets import AutocompleteSelect
 from django.contrib.admin.helpers import ACTION_CHECKBOX_NAME
+from django.contrib.admin.views.main import ChangeList, PAGE_VAR
 from django.shortcuts import render
 from django.views.generic.edit import FormView
 from django.core.cache import caches
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.core.exceptions import ValidationError
+from django.utils.functional import cached_property
 from django.conf import settings
 from django.apps import apps as django_apps
 from django.template import Context, Template
 
-from .models import Doc, Record, Register
-from users.models import User
-from refs.admin import CompanyFilter, DocTypeFilter, ProductFilter, CustomerFilter
+from .models import Doc, Record, Register, ProductStock, ProductBalanceSnapshot, ReceiptQueue
+from .posting import bypass_signals, post_doc
+from users.models import User, RoleMatrix
+from refs.admin import SearchFilter, CompanyFilter, DocTypeFilter, ProductFilter, CustomerFilter
 
 def get_model(app_model):
     app_name, model_name = app_model.split('.')
@@ -48,16 +55,179 @@ class UploadFileForm(forms.Form):
     file = forms.FileField(widget=forms.ClearableFileInput(attrs={'allow_multiple_selected': True}))
 
 
-class DocFilter(DropDownFilter):
+class RowAutocompleteSelect(AutocompleteSelect):
+    '''selected option of editable changelist row is taken from related object loaded with row (list_select_related) instead of query for every row'''
+    related = None
+
+    def optgroups(self, name, value, attr=None):
+        related = self.related
+        to_field_name = self.field.remote_field.get_related_field().attname
+        if related is None or [str(v) for v in value] != [str(getattr(related, to_field_name))]:
+            return super().optgroups(name, value, attr)
+        options = [] if self.is_required else [self.create_option(name, '', '', False, 0)]
+        options.append(self.create_option(name, getattr(related, to_field_name), self.choices.field.label_from_instance(related), True, len(options)))
+        return [(None, options, 0)]
+
+
+class RowRelatedFormSet(BaseModelFormSet):
+    def _construct_form(self, i, **kwargs):
+        form = super()._construct_form(i, **kwargs)
+        if form.instance.pk:
+            for name, field in form.fields.items():
+                widget = getattr(field.widget, 'widget', field.widget)
+                if isinstance(widget, RowAutocompleteSelect) and form.instance._meta.get_field(name).is_cached(form.instance):
+                    widget.related = getattr(form.instance, name)
+        return form
+
+
+#query string parameter with key of last row of previous page (KeysetChangeList, EstimatedCountPaginator)
+KEY_VAR = 'k'
+
+
+class EstimatedCountPaginator(Paginator):
+    '''
+    opt-in paginator of huge changelists (CustomModelAdmin.keyset),
+    count of unfiltered table is estimate of PostgreSQL statistics (pg_class.reltuples), exact count stops at ADMIN_PAGINATOR count_limit,
+    pages after estimated or capped count (truncated) stay reachable while rows go on,
+    page after previous one is selected by key of last row of previous page (after) instead of OFFSET
+    '''
+    def __init__(self, object_list, per_page, orphans=0, allow_empty_first_page=True, keyset=('id',), after=None):
+        super().__init__(object_list, per_page, orphans, allow_empty_first_page)
+        conf = getattr(settings, 'ADMIN_PAGINATOR', {})
+        self.keyset = tuple(keyset)
+        self.after = self.parse_key(after) if after else None
+        self.count_limit = conf.get('count_limit', 10000)
+        self.estimate_min = conf.get('estimate_min', 100000)
+        self.truncated = False
+
+    def estimate(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql' or queryset.query.where or queryset.query.distinct:
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)', [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+        return row[0] if row and row[0] >= self.estimate_min else None
+
+    @cached_property
+    def count(self):
+        estimate = self.estimate()
+        if estimate is not None:
+            self.truncated = True
+            return estimate
+        count = self.object_list.order_by()[:self.count_limit + 1].count()
+        self.truncated = count > self.count_limit
+        return min(count, self.count_limit)
+
+    def validate_number(self, number):
+        '''pages after estimated or capped count are valid, page() finds whether they have rows'''
+        if not self.count or not self.truncated:
+            return super().validate_number(number)
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger(self.error_messages['invalid_page'])
+        if number < 1:
+            raise EmptyPage(self.error_messages['min_page'])
+        return number
+
+    def parse_key(self, value):
+        '''key of row from query string (format_key), None for broken value'''
+        fields = [self.object_list.model._meta.get_field(key) for key in self.keyset]
+        values = value.split(',', len(fields) - 1)
+        if len(values) != len(fields):
+            return None
+        try:
+            return tuple(field.to_python(value) for field, value in zip(fields, values))
+        except ValidationError:
+            return None
+
+    def row_key(self, row):
+        return tuple(getattr(row, key) for key in self.keyset)
+
+    def format_key(self, row):
+        return ','.join(str(value) for value in self.row_key(row))
+
+    def keyset_descending(self):
+        '''True or False when ordering of changelist is keyset in one direction, None for other ordering (sorted by column)'''
+        pk_name = self.object_list.model._meta.pk.name
+        ordering = self.object_list.query.order_by
+        if not all(isinstance(o, str) for o in ordering):
+            return None
+        fields = tuple(pk_name if o.lstrip('-') == 'pk' else o.lstrip('-') for o in ordering)
+        directions = {o.startswith('-') for o in ordering}
+        if fields != self.keyset or len(directions) != 1:
+            return None
+        return directions.pop()
+
+    def keyset_filter(self, key, descending):
+        '''rows after key in order of changelist: (registered_at, id) < (key) for descending ordering'''
+        lookup = 'lt' if descending else 'gt'
+        condition = Q(**{f'{self.keyset[-1]}__{lookup}':key[-1]})
+        for field, value in reversed(list(zip(self.keyset[:-1], key[:-1]))):
+            condition = Q(**{f'{field}__{lookup}':value}) | (Q(**{field:value}) & condition)
+        return condition
+
+    def has_rows_after(self, page, descending):
+        '''next row exists after full page, found by key of its last row or OFFSET for other ordering'''
+        rows = page.object_list
+        if len(rows) < self.per_page:
+            return False
+        if descending is None:
+            return self.object_list[page.number * self.per_page:][:1].exists()
+        return self.object_list.filter(self.keyset_filter(self.row_key(rows[len(rows) - 1]), descending)).exists()
+
+    def page(self, number):
+        number = self.validate_number(number)
+        descending = self.keyset_descending()
+        if number > 1 and self.after is not None and descending is not None:
+            page = self._get_page(self.object_list.filter(self.keyset_filter(self.after, descending))[:self.per_page], number, self)
+        elif not self.truncated:
+            return super().page(number)
+        else:
+            page = self._get_page(self.object_list[(number - 1) * self.per_page:number * self.per_page], number, self)
+        if self.truncated:
+            if number > 1 and not len(page.object_list):
+                raise EmptyPage(self.error_messages['no_results'])
+            self.num_pages = max(self.num_pages, number + self.has_rows_after(page, descending))
+        return page
+
+
+class KeysetChangeList(ChangeList):
+    '''changelist of EstimatedCountPaginator, link to next page carries key of last row of current page (KEY_VAR)'''
+
+    def get_filters_params(self, params=None):
+        params = super().get_filters_params(params)
+        params.pop(KEY_VAR, None)
+        return params
+
+    def get_results(self, request):
+        super().get_results(request)
+        rows = self.result_list
+        self.next_key = self.paginator.format_key(rows[len(rows) - 1]) if self.multi_page and not self.show_all and len(rows) else None
+
+    def get_query_string(self, new_params=None, remove=None):
+        new_params = {KEY_VAR:None, **(new_params or {})}
+        if new_params.get(PAGE_VAR) == self.page_num + 1 and getattr(self, 'next_key', None):
+            new_params[KEY_VAR] = self.next_key
+        return super().get_query_string(new_params, remove)
+
+
+class DocFilter(SearchFilter):
     title = _('Document')
     parameter_name = 'doc'
+    search_model = 'core.Doc'
+    search_fields = ()
+    search_ordering = ('-id',)
+
+    @classmethod
+    def search_queryset(cls, request):
+        return Doc.objects.only('id', 'registered_at', 'type__name').select_related('type')
 
-    def lookups(self, request, model_admin):
-        res = []
-        queryset = Doc.objects.only('id', 'registered_at', 'type').select_related('type')
-        for it in queryset:
-            res.append((it.id, it.registered_at.strftime('%Y-%m-%d %H:%M:%S')+f' {it.type.name}'))
-        return res
+    @classmethod
+    def label(cls, obj):
+        return obj.registered_at.strftime('%Y-%m-%d %H:%M:%S')+f' {obj.type.name}'
 
     def queryset(self, request, queryset):
         if not self.value():
@@ -260,32 +430,54 @@ class CustomTabularInline(CoreBaseAdmin, admin.TabularInline):
     pass
 
 class CustomModelAdmin(CoreBaseAdmin, admin.ModelAdmin):
-    pass
+    #opt-in EstimatedCountPaginator for huge tables, keyset is ordering of changelist, for example ('registered_at', 'id') or ('id',)
+    keyset = None
+
+    def get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        if self.keyset:
+            return EstimatedCountPaginator(queryset, per_page, orphans, allow_empty_first_page, keyset=self.keyset, after=request.GET.get(KEY_VAR))
+        return super().get_paginator(request, queryset, per_page, orphans, allow_empty_first_page)
+
+    def get_changelist(self, request, **kwargs):
+        if self.keyset:
+            return KeysetChangeList
+        return super().get_changelist(request, **kwargs)
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if 'widget' not in kwargs and db_field.name in self.get_autocomplete_fields(request):
+            kwargs['widget'] = RowAutocompleteSelect(db_field, self.admin_site, using=kwargs.get('using'))
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
+    def get_changelist_formset(self, request, **kwargs):
+        formset = super().get_changelist_formset(request, **kwargs)
+        return type(formset.__name__, (RowRelatedFormSet, formset), {})
 
 
 class RecordAdmin(CustomModelAdmin):
     user = None
+    cost_permission = False
     list_display = ['id', 'get_doc', 'product', 'get_price', 'get_count', 'get_sum_price', 'extinfo']
     list_display_links = ('id',)
     search_fields = ('id', 'doc__owner__name', 'doc__contractor__name', 'doc__type__name', 'doc__tax__name', 'doc__sale_point__name', 'doc__author__username', 'extinfo')
-    list_select_related = ('product', 'doc')
+    list_select_related = ('product', 'currency', 'doc__type')
     autocomplete_fields = ('product', 'doc')
     list_filter = (ProductFilter, DocFilter, 'doc__type')
     list_editable = ['product']
+    keyset = ('id',)
+    show_full_result_count = False
 
     def check_cost_permission(self):
         if self.user.is_superuser:
             return True
         model_name = self.__class__.__name__.replace('Admin', '')
-        if get_model('users.RoleField').objects.filter(role=self.user.role, role_model__app='core', role_model__model=model_name, read=True, value='cost').exists():
-            return True
-        return False
+        return RoleMatrix.get(self.user.role_id).can_read(f'core.{model_name}', 'cost')
 
     def changelist_view(self, request, extra_context=None):
         self.user = request.user
         if settings.DEBUG:
             self.logd('CURRENT USER', self.user)
-        if self.check_cost_permission():
+        self.cost_permission = self.check_cost_permission()
+        if self.cost_permission:
             if 'get_cost' not in self.list_display:
                 self.list_display.insert(self.list_display.index('get_price'), 'get_cost')
             if 'get_sum_cost' not in self.list_display:
@@ -326,7 +518,7 @@ class RecordAdmin(CustomModelAdmin):
     get_count.admin_order_field = 'count'
 
     def get_cost(self, obj):
-        if self.check_cost_permission():
+        if self.cost_permission:
             return format_html('<font color="green" face="Verdana, Geneva, sans-serif">{} {}</font>', obj.cost.quantize(Decimal('0.00')), obj.currency.name if obj.currency else '')
         return ''
     get_cost.short_description = _('cost')
@@ -338,7 +530,7 @@ class RecordAdmin(CustomModelAdmin):
     get_price.admin_order_field = 'price'
 
     def get_sum_cost(self, obj):
-        if self.check_cost_permission():
+        if self.cost_permission:
             return format_html('<font color="green" face="Verdana, Geneva, sans-serif">{} {}</font>', (obj.cost*obj.count).quantize(Decimal('0.00')), obj.currency.name if obj.currency else '')
         return ''
     get_sum_cost.short_description = _('sum cost')
@@ -355,15 +547,16 @@ class RegisterAdmin(CustomModelAdmin):
     list_display_links = ['id']
     search_fields = ('id', 'rec__doc__owner__name', 'rec__doc__contractor__name', 'rec__doc__type__name')
     list_filter = (ProductRecordFilter, DocRecordFilter, 'rec__doc__type')
+    list_select_related = ('rec__product', 'rec__currency', 'rec__doc__type')
     list_editable = ['rec']
     autocomplete_fields = ['rec']
+    keyset = ('id',)
+    show_full_result_count = False
 
     def check_cost_permission(self):
         if self.user.is_superuser:
             return True
-        if get_model('users.RoleField').objects.filter(role=self.user.role, role_model__app='core', role_model__model='Record', read=True, value='cost').exists():
-            return True
-        return False
+        return RoleMatrix.get(self.user.role_id).can_read('core.Record', 'cost')
 
     def changelist_view(self, request, extra_context=None):
         self.user = request.user
@@ -418,6 +611,55 @@ class RegisterAdmin(CustomModelAdmin):
 admin.site.register(Register, RegisterAdmin)
 
 
+class ProductStockAdmin(CustomModelAdmin):
+    list_display = ['product', 'quantity', 'last_movement_at', 'last_cost', 'last_price']
+    list_display_links = ['product']
+    search_fields = ('product__id', 'product__name', 'product__article')
+    list_select_related = ('product',)
+    list_filter = (ProductFilter,)
+    readonly_fields = ('product', 'quantity', 'last_movement_at', 'last_record', 'last_cost', 'last_price')
+
+    def has_add_permission(self, request):
+        return False
+
+admin.site.register(ProductStock, ProductStockAdmin)
+
+
+class ProductBalanceSnapshotAdmin(CustomModelAdmin):
+    list_display = ['period_end', 'product', 'quantity']
+    list_display_links = ['period_end', 'product']
+    search_fields = ('product__id', 'product__name', 'product__article')
+    list_select_related = ('product',)
+    list_filter = ('period_end', ProductFilter)
+    readonly_fields = ('product', 'period_end', 'quantity')
+    date_hierarchy = 'period_end'
+
+    def has_add_permission(self, request):
+        return False
+
+admin.site.register(ProductBalanceSnapshot, ProductBalanceSnapshotAdmin)
+
+
+class ReceiptQueueAdmin(CustomModelAdmin):
+    list_display = ['id', 'ticket', 'created_at', 'processed_at', 'status', 'author', 'doc', 'idempotency_key', 'result']
+    list_display_links = ['id', 'ticket']
+    search_fields = ('ticket', 'idempotency_key', 'author__username', 'doc__id')
+    list_select_related = ('author', 'doc', 'doc__type')
+    list_filter = ('status', 'created_at')
+    readonly_fields = ('ticket', 'created_at', 'processed_at', 'author', 'idempotency_key', 'payload', 'status', 'doc', 'result')
+    actions = ('retry',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def retry(self, request, queryset):
+        count = queryset.filter(status=ReceiptQueue.ERROR).update(status=ReceiptQueue.PENDING, result={}, processed_at=None)
+        self.message_user(request, f'{_("receipts returned to queue")} {count} ☑', messages.SUCCESS)
+    retry.short_description = f'🔁 {_("return to queue")} 👌'
+
+admin.site.register(ReceiptQueue, ReceiptQueueAdmin)
+
+
 @html_safe
 class JSProductRelationsSet:
     def __str__(self):
@@ -494,27 +736,24 @@ field_product.on('select2:clear', function(evt) {
 class ProductAutocompleteJsonView(CoreBaseAdmin, AutocompleteJsonView):
     def serialize_result(self, obj, to_field_name):
         ext_data = {}
-        last_reg = None
+        quantity, last_cost, last_price = 0, None, None
+        if settings.BEHAVIOR_COST.get('select_from_register', False) or settings.BEHAVIOR_PRICE.get('select_from_register', False) or settings.BEHAVIOR_COUNT.get('select_from_register', False):
+            try:
+                quantity, last_cost, last_price = ProductStock.objects.filter(product_id=obj.id).values_list('quantity', 'last_cost', 'last_price').first() or (0, None, None)
+            except Exception as e:
+                self.loge(e)
         if settings.BEHAVIOR_COST.get('select_from_register', False):
-            last_reg = Register.objects.filter(rec__product_id=obj.id).order_by('-rec__doc__registered_at').select_related('rec').first()
-            if last_reg:
-                ext_data['cost'] = last_reg.rec.cost
+            if last_cost is not None:
+                ext_data['cost'] = last_cost
         elif obj.cost:
             ext_data['cost'] = obj.cost
         if settings.BEHAVIOR_PRICE.get('select_from_register', False):
-            if not last_reg:
-                last_reg = Register.objects.filter(rec__product_id=obj.id).order_by('-rec__doc__registered_at').select_related('rec').first()
-            if last_reg:
-                ext_data['price'] = last_reg.rec.price
+            if last_price is not None:
+                ext_data['price'] = last_price
         elif obj.price:
             ext_data['price'] = obj.price
         if settings.BEHAVIOR_COUNT.get('select_from_register', False):
-            SumIncome=Sum('rec__count', filter=Q(rec__doc__type__income=True), default=0)
-            SumExpense=Sum('rec__count', filter=Q(rec__doc__type__income=False), default=0)
-            try:
-                ext_data['count'] = get_model('core.Register').objects.filter(rec__product_id=obj.id).aggregate(count=SumIncome-SumExpense)['count']
-            except Exception as e:
-                self.loge(e)
+            ext_data['count'] = quantity
         if obj.unit:
             ext_data['unit'] = obj.unit.label
         result = super().serialize_result(obj, to_field_name)
@@ -539,13 +778,28 @@ class RecordInlines(CustomTabularInline):
     extra = 0
 
 
+def records_sum(field):
+    '''subquery of sum of records of document by cost or price, annotation of changelist rows and their ordering'''
+    recs = Record.objects.filter(doc_id=OuterRef('id')).order_by().values('doc_id')
+    return Subquery(recs.annotate(total=Sum(F('count') * F(field), output_field=DecimalField(max_digits=15, decimal_places=3))).values('total')[:1])
+
+
+class DocChangeList(KeysetChangeList):
+    '''records of documents are annotated for rows of changelist only, change view and actions take plain queryset'''
+
+    def get_results(self, request):
+        self.queryset = self.model_admin.annotate_records(self.queryset)
+        super().get_results(request)
+
+
 class DocAdmin(CustomModelAdmin):
     user = None
     date_hierarchy = 'registered_at'
     list_display = ['id', 'get_reg', 'created_at', 'registered_at', 'type', 'contractor', 'customer', 'get_records', 'get_sum_price', 'sum_final', 'tax', 'owner', 'author', 'extinfo']
     list_display_links = ('id', 'created_at', 'registered_at')
-    search_fields = ('id', 'created_at', 'registered_at', 'owner__name', 'contractor__name', 'type__name', 'tax__name', 'sale_point__name', 'author__username', 'extinfo')
+    search_fields = ('id', 'created_at', 'registered_at', 'owner__name', 'contractor__name', 'type__name', 'tax__name', 'sale_point__name', 'author__username', 'idempotency_key', 'extinfo')
     list_filter = ('registered_at', 'created_at', DocTypeFilter, ContractorCompanyFilter, OwnerCompanyFilter, ProductDocRecFilter, CustomerFilter)
+    list_select_related = ('type', 'contractor', 'owner', 'customer', 'tax', 'author')
     actions = ('new_incoming_from_orders', 'registration', 'unregistration', 'recalculate_final_sum', 'order_to_xls', 'sales_receipt_to_printer', 'earnings', 'merge_items')
     fieldsets = [
     (
@@ -563,6 +817,8 @@ class DocAdmin(CustomModelAdmin):
     inlines = [RecordInlines]
     list_editable = ['type']
     autocomplete_fields = ['type']
+    keyset = ('registered_at', 'id')
+    show_full_result_count = False
 
     #formfield_overrides = {CharField: {'widget': forms.Select(attrs={'size': '20'})}}
 
@@ -585,12 +841,22 @@ class DocAdmin(CustomModelAdmin):
             return queryset
         return queryset.filter(author=self.user)
 
+    def get_changelist(self, request, **kwargs):
+        return DocChangeList
+
+    @staticmethod
+    def annotate_records(queryset):
+        '''sums and registration of records for rows of changelist page by subqueries, products by one prefetch'''
+        return queryset.annotate(
+            records_sum_cost=records_sum('cost'),
+            records_sum_price=records_sum('price'),
+            records_registered=Exists(Register.objects.filter(rec__doc_id=OuterRef('id')))
+        ).prefetch_related(Prefetch('record_set', queryset=Record.objects.select_related('product').only('id', 'doc_id', 'product_id', 'product__name'), to_attr='records_products'))
+
     def check_cost_permission(self):
         if self.user.is_superuser:
             return True
-        if get_model('users.RoleField').objects.filter(role=self.user.role, role_model__app='core', role_model__model='Record', read=True, value='cost').exists():
-            return True
-        return False
+        return RoleMatrix.get(self.user.role_id).can_read('core.Record', 'cost')
 
     def changelist_view(self, request, extra_context=None):
         self.user = request.user
@@ -624,102 +890,74 @@ class DocAdmin(CustomModelAdmin):
         instance = form.save(commit=False)
         if not change or not instance.author:
             instance.author = current_user
-        instance.save()
+        with bypass_signals():
+            instance.save()
         form.save_m2m()
         return instance
 
+    def save_formset(self, request, form, formset, change):
+        '''records are saved, registered and summed once per document by posting instead of receivers of every record'''
+        if formset.model is not Record:
+            return super().save_formset(request, form, formset, change)
+        doc = form.instance
+        post_doc(doc, formset.save(commit=False), formset.deleted_objects)
+        formset.save_m2m()
+        if change and not doc.type.auto_register and not doc.extinfo.get('not_use_post_save_auto_register', False):
+            ProductStock.unregister(Record.objects.filter(doc=doc))
+
     def get_records(self, obj):
-        try:
-            idxs = Record.objects.filter(doc=obj).annotate(admin_path_prefix=Value(settings.ADMIN_PATH_PREFIX, CharField())).values_list('admin_path_prefix', 'product_id', 'product__name')
-        except Exception as e:
-            self.loge(e)
+        if not obj.records_products:
             return ''
-        else:
-            if not idxs:
-                return ''
-            content = format_html_join('\n', '<p><font color="green" face="Verdana, Geneva, sans-serif"><a href="{0}/refs/product/?id={1}" target="_blank">{2}</a></font></p>', idxs)
-            return format_html('<details><summary>{}</summary>{}</details>', idxs[0][2], content)
+        content = format_html_join('\n', '<p><font color="green" face="Verdana, Geneva, sans-serif"><a href="{0}/refs/product/?id={1}" target="_blank">{2}</a></font></p>', ((settings.ADMIN_PATH_PREFIX, rec.product_id, rec.product.name) for rec in obj.records_products))
+        return format_html('<details><summary>{}</summary>{}</details>', obj.records_products[0].product.name, content)
     get_records.short_description = _('Products')
 
     def get_sum_cost(self, obj):
-        full_sum = 0
-        try:
-            full_sum = Record.objects.filter(doc=obj).aggregate(full_sum=Sum(F('count')*F('cost')))['full_sum']
-        except Exception as e:
-            self.loge(e)
-        else:
-            if full_sum:
-                full_sum = full_sum.quantize(Decimal('0.00'))
-            else:
-                full_sum = 0
+        full_sum = obj.records_sum_cost.quantize(Decimal('0.00')) if obj.records_sum_cost else 0
         return format_html('<font color="green" face="Verdana, Geneva, sans-serif">{}</font>', full_sum)
     get_sum_cost.short_description = _('sum cost')
+    get_sum_cost.admin_order_field = records_sum('cost')
 
     def get_sum_price(self, obj):
-        full_sum = 0
-        try:
-            full_sum = Record.objects.filter(doc=obj).aggregate(full_sum=Sum(F('count')*F('price')))['full_sum']
-        except Exception as e:
-            self.loge(e)
-        else:
-            if full_sum:
-                full_sum = full_sum.quantize(Decimal('0.00'))
-            else:
-                full_sum = 0
+        full_sum = obj.records_sum_price.quantize(Decimal('0.00')) if obj.records_sum_price else 0
         return format_html('<font color="green" face="Verdana, Geneva, sans-serif">{}</font>', full_sum)
     get_sum_price.short_description = _('sum price')
+    get_sum_price.admin_order_field = records_sum('price')
 
     def get_reg(self, obj):
-        return Register.objects.filter(rec__doc=obj).exists()
+        return obj.records_registered
     get_reg.short_description = '☑'
     get_reg.help_text = _('registered')
     get_reg.boolean = True
 
     def registration(self, request, queryset):
-        updated_count = 0
-        for it in queryset.filter(type_id__in=get_model('refs.DocType').objects.filter(auto_register=True).values('id')):
-            all_reg = False
-            for r in Record.objects.filter(doc=it):
-                if not Register.objects.filter(rec=r).exists():
-                    try:
-                        obj, created = Register.objects.get_or_create(rec=r)
-                    except Exception as e:
-                        self.loge(e)
-                        break
-                    else:
-                        all_reg = True
-            if all_reg:
-                updated_count += 1
-        self.message_user(request, f'{_("updated")} {updated_count} ☑', messages.SUCCESS)
+        docs = queryset.filter(type__auto_register=True)
+        try:
+            count_regs, product_ids = ProductStock.register(Record.objects.filter(doc__in=docs.values('id')))
+        except Exception as e:
+            self.loge(e)
+            self.message_user(request, f'{e}', messages.ERROR)
+        else:
+            self.message_user(request, f'{_("registered records")} {count_regs}; {_("documents")} {docs.count()}; {_("products")} {len(product_ids)} ☑', messages.SUCCESS)
     registration.short_description = f'✅ {_("registration for accaunting")} 👌'
 
     def unregistration(self, request, queryset):
-        updated_count = 0
-        for it in queryset.filter(type_id__in=get_model('refs.DocType').objects.filter(auto_register=True).values('id')):
-            records_queryset = Record.objects.filter(doc=it)
-            count_delete, del_refs = Register.objects.filter(rec__in=records_queryset.values_list('id', flat=True)).delete()
-            if records_queryset.count() == count_delete:
-                updated_count += 1
-        self.message_user(request, f'{_("updated")} {updated_count} ☑', messages.SUCCESS)
+        docs = queryset.filter(type__auto_register=True)
+        try:
+            count_regs, product_ids = ProductStock.unregister(Record.objects.filter(doc__in=docs.values('id')))
+        except Exception as e:
+            self.loge(e)
+            self.message_user(request, f'{e}', messages.ERROR)
+        else:
+            self.message_user(request, f'{_("cancelled records")} {count_regs}; {_("documents")} {docs.count()}; {_("products")} {len(product_ids)} ☑', messages.SUCCESS)
     unregistration.short_description = f'❌ {_("cancel registration")} 👌'
 
     def recalculate_final_sum(self, request, queryset):
         updated_count = 0
-        docs = []
-        for it in queryset:
-            value = None
-            if it.type.income:
-                value = Record.objects.filter(doc=it).aggregate(sum_final=Sum(F('count') * F('cost')))['sum_final']
-            else:
-                value = Record.objects.filter(doc=it).aggregate(sum_final=Sum(F('count') * F('price')))['sum_final']
-            if value is not None and it.sum_final != value:
-                it.sum_final = value
-                docs.append(it)
-        if docs:
-            try:
-                updated_count = Doc.objects.bulk_update(docs, ['sum_final'])
-            except Exception as e:
-                self.loge(e)
+        try:
+            updated_count = Doc.recalculate_sum_final(queryset)
+        except Exception as e:
+            self.loge(e)
         self.message_user(request, f'{_("updated")} {updated_count}', messages.SUCCESS)
     recalculate_final_sum.short_description = f'🖩 {_("recalculate final sum")} 🖩'
 
@@ -803,43 +1041,22 @@ class DocAdmin(CustomModelAdmin):
         if not queryset.count():
             self.message_user(request, _('please select items'), messages.ERROR)
             return
-        records = Record.objects.filter(doc_id__in=queryset.values('id')).distinct()
+        rows = Record.objects.filter(doc_id__in=queryset.values('id')).order_by().values('product_id', 'product__cost', 'product__price').annotate(total=Sum('count')).values_list('product_id', 'product__cost', 'product__price', 'total')
         d, count_records = None, 0
-        if records.count():
+        if rows:
             company_owner = request.user.default_company
             if not company_owner:
                 company_owner = get_model('refs.Company').objects.order_by('id').first()
             d = Doc(contractor=queryset.first().contractor, owner=company_owner, type=get_model('refs.DocType').objects.filter(alias='receipt').first(), author=request.user)
+            new_recs = [Record(product_id=product_id, count=total, cost=cost, price=price) for product_id, cost, price, total in rows]
             try:
-                d.save()
+                with transaction.atomic():
+                    count_records = post_doc(d, new_recs)['records']
+                    if not d.type.auto_register:
+                        ProductStock.register(Record.objects.filter(doc=d))
             except Exception as e:
                 self.loge(e)
-            else:
-                new_recs = {}
-                for r in records:
-                    if r.product.id not in new_recs:
-                        new_recs[r.product.id] = Record(doc=d, product=r.product, count=r.count, cost=r.product.cost, price=r.product.price)
-                    else:
-                        new_recs[r.product.id].count += r.count
-                try:
-                    objs = Record.objects.bulk_create(new_recs.values())
-                except Exception as e:
-                    self.loge(e)
-                else:
-                    count_records = len(objs)
-                    regs = []
-                    for o in objs:
-                        regs.append(Register(rec=o))
-                        d.sum_final += o.count * o.cost
-                    try:
-                        d.save(update_fields=['sum_final'])
-                    except Exception as e:
-                        self.loge(e)
-                    if regs:
-                        try:
-                            rgs = Register.objects.bulk_create(regs)
-                        except Exception as e:
-                            self.loge(e)
+                d, count_records = None, 0
         self.message_user(request, f'{_("created document")} {d.id if d else 0}; {_("count records")} {count_records}', messages.SUCCESS)
     new_incoming_from_orders.short_description = f'🪄 {_("new incoming from orders")} ✨'
 
@@ -863,91 +1080,17 @@ class DocAdmin(CustomModelAdmin):
     def merge_items(self, request, queryset):
         if queryset.count() < 2:
             self.message_user(request, _('Please select more than one item'), messages.SUCCESS)
+            return
         doc_main = queryset.first()
         msg = f'{_("final document")} {doc_main.id}'
-        recs = Record.objects.filter(doc_id=doc_main.id)
-        docs_extra = queryset.filter(type_id=doc_main.type_id).exclude(id=doc_main.id)
-        recs_extra = Record.objects.filter(doc__in=docs_extra.values_list('id'))
-        recs_moved = []
-        recs_deleted = []
-        sid = transaction.savepoint()
-        for rec in recs_extra:
-            if rec.id in recs_deleted:
-                continue
-            rec_main = recs.filter(product_id=rec.product_id).first()
-            if rec_main:
-                rec_main.count += rec.count
-                try:
-                    rec_main.save(update_fields=['count'])
-                except Exception as e:
-                    transaction.savepoint_rollback(sid)
-                    self.loge(e, rec_main.id, rec_main.product)
-                    msg += f'; {e}, {rec_main.id}, {rec_main.product}'
-                    self.message_user(request, mark_safe(msg), messages.ERROR)
-                    return
-                else:
-                    recs_deleted.append(rec.id)
-            else:
-                recs_moved.append(rec.id)
-                rs = recs_extra.filter(product_id=rec.product_id).exclude(id=rec.id)
-                if rs.count():
-                    count_extra = rs.aggregate(cnt = Sum('count'))
-                    if settings.DEBUG:
-                        self.logd('FOUND DOUBLE RECORDS', rs.values_list('id'))
-                        self.logd('COUNT', rec.count)
-                        self.logd('COUNT_EXTRA', count_extra)
-                    rec.count += count_extra['cnt']
-                    try:
-                        rec.save(update_fields=['count'])
-                    except Exception as e:
-                        transaction.savepoint_rollback(sid)
-                        self.loge(e, rec.id, rec.product)
-                        msg += f'; {e}, {rec.id}, {rec.product}'
-                        self.message_user(request, mark_safe(msg), messages.ERROR)
-                        return
-                    else:
-                        recs_deleted.extend(rs.values_list('id', flat=True))
-        if recs_moved:
-            try:
-                res = Record.objects.filter(id__in=recs_moved).update(doc_id=doc_main.id)
-            except Exception as e:
-                self.loge(e)
-                msg += f'; {e}'
-            else:
-                msg += f'; {_("records moved")} {res}'
-        if recs_deleted:
-            try:
-                res = Record.objects.filter(id__in=recs_deleted).delete()
-            except Exception as e:
-                self.loge(e)
-                msg += f'; {e}'
-            else:
-                msg += f'; {_("records deleted")} {res}'
-        not_empty_extra_docs = recs_extra.values_list('doc_id', flat=True)
-        if len(not_empty_extra_docs):
-            msg += f'; {_("can't delete documents")} {not_empty_extra_docs}'
-        else:
-            docs_extra_for_delete = list(docs_extra.only('id').values_list('id', flat=True))
-            try:
-                res = docs_extra.delete()
-            except Exception as e:
-                self.loge(e)
-                msg += f'; {e}'
-            else:
-                msg += f'; {_("documents deleted")} {docs_extra_for_delete} {res[1]}'
-        value_sum_final = None
-        if doc_main.type.income:
-            value_sum_final = Record.objects.filter(doc=doc_main).aggregate(sum_final=Sum(F('count') * F('cost')))['sum_final']
+        try:
+            res = Doc.merge(doc_main, queryset.filter(type_id=doc_main.type_id))
+        except Exception as e:
+            self.loge(e, doc_main.id)
+            self.message_user(request, mark_safe(f'{msg}; {e}'), messages.ERROR)
         else:
-            value_sum_final = Record.objects.filter(doc=doc_main).aggregate(sum_final=Sum(F('count') * F('price')))['sum_final']
-        if value_sum_final is not None and doc_main.sum_final != value_sum_final:
-            try:
-                Doc.objects.filter(id=doc_main.id).update(sum_final=value_sum_final)
-            except Exception as e:
-                self.loge(e)
-                msg += f'; {e}'
-        transaction.savepoint_commit(sid)
-        self.message_user(request, mark_safe(msg), messages.SUCCESS)
+            msg += f'; {_("records updated")} {res["updated"]}; {_("records moved")} {res["moved"]}; {_("records deleted")} {res["deleted"]}; {_("documents deleted")} {res["docs"]}'
+            self.message_user(request, mark_safe(msg), messages.SUCCESS)
     merge_items.short_description = f'🫕 {_("combine elements and remove unnecessary ones")} 🫕'
 
 admin.site.register(Doc, DocAdmin)
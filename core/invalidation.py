@@ -0,0 +1,295 @@
+import logging, os, threading, time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils.module_loading import import_string
+
+'''
+cross-process invalidation bus for in-memory caches of admin
+message format "topic:id,id,..." or "topic:*" for drop all keys of topic
+'''
+
+ALL = '*'
+
+
+class InvalidationBus():
+    def __init__(self, channel='prod_invalidation', **options):
+        self.channel = channel
+        self.options = options
+        self.subscribers = {}
+        self.lock = threading.Lock()
+
+    def logi(self, *args):
+        logging.info('::'.join([f'💡{self.__class__.__name__}'] + [f'{a}' for a in args]))
+
+    def loge(self, err, *args):
+        logging.error('::'.join([f'🆘{self.__class__.__name__}.{err.__traceback__.tb_frame.f_code.co_name}'] + [f'{a}' for a in args] + [f'{err}', f'LINE={err.__traceback__.tb_lineno}']))
+
+    def subscribe(self, topic, callback):
+        with self.lock:
+            self.subscribers.setdefault(topic, []).append(callback)
+
+    def start(self):
+        '''start receiving messages of other processes, called lazily by subscribers'''
+        pass
+
+    def encode(self, topic, keys, max_length=7900):
+        if keys is None:
+            return [f'{topic}:{ALL}']
+        messages, msg = [], ''
+        for key in sorted(set(keys)):
+            if len(msg) + len(f'{key}') + len(topic) + 2 > max_length:
+                messages.append(f'{topic}:{msg}')
+                msg = ''
+            msg = f'{msg},{key}' if msg else f'{key}'
+        if msg:
+            messages.append(f'{topic}:{msg}')
+        return messages
+
+    def dispatch(self, topic, keys):
+        for callback in self.subscribers.get(topic, []):
+            try:
+                callback(keys)
+            except Exception as e:
+                self.loge(e, topic, keys)
+
+    def receive(self, message):
+        topic, _, payload = message.partition(':')
+        if not payload or payload == ALL:
+            self.dispatch(topic, None)
+        else:
+            self.dispatch(topic, [int(k) if k.isdigit() else k for k in payload.split(',')])
+
+    def receive_all(self):
+        '''messages may be lost (reconnect, truncated file), drop everything'''
+        for topic in list(self.subscribers):
+            self.dispatch(topic, None)
+
+    def publish(self, topic, keys=None):
+        '''
+        keys=None - invalidate all keys of topic,
+        local caches and other processes are invalidated on commit, so values are not reloaded from uncommitted state
+        '''
+        if keys is not None:
+            keys = [k for k in keys if k is not None]
+            if not keys:
+                return
+        messages = self.encode(topic, keys)
+        transaction.on_commit(lambda: self.deliver(topic, keys, messages))
+
+    def deliver(self, topic, keys, messages):
+        self.dispatch(topic, keys)
+        self.broadcast(messages)
+
+    def broadcast(self, messages):
+        pass
+
+
+class LocalInvalidationBus(InvalidationBus):
+    '''current process only, for tests and single worker'''
+    pass
+
+
+class FileInvalidationBus(InvalidationBus):
+    '''shared append only file, for SQLite and several workers on one host'''
+    def __init__(self, channel='prod_invalidation', path=None, interval=1.0, max_bytes=1048576, **options):
+        super().__init__(channel, **options)
+        self.path = path or os.path.join(settings.BASE_DIR, 'logs', f'{channel}.bus')
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.offset = None
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.poll()
+                    self.thread = threading.Thread(target=self.listen, name=f'{self.__class__.__name__}', daemon=True)
+                    self.thread.start()
+
+    def listen(self):
+        while True:
+            time.sleep(self.interval)
+            self.poll()
+
+    def poll(self):
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        if self.offset is None:
+            self.offset = size
+            return
+        if size < self.offset:
+            self.offset = 0
+            self.receive_all()
+        if size == self.offset:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                f.seek(self.offset)
+                data = f.read()
+        except Exception as e:
+            self.loge(e, self.path)
+            return
+        if not data.endswith('\n'):
+            data = data[:data.rfind('\n') + 1]
+        self.offset += len(data.encode('utf-8'))
+        for message in data.splitlines():
+            if message:
+                self.receive(message)
+
+    def write(self, messages):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                os.truncate(self.path, 0)
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, ''.join(f'{m}\n' for m in messages).encode('utf-8'))
+            finally:
+                os.close(fd)
+        except Exception as e:
+            self.loge(e, self.path)
+
+    def broadcast(self, messages):
+        self.write(messages)
+
+
+class PostgresInvalidationBus(InvalidationBus):
+    '''LISTEN/NOTIFY, notifications are sent after commit of current transaction and dropped on rollback'''
+    def __init__(self, channel='prod_invalidation', using='default', reconnect_interval=5.0, **options):
+        super().__init__(channel, **options)
+        self.using = using
+        self.reconnect_interval = reconnect_interval
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.listen, name=f'{self.__class__.__name__}', daemon=True)
+                    self.thread.start()
+
+    def connect(self):
+        import psycopg
+        s = connections[self.using].settings_dict
+        params = {'dbname':s['NAME'], 'user':s['USER'], 'password':s['PASSWORD'], 'host':s['HOST'], 'port':s['PORT']}
+        return psycopg.connect(autocommit=True, **{k:v for k,v in params.items() if v})
+
+    def listen(self):
+        from psycopg import sql
+        while True:
+            try:
+                with self.connect() as conn:
+                    conn.execute(sql.SQL('LISTEN {}').format(sql.Identifier(self.channel)))
+                    self.logi('LISTEN', self.channel)
+                    self.receive_all()
+                    for notify in conn.notifies():
+                        self.receive(notify.payload)
+            except Exception as e:
+                self.loge(e, self.channel)
+            time.sleep(self.reconnect_interval)
+
+    def broadcast(self, messages):
+        try:
+            with connections[self.using].cursor() as cursor:
+                for message in messages:
+                    cursor.execute('SELECT pg_notify(%s, %s)', [self.channel, message])
+        except Exception as e:
+            self.loge(e, messages)
+
+
+__bus__ = None
+
+def get_invalidation_bus():
+    global __bus__
+    if __bus__ is None:
+        conf = getattr(settings, 'INVALIDATION_BUS', {})
+        backend = conf.get('BACKEND', 'core.invalidation.LocalInvalidationBus')
+        options = conf.get('OPTIONS', {})
+        bus_class = import_string(backend)
+        if issubclass(bus_class, PostgresInvalidationBus) and connections[options.get('using', 'default')].vendor != 'postgresql':
+            bus_class = LocalInvalidationBus
+        __bus__ = bus_class(**options)
+    return __bus__
+
+def invalidate_products(product_ids=None):
+    '''product_ids=None - drop all cached products in all processes'''
+    get_invalidation_bus().publish('product', product_ids)
+
+
+class LRUCache():
+    '''bounded in-memory cache, subscribed to invalidation bus topic'''
+    def __init__(self, maxsize=10000, topic=None):
+        self.maxsize = maxsize
+        self.topic = topic
+        self.data = OrderedDict()
+        self.lock = threading.RLock()
+        self.started = False
+        if topic:
+            get_invalidation_bus().subscribe(topic, self.invalidate)
+
+    def start(self):
+        if self.topic and not self.started:
+            self.started = True
+            get_invalidation_bus().start()
+
+    def __contains__(self, key):
+        self.start()
+        return key in self.data
+
+    def __getitem__(self, key):
+        self.start()
+        with self.lock:
+            value = self.data[key]
+            self.data.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        self.start()
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.data[key]
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({len(self.data)}/{self.maxsize})'
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        with self.lock:
+            if key not in self:
+                self[key] = default
+            return self[key]
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.data.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def invalidate(self, keys=None):
+        with self.lock:
+            if keys is None:
+                self.data.clear()
+            else:
+                for key in keys:
+                    self.data.pop(key, None)
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import Doc, ProductBalanceSnapshot
+from core.posting import Posting
+
+
+class Command(BaseCommand):
+    help = 'post documents without signals: register records of auto registered types, calculate empty final sums, update references of products'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ids', default='', help='comma separated ids of documents')
+        parser.add_argument('--from', dest='date_from', default='', help='begin of registered date as ISO datetime or date')
+        parser.add_argument('--to', dest='date_to', default='', help='end of registered date as ISO datetime or date')
+        parser.add_argument('--batch-size', type=int, default=500, help='count of documents per transaction')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('BATCH SIZE MUST BE POSITIVE')
+        docs = Doc.objects.order_by('registered_at', 'id')
+        if options['ids']:
+            docs = docs.filter(id__in=[int(i) for i in options['ids'].split(',') if i.strip().isdigit()])
+        if options['date_from']:
+            docs = docs.filter(registered_at__gte=ProductBalanceSnapshot.parse_at(options['date_from'], False))
+        if options['date_to']:
+            docs = docs.filter(registered_at__lte=ProductBalanceSnapshot.parse_at(options['date_to']))
+        ids = list(docs.values_list('id', flat=True))
+        posting, registered, products = Posting(), 0, set()
+        for i in range(0, len(ids), options['batch_size']):
+            result = posting.post([(doc, []) for doc in Doc.objects.filter(id__in=ids[i:i + options['batch_size']])])
+            registered += result['registered']
+            products |= result['products']
+            self.stdout.write(f'{min(i + options["batch_size"], len(ids))}/{len(ids)}: REGISTERED {result["registered"]}')
+        self.stdout.write(self.style.SUCCESS(f'POSTED {len(ids)} DOCUMENTS; REGISTERED {registered} RECORDS; PRODUCTS {len(products)}'))
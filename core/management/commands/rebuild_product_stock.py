@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import ProductStock
+
+
+class Command(BaseCommand):
+    help = 'rebuild product stock balances from register and verify them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify-only', action='store_true', default=False, help='only compare stored balances with register')
+        parser.add_argument('--batch-size', type=int, default=1000, help='count of rows per insert')
+
+    def handle(self, *args, **options):
+        if not options['verify_only']:
+            count = ProductStock.rebuild(options['batch_size'])
+            self.stdout.write(f'REBUILT {count} PRODUCT STOCKS')
+        errors = ProductStock.verify()
+        for product_id, quantity, registered in errors:
+            self.stderr.write(f'PRODUCT {product_id}: STORED {quantity} != REGISTERED {registered}')
+        if errors:
+            raise CommandError(f'FOUND {len(errors)} INVALID PRODUCT STOCKS')
+        self.stdout.write(self.style.SUCCESS('PRODUCT STOCKS VERIFIED'))
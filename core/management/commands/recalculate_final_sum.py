@@ -0,0 +1,39 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Min, Max
+
+from core.models import Doc, ProductBalanceSnapshot
+
+
+class Command(BaseCommand):
+    help = 'recalculate final sum of documents from records by chunks of registered date'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='date_from', default='', help='begin of range as ISO datetime or date, default first document')
+        parser.add_argument('--to', dest='date_to', default='', help='end of range as ISO datetime or date, default last document')
+        parser.add_argument('--days', type=int, default=30, help='count of days per chunk (transaction)')
+
+    def handle(self, *args, **options):
+        if options['days'] < 1:
+            raise CommandError('DAYS MUST BE POSITIVE')
+        bounds = Doc.objects.aggregate(first=Min('registered_at'), last=Max('registered_at'))
+        date_from = ProductBalanceSnapshot.parse_at(options['date_from'], False) if options['date_from'] else bounds['first']
+        date_to = ProductBalanceSnapshot.parse_at(options['date_to']) if options['date_to'] else bounds['last']
+        if not date_from or not date_to:
+            self.stdout.write('DOCUMENTS NOT FOUND')
+            return
+        step, total = timedelta(days=options['days']), 0
+        begin = date_from
+        while begin <= date_to:
+            end = min(begin + step, date_to)
+            docs = Doc.objects.filter(registered_at__gte=begin, registered_at__lte=end) if end == date_to else Doc.objects.filter(registered_at__gte=begin, registered_at__lt=end)
+            with transaction.atomic():
+                count = Doc.recalculate_sum_final(docs)
+            total += count
+            self.stdout.write(f'{begin.isoformat()} - {end.isoformat()}: UPDATED {count}')
+            if end == date_to:
+                break
+            begin = end
+        self.stdout.write(self.style.SUCCESS(f'UPDATED {total} DOCUMENTS'))
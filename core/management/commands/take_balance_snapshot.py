@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import ProductBalanceSnapshot
+
+
+class Command(BaseCommand):
+    help = 'save registered balances of all products at the end of period, run periodically (cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--at', default='', help='end of period as ISO datetime or date, default now')
+        parser.add_argument('--refresh', action='store_true', default=False, help='recalculate all existing snapshots from register')
+        parser.add_argument('--batch-size', type=int, default=1000, help='count of rows per insert')
+
+    def handle(self, *args, **options):
+        if options['refresh']:
+            count = ProductBalanceSnapshot.refresh()
+            self.stdout.write(f'REFRESHED {count} BALANCE SNAPSHOTS')
+            return
+        at = None
+        if options['at']:
+            at = ProductBalanceSnapshot.parse_at(options['at'])
+            if not at:
+                raise CommandError(f'INVALID DATE {options["at"]}')
+        count = ProductBalanceSnapshot.take(at, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'SAVED {count} BALANCE SNAPSHOTS'))
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.models import ProductStock
+
+
+class Command(BaseCommand):
+    help = 'set cost and price of product references from last registered records in REFERENCE_UPDATE="periodic" mode, run periodically (cron) or as service with --loop'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='count of products updated in one transaction')
+        parser.add_argument('--loop', action='store_true', default=False, help='wait for new registrations forever')
+        parser.add_argument('--interval', type=float, default=5.0, help='seconds between updates in loop mode')
+
+    def handle(self, *args, **options):
+        while True:
+            count = ProductStock.apply_pending_references(options['batch_size'])
+            if not options['loop']:
+                self.stdout.write(self.style.SUCCESS(f'UPDATED {count} PRODUCTS'))
+                break
+            if count:
+                self.stdout.write(f'UPDATED {count} PRODUCTS')
+            time.sleep(options['interval'])
@@ -1,19 +1,25 @@
-import logging, sys
+import logging, sys, threading
+from decimal import Decimal
 from uuid import uuid4
 from itertools import chain
 from datetime import datetime, timedelta, timezone
 
 from django.conf import settings
-from django.db import models, transaction
-from django.db.models import F, Q, Max, Sum, Subquery, Value, IntegerField, JSONField
+from django.db import connections, models, transaction
+from django.db.models import F, Q, Min, Max, Sum, Count, Case, When, OuterRef, Subquery, Exists, Value, IntegerField, DecimalField, JSONField
+from django.db.models.functions import Coalesce
 from django.db.models.signals import pre_save, post_save, post_init, post_delete
 from django.dispatch import receiver
 from django.utils import timezone as django_timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from django.utils.translation import gettext as _
 from django.core.cache import caches
 from django.db.utils import IntegrityError
 from django.apps import apps as django_apps
 from django.contrib import admin
+
+from .invalidation import invalidate_products
+from .posting import bypass_signals, signals_bypassed
 try:
     from zoneinfo import available_timezones, ZoneInfo
 except:
@@ -24,6 +30,9 @@ def get_model(app_model):
     app_name, model_name = app_model.split('.')
     return django_apps.get_app_config(app_name).get_model(model_name)
 
+#product ids of references updated after commit of transaction of current thread
+__pending_references__ = threading.local()
+
 
 class CustomAbstractModel(models.Model):
 
@@ -113,19 +122,87 @@ class Doc(CustomAbstractModel):
     sale_point = models.ForeignKey('refs.SalePoint', default=None, null=True, blank=True, on_delete=models.SET_NULL, verbose_name=_('sale point'), help_text=_('sale point of document'))
     author = models.ForeignKey('users.User', default=1, null=False, blank=False, editable=False, on_delete=models.CASCADE, verbose_name=_('author'), help_text=_('author of document'))
     sum_final = models.DecimalField(max_digits=15, decimal_places=3, default=0, null=False, blank=False, verbose_name=_('final sum'), help_text=_('final sum of document'))
+    idempotency_key = models.CharField(max_length=128, default=None, null=True, blank=True, unique=True, editable=False, verbose_name=_('idempotency key'), help_text=_('key of client submission, repeated submission returns saved document'))
     extinfo = JSONField(default=dict, blank=True)
 
     class Meta:
         verbose_name = f'🗂{_("Doc")}'
         verbose_name_plural = f'🗂{_("Docs")}'
         ordering = ['-registered_at']
+        indexes = [models.Index(fields=['registered_at', 'id'], name='core_doc_registered_id')]
 
     def __str__(self):
         return f'[{self.id}]{self.type.name}'
 
+    @classmethod
+    def sum_final_expression(cls, prefix=''):
+        '''sum of records by cost for income document type else by price, prefix - path from record to document'''
+        return Sum(F('count') * Case(When(**{f'{prefix}doc__type__income':True}, then=F('cost')), default=F('price')), output_field=DecimalField(max_digits=15, decimal_places=3))
+
+    @classmethod
+    def get_by_idempotency_keys(cls, keys):
+        '''result - {idempotency key: (doc id, count of records)} of already saved documents by one query'''
+        rows = cls.objects.filter(idempotency_key__in=keys).order_by().annotate(records_count=Count('record')).values_list('idempotency_key', 'id', 'records_count')
+        return {key: (id_doc, records_count) for key, id_doc, records_count in rows}
+
+    @classmethod
+    async def aget_by_idempotency_keys(cls, keys):
+        rows = cls.objects.filter(idempotency_key__in=keys).order_by().annotate(records_count=Count('record')).values_list('idempotency_key', 'id', 'records_count')
+        return {key: (id_doc, records_count) async for key, id_doc, records_count in rows}
+
+    @classmethod
+    def recalculate_sum_final(cls, docs):
+        '''set-based recalculation of final sum for queryset of documents, result - count of changed documents'''
+        sums = get_model('core.Record').objects.filter(doc_id__in=docs.values('id')).order_by().values('doc_id').annotate(total=cls.sum_final_expression())
+        connection = connections[docs.db]
+        if connection.vendor in ('postgresql', 'sqlite'):
+            sql, params = sums.query.sql_with_params()
+            table = connection.ops.quote_name(cls._meta.db_table)
+            with connection.cursor() as cursor:
+                cursor.execute(f'UPDATE {table} SET sum_final = s.total FROM ({sql}) AS s WHERE {table}.id = s.doc_id AND {table}.sum_final <> s.total', params)
+                return cursor.rowcount
+        total = Subquery(sums.filter(doc_id=OuterRef('id')).values('total')[:1])
+        return cls.objects.filter(id__in=docs.values('id')).annotate(total=total).exclude(total__isnull=True).exclude(sum_final=F('total')).update(sum_final=total)
+
+    @classmethod
+    def merge(cls, doc_main, docs_extra):
+        '''
+        grouped merge of records of documents into main document: counts of product are added to first record of main document
+        or to first record of product moved from other documents, rest of records and emptied documents are deleted,
+        registered and unregistered records are merged separately and only records which held stock are registered again,
+        so registered balance does not change, result - {'updated', 'moved', 'deleted', 'docs'}
+        '''
+        Record, Register, ProductStock = get_model('core.Record'), get_model('core.Register'), get_model('core.ProductStock')
+        output_field = DecimalField(max_digits=15, decimal_places=3)
+        extra_ids = list(docs_extra.exclude(id=doc_main.id).values_list('id', flat=True))
+        recs_main = Record.objects.filter(doc_id=doc_main.id)
+        recs_extra = Record.objects.filter(doc_id__in=extra_ids)
+        held = Exists(Register.objects.filter(rec_id=OuterRef('id')))
+        with bypass_signals(), transaction.atomic():
+            #keys of groups are (product_id, registered)
+            totals = {(product_id, registered): (first_id, total) for product_id, registered, first_id, total in recs_extra.order_by().annotate(registered=held).values('product_id', 'registered').annotate(first_id=Min('id'), total=Sum('count')).values_list('product_id', 'registered', 'first_id', 'total')}
+            firsts = {(product_id, registered): first_id for product_id, registered, first_id in recs_main.filter(product_id__in={product_id for product_id, registered in totals}).order_by().annotate(registered=held).values('product_id', 'registered').annotate(first_id=Min('id')).values_list('product_id', 'registered', 'first_id') if (product_id, registered) in totals}
+            targets = [firsts.get(key, first_id) for key, (first_id, total) in totals.items() if key[1]]
+            ProductStock.unregister(Record.objects.filter(Q(doc_id__in=extra_ids) | Q(id__in=firsts.values())))
+            updated = moved = 0
+            if firsts:
+                updated = Record.objects.filter(id__in=firsts.values()).update(count=F('count') + Case(*[When(id=rec_id, then=Value(totals[key][1], output_field)) for key, rec_id in firsts.items()], default=Value(0, output_field), output_field=output_field))
+            move = {first_id: total for key, (first_id, total) in totals.items() if key not in firsts}
+            if move:
+                moved = Record.objects.filter(id__in=move.keys()).update(doc_id=doc_main.id, count=Case(*[When(id=rec_id, then=Value(total, output_field)) for rec_id, total in move.items()], default=F('count'), output_field=output_field))
+            deleted = recs_extra.delete()[1].get(Record._meta.label, 0)
+            docs = cls.objects.filter(id__in=extra_ids).delete()[1].get(cls._meta.label, 0)
+            cls.recalculate_sum_final(cls.objects.filter(id=doc_main.id))
+            if targets:
+                ProductStock.register(Record.objects.filter(id__in=targets))
+        return {'updated':updated, 'moved':moved, 'deleted':deleted, 'docs':docs}
+
 @receiver(pre_save, sender=Doc)
 def on_doc_pre_save(sender, **kwargs):
     instance: Doc = kwargs['instance']
+    update_fields = kwargs.get('update_fields')
+    if not instance._state.adding and (not update_fields or {'type', 'registered_at'} & set(update_fields)):
+        instance._stock_origin = Doc.objects.filter(pk=instance.pk).values_list('type_id', 'registered_at').first()
     if kwargs.get('created', False):
         recs = get_model('core.Record').objects.filter(doc=instance)
         if not instance.sum_final and recs.count():
@@ -140,25 +217,25 @@ def on_doc_pre_save(sender, **kwargs):
 @receiver(post_save, sender=Doc)
 def on_doc_post_save(sender, **kwargs):
     instance: Doc = kwargs['instance']
-    if not kwargs.get('created', False) and not instance.extinfo.get('not_use_post_save_auto_register', False):
+    if not kwargs.get('created', False) and not signals_bypassed() and not instance.extinfo.get('not_use_post_save_auto_register', False):
         recs = get_model('core.Record').objects.filter(doc=instance)
         recs_count = recs.count()
         regs = get_model('core.Register').objects.filter(rec__in=recs.values_list('id', flat=True))
         if instance.type.auto_register:
             if recs_count and recs_count != regs.count():
-                regs_new = []
-                for r in recs:
-                    regs_new.append(get_model('core.Register')(rec=r))
                 try:
-                    rgs = get_model('core.Register').objects.bulk_create(regs_new)
+                    get_model('core.ProductStock').register(recs)
                 except Exception as e:
                     instance.loge(e)
         elif recs_count:
             if regs.count():
                 try:
-                    regs.delete()
+                    get_model('core.ProductStock').unregister(recs)
                 except Exception as e:
                     instance.loge(e)
+    stock_origin = getattr(instance, '_stock_origin', None)
+    if stock_origin and stock_origin != (instance.type_id, instance.registered_at):
+        get_model('core.ProductStock').refresh(get_model('core.Record').objects.filter(doc=instance).values_list('product_id', flat=True))
 
 
 class Record(CustomAbstractModel):
@@ -183,9 +260,30 @@ class Record(CustomAbstractModel):
     def sum_price(self):
         return self.count * self.price
 
+@receiver(pre_save, sender=Record)
+def on_rec_pre_save(sender, **kwargs):
+    if signals_bypassed():
+        return
+    instance: Record = kwargs['instance']
+    update_fields = kwargs.get('update_fields')
+    if not instance._state.adding and (not update_fields or {'count', 'product'} & set(update_fields)):
+        instance._stock_origin = Record.objects.filter(pk=instance.pk, register__isnull=False).values_list('product_id', 'count').first()
+
 @receiver(post_save, sender=Record)
 def on_rec_post_save(sender, **kwargs):
+    if signals_bypassed():
+        return
     instance: Record = kwargs['instance']
+    stock_origin = getattr(instance, '_stock_origin', None)
+    if stock_origin:
+        instance._stock_origin = None
+        product_id, count = stock_origin
+        if product_id != instance.product_id:
+            ProductStock.refresh([product_id, instance.product_id])
+        elif count != instance.count:
+            ProductStock.apply_movements({product_id: (ProductStock.signed_count(instance.count - count, instance.doc.type.income), instance.doc.registered_at)})
+    if not kwargs.get('created', False):
+        ProductStock.objects.filter(last_record_id=instance.id).update(last_cost=instance.cost, last_price=instance.price)
     recs = Record.objects.filter(doc=instance.doc)
     if not instance.doc.sum_final:
         value = None
@@ -201,35 +299,20 @@ def on_rec_post_save(sender, **kwargs):
         elif not instance.doc.type.income and instance.price and instance.count:
             Doc.objects.filter(id=instance.doc_id).update(sum_final = instance.doc.sum_final + instance.price * instance.count)
     if instance.doc.type.auto_register:
-        if not Register.objects.filter(rec=instance).exists():
+        try:
+            ProductStock.register(Record.objects.filter(id=instance.id))
+        except Exception as e:
+            instance.loge(e)
+        last_at = ProductStock.objects.filter(product_id=instance.product_id).values_list('last_movement_at', flat=True).first()
+        if not last_at or last_at <= instance.doc.registered_at:
             try:
-                Register(rec=instance).save()
+                ProductStock.defer_references([instance.product_id])
             except Exception as e:
                 instance.loge(e)
-        last_doc = Doc.objects.filter(id__in=Record.objects.filter(product=instance.product).values('doc_id')).order_by('registered_at').last()
-        if last_doc and last_doc.registered_at <= instance.doc.registered_at:
-            updatefields = []
-            if settings.BEHAVIOR_COST.get('register_change_referece', False):
-                if instance.cost and instance.cost != instance.product.cost:
-                    instance.product.cost = instance.cost
-                    updatefields.append('cost')
-            if settings.BEHAVIOR_PRICE.get('register_change_referece', False):
-                if instance.price and instance.price != instance.product.price:
-                    instance.product.price = instance.price
-                    updatefields.append('price')
-            if updatefields:
-                try:
-                    instance.product.save(update_fields=updatefields)
-                except Exception as e:
-                    instance.loge(e)
         try:
-            product_admin = admin.site.get_model_admin(get_model('refs.Product'))
+            invalidate_products([instance.product_id])
         except Exception as e:
             instance.loge(e)
-        else:
-            if product_admin and hasattr(product_admin, '__objs__'):
-                if instance.product_id in product_admin.__objs__:
-                    del product_admin.__objs__[instance.product_id]
 
 
 class Register(CustomAbstractModel):
@@ -239,22 +322,432 @@ class Register(CustomAbstractModel):
         verbose_name = f'✅{_("Register")}'
         verbose_name_plural = f'✅{_("Registers")}'
         ordering = ['-id']
+        constraints = [models.UniqueConstraint(fields=['rec'], name='unique_register_rec')]
 
     def reset_admin_product_cache(self):
         try:
-            product_admin = admin.site.get_model_admin(get_model('refs.Product'))
+            invalidate_products([self.rec.product_id])
         except Exception as e:
             self.loge(e)
-        else:
-            if product_admin and hasattr(product_admin, '__objs__'):
-                if self.rec.product_id in product_admin.__objs__:
-                    del product_admin.__objs__[self.rec.product_id]
-                self.logd(product_admin.__objs__)
 
 @receiver(post_save, sender=Register)
 def on_reg_post_save(sender, **kwargs):
-    kwargs['instance'].reset_admin_product_cache()
+    if signals_bypassed():
+        return
+    instance: Register = kwargs['instance']
+    if kwargs.get('created', False):
+        try:
+            records = Record.objects.filter(id=instance.rec_id)
+            ProductStock.apply_movements(ProductStock.movements(records), last=ProductStock.last_records(records))
+        except Exception as e:
+            instance.loge(e)
+    instance.reset_admin_product_cache()
 
 @receiver(post_delete, sender=Register)
 def on_reg_post_delete(sender, **kwargs):
-    kwargs['instance'].reset_admin_product_cache()
+    if signals_bypassed():
+        return
+    instance: Register = kwargs['instance']
+    try:
+        ProductStock.apply_movements(ProductStock.movements(Record.objects.filter(id=instance.rec_id)), -1, cancelled=[instance.rec_id])
+    except Exception as e:
+        instance.loge(e)
+    instance.reset_admin_product_cache()
+
+
+class ProductStock(CustomAbstractModel):
+    product = models.OneToOneField('refs.Product', primary_key=True, on_delete=models.CASCADE, related_name='stock', verbose_name=_('product'), help_text=_('refernce of product'))
+    quantity = models.DecimalField(max_digits=15, decimal_places=3, default=0, null=False, blank=False, verbose_name=_('quantity'), help_text=_('registered balance of product'))
+    last_movement_at = models.DateTimeField(default=None, null=True, blank=True, verbose_name=_('last movement date'), help_text=_('registered date of last document with product'))
+    last_record = models.ForeignKey(Record, default=None, null=True, blank=True, on_delete=models.SET_NULL, related_name='+', verbose_name=_('last record'), help_text=_('last registered record of product'))
+    last_cost = models.DecimalField(max_digits=15, decimal_places=3, default=None, null=True, blank=True, verbose_name=_('last cost'), help_text=_('cost of last registered record'))
+    last_price = models.DecimalField(max_digits=15, decimal_places=3, default=None, null=True, blank=True, verbose_name=_('last price'), help_text=_('price of last registered record'))
+    reference_pending = models.BooleanField(default=False, db_index=True, verbose_name=_('reference pending'), help_text=_('cost and price of product reference wait for periodic update from last registered record'))
+
+    class Meta:
+        verbose_name = f'📊{_("Product Stock")}'
+        verbose_name_plural = f'📊{_("Product Stocks")}'
+
+    def __str__(self):
+        return f'{self.product_id}: {self.quantity}'
+
+    @staticmethod
+    def signed_count(count, income):
+        return count if income else -count
+
+    @staticmethod
+    def signed_sum(prefix=''):
+        '''prefix - path to record, "rec__" for register'''
+        return Sum(Case(When(**{f'{prefix}doc__type__income':True}, then=F(f'{prefix}count')), default=-F(f'{prefix}count'), output_field=DecimalField(max_digits=15, decimal_places=3)))
+
+    @classmethod
+    def movements(cls, records):
+        '''records - queryset of registered records, result - {product_id: (signed count, last registered date)}'''
+        rows = records.order_by().values('product_id').annotate(delta=cls.signed_sum(), last_at=Max('doc__registered_at')).values_list('product_id', 'delta', 'last_at')
+        return {product_id: (delta, last_at) for product_id, delta, last_at in rows}
+
+    @classmethod
+    def apply_movements(cls, movements, sign=1, snapshots=True, last=None, cancelled=None):
+        '''
+        movements - {product_id: (signed count, registered date or None)}, sign=-1 for cancel registration, snapshots=False when caller corrects them,
+        last - result of last_records for newly registered records, cancelled - ids of records with cancelled registration,
+        last record of product is replaced by newer one of "last" without scan of register, scan is needed only when last record is cancelled
+        '''
+        if not movements:
+            return 0
+        output_field = DecimalField(max_digits=15, decimal_places=3)
+        quantity = Case(*[When(product_id=product_id, then=Value(sign * delta, output_field)) for product_id, (delta, last_at) in movements.items()], default=Value(0, output_field), output_field=output_field)
+        with transaction.atomic():
+            if sign > 0:
+                cls.objects.bulk_create([cls(product_id=product_id) for product_id in movements], ignore_conflicts=True)
+            updated = cls.objects.filter(product_id__in=movements.keys()).update(quantity=F('quantity') + quantity)
+            if last:
+                cls.apply_last(last)
+            if cancelled is not None:
+                cls.objects.filter(product_id__in=movements.keys(), last_record_id__in=cancelled).update(**cls.last_values())
+            if snapshots:
+                ProductBalanceSnapshot.apply_movements(movements, sign)
+        return updated
+
+    @staticmethod
+    def last_records(records):
+        '''records - queryset of records before registration, result - {product_id: (record id, cost, price, registered date)} of newest record of each product'''
+        last = {}
+        for product_id, rec_id, cost, price, at in records.order_by('doc__registered_at', 'id').values_list('product_id', 'id', 'cost', 'price', 'doc__registered_at'):
+            last[product_id] = (rec_id, cost, price, at)
+        return last
+
+    @classmethod
+    def apply_last(cls, last):
+        '''last - result of last_records, back-dated record does not touch last record of product'''
+        newer = Q()
+        for product_id, (rec_id, cost, price, at) in last.items():
+            newer |= Q(product_id=product_id) & (Q(last_movement_at__isnull=True) | Q(last_movement_at__lt=at) | Q(last_movement_at=at) & (Q(last_record_id__isnull=True) | Q(last_record_id__lt=rec_id)))
+        values = {}
+        for i, name in enumerate(('last_record_id', 'last_cost', 'last_price', 'last_movement_at')):
+            output_field = models.BigIntegerField() if name == 'last_record_id' else cls._meta.get_field(name)
+            values[name] = Case(*[When(product_id=product_id, then=Value(row[i], output_field)) for product_id, row in last.items()], output_field=output_field)
+        return cls.objects.filter(newer).update(**values)
+
+    @classmethod
+    def dated_movements(cls, records):
+        '''records - queryset of records of several documents, result - {registered date: {product_id: (signed count, registered date)}}'''
+        dated = {}
+        for product_id, at, delta in records.order_by().values('product_id', 'doc__registered_at').annotate(delta=cls.signed_sum()).values_list('product_id', 'doc__registered_at', 'delta'):
+            dated.setdefault(at, {})[product_id] = (delta, at)
+        return dated
+
+    @staticmethod
+    def lock(records):
+        '''lock records against concurrent registration, so balances are changed by really inserted or deleted registers only'''
+        return list(records.order_by('id').select_for_update(of=('self',)).values_list('id', flat=True))
+
+    @classmethod
+    def register(cls, records):
+        '''set-based idempotent registration of records without register, result - (count of new registers, product ids)'''
+        with transaction.atomic():
+            cls.lock(records)
+            pending = records.filter(register__isnull=True)
+            movements = cls.movements(pending)
+            if not movements:
+                return 0, set()
+            dated = cls.dated_movements(pending) if ProductBalanceSnapshot.objects.exists() else {}
+            last = cls.last_records(pending)
+            regs = Register.objects.bulk_create([Register(rec_id=rec_id) for rec_id in pending.values_list('id', flat=True)], batch_size=1000, ignore_conflicts=True)
+            cls.apply_movements(movements, snapshots=False, last=last)
+            ProductBalanceSnapshot.apply_dated(dated)
+        invalidate_products(movements.keys())
+        return len(regs), set(movements)
+
+    @classmethod
+    def unregister(cls, records):
+        '''set-based cancel of registration, delete with bypassed signals, result - (count of deleted registers, product ids)'''
+        with bypass_signals(), transaction.atomic():
+            cls.lock(records)
+            registered = records.filter(register__isnull=False)
+            movements = cls.movements(registered)
+            if not movements:
+                return 0, set()
+            dated = cls.dated_movements(registered) if ProductBalanceSnapshot.objects.exists() else {}
+            count = Register.objects.filter(rec__in=records).delete()[1].get(Register._meta.label, 0)
+            cls.apply_movements(movements, -1, snapshots=False, cancelled=records.values('id'))
+            ProductBalanceSnapshot.apply_dated(dated, -1)
+        invalidate_products(movements.keys())
+        return count, set(movements)
+
+    @classmethod
+    def last_values(cls):
+        '''update expressions of last registered record for each product'''
+        last_register = Register.objects.filter(rec__product_id=OuterRef('product_id')).order_by('-rec__doc__registered_at', '-rec_id')
+        return {
+            'last_record_id': Subquery(last_register.values('rec_id')[:1]),
+            'last_cost': Subquery(last_register.values('rec__cost')[:1]),
+            'last_price': Subquery(last_register.values('rec__price')[:1]),
+            'last_movement_at': Subquery(last_register.values('rec__doc__registered_at')[:1])
+        }
+
+    @classmethod
+    def refresh(cls, product_ids):
+        product_ids = set(product_ids)
+        movements = cls.movements(Record.objects.filter(product_id__in=product_ids, register__isnull=False))
+        with transaction.atomic():
+            cls.objects.filter(product_id__in=product_ids).delete()
+            cls.objects.bulk_create([cls(product_id=product_id, quantity=delta) for product_id, (delta, last_at) in movements.items()])
+            cls.objects.filter(product_id__in=product_ids).update(**cls.last_values())
+            ProductBalanceSnapshot.refresh(product_ids)
+        return len(movements)
+
+    @classmethod
+    def rebuild(cls, batch_size=1000):
+        movements = cls.movements(Record.objects.filter(register__isnull=False))
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create([cls(product_id=product_id, quantity=delta) for product_id, (delta, last_at) in movements.items()], batch_size=batch_size)
+            cls.objects.update(**cls.last_values())
+        return len(movements)
+
+    @staticmethod
+    def reference_fields():
+        return [field for field, behavior in (('cost', settings.BEHAVIOR_COST), ('price', settings.BEHAVIOR_PRICE)) if behavior.get('register_change_referece', False)]
+
+    @classmethod
+    def update_references(cls, product_ids):
+        '''set cost and price of product reference from last registered record, one update by field, result - ids of changed products'''
+        Product = get_model('refs.Product')
+        changed = set()
+        for field in cls.reference_fields():
+            last = f'stock__last_{field}'
+            ids = list(Product.objects.filter(Q(id__in=product_ids, **{f'{last}__isnull':False}) & ~Q(**{last:0}) & ~Q(**{field:F(last)})).values_list('id', flat=True))
+            if ids:
+                Product.objects.filter(id__in=ids).update(**{field:Subquery(cls.objects.filter(product_id=OuterRef('id')).values(f'last_{field}')[:1])})
+                changed.update(ids)
+        if changed:
+            invalidate_products(changed)
+        return changed
+
+    @classmethod
+    def defer_references(cls, product_ids):
+        '''
+        product reference follows last registered record without lock of product row during registration:
+        REFERENCE_UPDATE="commit" - ids are collected until commit of transaction and updated at once,
+        REFERENCE_UPDATE="periodic" - stocks are marked and updated by ./manage.py update_references
+        '''
+        product_ids = set(product_ids)
+        if not product_ids or not cls.reference_fields():
+            return
+        if settings.REFERENCE_UPDATE == 'periodic':
+            cls.objects.filter(product_id__in=product_ids, reference_pending=False).update(reference_pending=True)
+            return
+        pending = getattr(__pending_references__, 'product_ids', None)
+        if pending is None:
+            pending = __pending_references__.product_ids = set()
+        pending.update(product_ids)
+        #callbacks after first one of transaction find empty set, ids of rolled back transaction are only checked again
+        transaction.on_commit(cls.apply_deferred_references)
+
+    @classmethod
+    def apply_deferred_references(cls):
+        product_ids = getattr(__pending_references__, 'product_ids', None)
+        if not product_ids:
+            return set()
+        __pending_references__.product_ids = set()
+        return cls.update_references(product_ids)
+
+    @classmethod
+    def apply_pending_references(cls, batch_size=1000):
+        '''job of REFERENCE_UPDATE="periodic", result - count of changed products'''
+        total = 0
+        while True:
+            with transaction.atomic():
+                product_ids = list(cls.objects.select_for_update().filter(reference_pending=True).order_by('product_id').values_list('product_id', flat=True)[:batch_size])
+                if not product_ids:
+                    return total
+                total += len(cls.update_references(product_ids))
+                cls.objects.filter(product_id__in=product_ids).update(reference_pending=False)
+
+    @classmethod
+    def verify(cls):
+        '''result - list of (product_id, stored quantity, registered quantity) which are not equal'''
+        movements = cls.movements(Record.objects.filter(register__isnull=False))
+        stored = dict(cls.objects.values_list('product_id', 'quantity'))
+        errors = []
+        for product_id in set(movements) | set(stored):
+            registered = movements.get(product_id, (0, None))[0]
+            quantity = stored.get(product_id, 0)
+            if quantity != registered:
+                errors.append((product_id, quantity, registered))
+        return errors
+
+    @classmethod
+    def get_quantity(cls, product_id):
+        quantity = cls.objects.filter(product_id=product_id).values_list('quantity', flat=True).first()
+        return quantity if quantity is not None else 0
+
+    @classmethod
+    async def aget_quantity(cls, product_id):
+        quantity = await cls.objects.filter(product_id=product_id).values_list('quantity', flat=True).afirst()
+        return quantity if quantity is not None else 0
+
+    @classmethod
+    def get_last_values(cls, product_id):
+        '''result - (cost, price) of last registered record or (None, None)'''
+        return cls.objects.filter(product_id=product_id).values_list('last_cost', 'last_price').first() or (None, None)
+
+
+class ProductBalanceSnapshot(CustomAbstractModel):
+    product = models.ForeignKey('refs.Product', null=False, blank=False, on_delete=models.CASCADE, related_name='balance_snapshots', verbose_name=_('product'), help_text=_('refernce of product'))
+    period_end = models.DateTimeField(null=False, blank=False, db_index=True, verbose_name=_('period end'), help_text=_('registered balance includes documents till this date'))
+    quantity = models.DecimalField(max_digits=15, decimal_places=3, default=0, null=False, blank=False, verbose_name=_('quantity'), help_text=_('registered balance of product at the end of period'))
+
+    class Meta:
+        verbose_name = f'🗓️{_("Balance Snapshot")}'
+        verbose_name_plural = f'🗓️{_("Balance Snapshots")}'
+        ordering = ['-period_end', 'product']
+        constraints = [models.UniqueConstraint(fields=['product', 'period_end'], name='unique_product_period_end')]
+
+    def __str__(self):
+        return f'{self.product_id}: {self.quantity} ({self.period_end})'
+
+    @staticmethod
+    def parse_at(value, end_of_day=True):
+        '''value - ISO datetime or date (till end of day or from start of day), result - aware datetime or None'''
+        if not value:
+            return None
+        at = parse_datetime(value)
+        if at is None:
+            day = parse_date(value)
+            if day is None:
+                return None
+            at = datetime.combine(day, datetime.max.time() if end_of_day else datetime.min.time())
+        if django_timezone.is_naive(at):
+            at = django_timezone.make_aware(at)
+        return at
+
+    @classmethod
+    def apply_movements(cls, movements, sign=1):
+        '''movements - {product_id: (signed count, registered date)}, snapshots after registered date are corrected for back-dated documents'''
+        dated = {}
+        for product_id, (delta, at) in movements.items():
+            if at:
+                dated.setdefault(at, {})[product_id] = (delta, at)
+        return cls.apply_dated(dated, sign)
+
+    @classmethod
+    def apply_dated(cls, dated, sign=1):
+        '''dated - result of ProductStock.dated_movements, one select and one update for any count of dates'''
+        if not dated:
+            return 0
+        product_ids = {product_id for movements in dated.values() for product_id in movements}
+        deltas = {}
+        for snapshot_id, product_id, period_end in cls.objects.filter(product_id__in=product_ids, period_end__gte=min(dated)).values_list('id', 'product_id', 'period_end'):
+            delta = sum(movements[product_id][0] for at, movements in dated.items() if product_id in movements and at <= period_end)
+            if delta:
+                deltas[snapshot_id] = sign * delta
+        if not deltas:
+            return 0
+        output_field = DecimalField(max_digits=15, decimal_places=3)
+        quantity = Case(*[When(id=snapshot_id, then=Value(delta, output_field)) for snapshot_id, delta in deltas.items()], default=Value(0, output_field), output_field=output_field)
+        return cls.objects.filter(id__in=deltas.keys()).update(quantity=F('quantity') + quantity)
+
+    @classmethod
+    def refresh(cls, product_ids=None):
+        '''recalculate existing snapshots of products (None - all) from register'''
+        registered = Register.objects.filter(rec__product_id=OuterRef('product_id'), rec__doc__registered_at__lte=OuterRef('period_end')).order_by().values('rec__product_id').annotate(q=ProductStock.signed_sum('rec__')).values('q')
+        snapshots = cls.objects.all() if product_ids is None else cls.objects.filter(product_id__in=product_ids)
+        return snapshots.update(quantity=Coalesce(Subquery(registered), Value(0, DecimalField(max_digits=15, decimal_places=3))))
+
+    @classmethod
+    def balances_at(cls, at, product_ids=None):
+        '''result - {product_id: quantity} as nearest snapshot before "at" plus registered delta after it'''
+        snapshots = cls.objects.filter(period_end__lte=at)
+        registers = Register.objects.filter(rec__doc__registered_at__lte=at)
+        if product_ids is not None:
+            product_ids = set(product_ids)
+            snapshots = snapshots.filter(product_id__in=product_ids)
+            registers = registers.filter(rec__product_id__in=product_ids)
+        balances, periods = {}, {}
+        nearest = snapshots.order_by().values('product_id').annotate(last_period=Max('period_end')).values('last_period')
+        #snapshots are taken for all products at once, so few periods; ascending order leaves nearest snapshot of each product
+        for product_id, period_end, quantity in snapshots.filter(period_end__in=nearest).values_list('product_id', 'period_end', 'quantity').order_by('period_end'):
+            balances[product_id] = quantity
+            periods[product_id] = period_end
+        by_period = {}
+        for product_id, period_end in periods.items():
+            by_period.setdefault(period_end, []).append(product_id)
+        delta_filters = [Q(rec__product_id__in=ids, rec__doc__registered_at__gt=period_end) for period_end, ids in by_period.items()]
+        if product_ids is None:
+            delta_filters.append(~Q(rec__product_id__in=snapshots.values('product_id')))
+        elif product_ids - set(periods):
+            delta_filters.append(Q(rec__product_id__in=product_ids - set(periods)))
+        for q in delta_filters:
+            for product_id, delta in registers.filter(q).order_by().values('rec__product_id').annotate(delta=ProductStock.signed_sum('rec__')).values_list('rec__product_id', 'delta'):
+                balances[product_id] = balances.get(product_id, 0) + delta
+        if product_ids is not None:
+            for product_id in product_ids:
+                balances.setdefault(product_id, Decimal(0))
+        return balances
+
+    @classmethod
+    def get_balance(cls, product_id, at):
+        return cls.balances_at(at, [product_id])[product_id]
+
+    @classmethod
+    def take(cls, period_end=None, batch_size=1000):
+        '''save balances of all products at the end of period, result - count of snapshots'''
+        if period_end is None:
+            period_end = django_timezone.now()
+        balances = cls.balances_at(period_end)
+        with transaction.atomic():
+            cls.objects.bulk_create([cls(product_id=product_id, period_end=period_end, quantity=quantity) for product_id, quantity in balances.items()], batch_size=batch_size, update_conflicts=True, unique_fields=['product', 'period_end'], update_fields=['quantity'])
+        return len(balances)
+
+
+class ReceiptQueue(CustomAbstractModel):
+    PENDING, DONE, ERROR = 0, 1, 2
+    STATUSES = ((PENDING, _('pending')), (DONE, _('done')), (ERROR, _('error')))
+    STATUS_NAMES = {PENDING:'pending', DONE:'done', ERROR:'error'}
+    ticket = models.UUIDField(default=uuid4, unique=True, editable=False, verbose_name=_('ticket'), help_text=_('ticket of accepted receipt'))
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name=_('created date'), help_text=_('Date of creation'))
+    processed_at = models.DateTimeField(default=None, null=True, blank=True, verbose_name=_('processed date'), help_text=_('date of saving document'))
+    author = models.ForeignKey('users.User', null=False, blank=False, on_delete=models.CASCADE, verbose_name=_('author'), help_text=_('author of receipt'))
+    idempotency_key = models.CharField(max_length=128, default=None, null=True, blank=True, unique=True, verbose_name=_('idempotency key'), help_text=_('key of client submission'))
+    payload = JSONField(default=dict, blank=True, verbose_name=_('payload'), help_text=_('receipt as received'))
+    status = models.PositiveSmallIntegerField(choices=STATUSES, default=PENDING, db_index=True, verbose_name=_('status'), help_text=_('status of receipt processing'))
+    doc = models.ForeignKey(Doc, default=None, null=True, blank=True, on_delete=models.SET_NULL, verbose_name=_('document'), help_text=_('saved document'))
+    result = JSONField(default=dict, blank=True, verbose_name=_('result'), help_text=_('result of processing'))
+
+    class Meta:
+        verbose_name = f'📥{_("Receipt Queue")}'
+        verbose_name_plural = f'📥{_("Receipts Queue")}'
+        ordering = ['-id']
+
+    def __str__(self):
+        return f'{self.ticket}'
+
+    @classmethod
+    def enqueue(cls, author, payload, idempotency_key=None):
+        '''durably append receipt, repeated key returns queued receipt, result - (queued receipt, created)'''
+        if idempotency_key:
+            payload['idempotency_key'] = idempotency_key
+            try:
+                with transaction.atomic():
+                    return cls.objects.get_or_create(idempotency_key=idempotency_key, defaults={'author':author, 'payload':payload})
+            except IntegrityError:
+                return cls.objects.get(idempotency_key=idempotency_key), False
+        return cls.objects.create(author=author, payload=payload), True
+
+    @classmethod
+    def claim(cls, batch_size=200):
+        '''lock pending receipts for current transaction, other workers skip them'''
+        queryset = cls.objects.filter(status=cls.PENDING).select_related('author').order_by('id')
+        if connections[queryset.db].features.has_select_for_update_skip_locked:
+            queryset = queryset.select_for_update(skip_locked=True, of=('self',))
+        return list(queryset[:batch_size])
+
+    @classmethod
+    def finish(cls, items):
+        '''save status, document and result of processed receipts by one statement'''
+        now = django_timezone.now()
+        for item in items:
+            item.processed_at = now
+        cls.objects.bulk_update(items, ['status', 'doc', 'result', 'processed_at'], batch_size=1000)
@@ -0,0 +1,99 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import transaction
+from django.db.models import Case, When, F, Value, DecimalField
+from django.apps import apps as django_apps
+
+'''
+posting of document records by set-based statements in one transaction,
+signals of records and registers are bypassed while posting runs
+'''
+
+__bypass_signals__ = ContextVar('core_posting_bypass_signals', default=False)
+
+
+def get_model(app_model):
+    app_name, model_name = app_model.split('.')
+    return django_apps.get_app_config(app_name).get_model(model_name)
+
+def signals_bypassed():
+    '''receivers of Record and Register return immediately while posting'''
+    return __bypass_signals__.get()
+
+@contextmanager
+def bypass_signals():
+    token = __bypass_signals__.set(True)
+    try:
+        yield
+    finally:
+        __bypass_signals__.reset(token)
+
+
+class Posting():
+    '''
+    docs_records - [(doc, records)], new documents and records (pk is None) are inserted, changed records are updated,
+    update_sum_final=False keeps final sums of documents (for example receipt of POS with discount)
+    '''
+    RECORD_FIELDS = ['count', 'cost', 'price', 'doc', 'currency', 'product', 'extinfo']
+
+    def __init__(self, update_sum_final=True, batch_size=1000):
+        self.update_sum_final = update_sum_final
+        self.batch_size = batch_size
+
+    def save_records(self, docs_records, delete=()):
+        '''result - (ids of inserted records, ids of changed records)'''
+        Doc, Record, ProductStock = get_model('core.Doc'), get_model('core.Record'), get_model('core.ProductStock')
+        new_docs = [doc for doc, recs in docs_records if doc.pk is None]
+        if new_docs:
+            Doc.objects.bulk_create(new_docs, batch_size=self.batch_size)
+        new_recs, changed_recs = [], []
+        for doc, recs in docs_records:
+            for rec in recs:
+                rec.doc = doc
+                (changed_recs if rec.pk else new_recs).append(rec)
+        delete_ids = [rec.pk if isinstance(rec, Record) else rec for rec in delete]
+        changed_ids = [rec.pk for rec in changed_recs]
+        if changed_ids or delete_ids:
+            ProductStock.unregister(Record.objects.filter(id__in=changed_ids + delete_ids))
+        if delete_ids:
+            Record.objects.filter(id__in=delete_ids).delete()
+        if changed_recs:
+            Record.objects.bulk_update(changed_recs, self.RECORD_FIELDS, batch_size=self.batch_size)
+        if new_recs:
+            Record.objects.bulk_create(new_recs, batch_size=self.batch_size)
+        return [rec.pk for rec in new_recs], changed_ids
+
+    def recalculate_sum_final(self, doc_ids, new_ids):
+        '''as receivers of records: empty final sum is calculated from records, sums of inserted records are added to others'''
+        Doc, Record = get_model('core.Doc'), get_model('core.Record')
+        added = {}
+        if new_ids:
+            added = dict(Record.objects.filter(id__in=new_ids).exclude(doc__sum_final=0).order_by().values('doc_id').annotate(total=Doc.sum_final_expression()).values_list('doc_id', 'total'))
+            added = {doc_id: total for doc_id, total in added.items() if total}
+        Doc.recalculate_sum_final(Doc.objects.filter(id__in=doc_ids, sum_final=0))
+        if added:
+            output_field = DecimalField(max_digits=15, decimal_places=3)
+            Doc.objects.filter(id__in=added.keys()).update(sum_final=F('sum_final') + Case(*[When(id=doc_id, then=Value(total, output_field)) for doc_id, total in added.items()], default=Value(0, output_field), output_field=output_field))
+
+    def post(self, docs_records, delete=()):
+        '''result - {'records': count of inserted, 'changed': count of updated, 'registered': count of new registers, 'products': product ids}'''
+        Doc, Record, ProductStock = get_model('core.Doc'), get_model('core.Record'), get_model('core.ProductStock')
+        with bypass_signals(), transaction.atomic():
+            new_ids, changed_ids = self.save_records(docs_records, delete)
+            doc_ids = [doc.pk for doc, recs in docs_records]
+            if self.update_sum_final:
+                self.recalculate_sum_final(doc_ids, new_ids)
+            auto_ids = list(Doc.objects.filter(id__in=doc_ids, type__auto_register=True).values_list('id', flat=True))
+            count_regs, product_ids = ProductStock.register(Record.objects.filter(doc_id__in=auto_ids)) if auto_ids else (0, set())
+            if auto_ids:
+                ProductStock.defer_references(ProductStock.objects.filter(last_record__doc_id__in=auto_ids).values_list('product_id', flat=True))
+        return {'records':len(new_ids), 'changed':len(changed_ids), 'registered':count_regs, 'products':product_ids}
+
+
+def post_doc(doc, records=(), delete=(), update_sum_final=True):
+    '''post one document with records, see Posting'''
+    return Posting(update_sum_final).post([(doc, list(records))], delete)
+
+def post_docs(docs_records, update_sum_final=True):
+    return Posting(update_sum_final).post(docs_records)
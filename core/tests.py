@@ -0,0 +1,638 @@
+import os, tempfile
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.core.management import call_command
+from django.core.paginator import EmptyPage, Paginator
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
+from django.apps import apps as django_apps
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+
+from .admin import EstimatedCountPaginator
+from .invalidation import FileInvalidationBus, LocalInvalidationBus, LRUCache, get_invalidation_bus
+from .posting import post_doc
+
+
+def get_model(app_model):
+    app_name, model_name = app_model.split('.')
+    return django_apps.get_app_config(app_name).get_model(model_name)
+
+
+class Invalidation(TransactionTestCase):
+    'Cross-process invalidation of admin product cache'
+    reset_sequences = True
+
+    def test_lru_bounded(self):
+        cache = LRUCache(3)
+        for i in range(3):
+            cache[i] = {'count':i}
+        cache.get(0)
+        cache[3] = {}
+        self.assertEqual(len(cache), 3)
+        self.assertIn(0, cache)
+        self.assertNotIn(1, cache)
+        cache.invalidate([0, 2])
+        self.assertEqual([k for k in (0, 1, 2, 3) if k in cache], [3])
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+
+    def test_file_bus_between_processes(self):
+        path = os.path.join(tempfile.mkdtemp(), 'test.bus')
+        worker1, worker2 = FileInvalidationBus(path=path), FileInvalidationBus(path=path)
+        cache1, cache2 = LRUCache(), LRUCache()
+        worker1.subscribe('product', cache1.invalidate)
+        worker2.subscribe('product', cache2.invalidate)
+        worker2.poll()
+        for cache in (cache1, cache2):
+            for i in range(1, 5):
+                cache[i] = {'count':i}
+        worker1.publish('product', [1, 2])
+        self.assertEqual([k for k in range(1, 5) if k in cache1], [3, 4])
+        self.assertEqual([k for k in range(1, 5) if k in cache2], [1, 2, 3, 4])
+        worker2.poll()
+        self.assertEqual([k for k in range(1, 5) if k in cache2], [3, 4])
+        worker1.publish('product')
+        worker2.poll()
+        self.assertEqual(len(cache2), 0)
+
+    def test_encode_chunks(self):
+        bus = LocalInvalidationBus()
+        messages = bus.encode('product', range(3000), 1000)
+        self.assertTrue(all(len(m) <= 1000 for m in messages))
+        received = []
+        bus.subscribe('product', received.extend)
+        for m in messages:
+            bus.receive(m)
+        self.assertEqual(received, list(range(3000)))
+
+    def test_publish_on_commit(self):
+        bus, cache = LocalInvalidationBus(), LRUCache()
+        bus.subscribe('product', cache.invalidate)
+        cache[1], cache[2] = {'count':1}, {'count':2}
+        with transaction.atomic():
+            bus.publish('product', [1])
+            self.assertIn(1, cache)
+        self.assertNotIn(1, cache)
+        try:
+            with transaction.atomic():
+                bus.publish('product', [2])
+                raise IntegrityError
+        except IntegrityError:
+            pass
+        self.assertIn(2, cache)
+
+    def test_register_resets_product_admin(self):
+        get_user_model().objects.create_superuser('admin', 'admin@localhost', 'admin')
+        get_model('refs.Currency')().save()
+        get_model('refs.Unit')(label='pcs', name='pieces').save()
+        get_model('refs.Tax')(name='NO').save()
+        company = get_model('refs.Company')(name='Own')
+        company.save()
+        get_model('refs.Company')(name='Other').save()
+        doc_type = get_model('refs.DocType')(alias='receipt', name='Receipt', income=True, auto_register=False)
+        doc_type.save()
+        product = get_model('refs.Product')(name='P1')
+        product.save()
+        doc = get_model('core.Doc')(type=doc_type, contractor=company, owner=company)
+        doc.save()
+        rec = get_model('core.Record')(doc=doc, product=product, count=5)
+        rec.save()
+        product_admin = admin.site.get_model_admin(get_model('refs.Product'))
+        self.assertIsInstance(get_invalidation_bus(), LocalInvalidationBus)
+        self.assertEqual(product_admin.get_count_from_reg(product), 0)
+        self.assertIn(product.id, product_admin.__objs__)
+        get_model('core.Register')(rec=rec).save()
+        self.assertNotIn(product.id, product_admin.__objs__)
+        self.assertEqual(product_admin.get_count_from_reg(product), 5)
+
+
+class ProductFixture():
+    'Companies, document type, product, documents and admin actions shared by test cases'
+    reset_sequences = True
+
+    def setUp(self):
+        get_user_model().objects.create_superuser('admin', 'admin@localhost', 'admin')
+        get_model('refs.Currency')().save()
+        get_model('refs.Unit')(label='pcs', name='pieces').save()
+        get_model('refs.Tax')(name='NO').save()
+        get_model('refs.Company')(name='Own').save()
+        get_model('refs.Company')(name='Other').save()
+        self.doc_type = get_model('refs.DocType')(alias='receipt', name='Receipt', income=True, auto_register=False)
+        self.doc_type.save()
+        self.product = get_model('refs.Product')(name='P1')
+        self.product.save()
+
+    def add_record(self, registered_at, cost, price):
+        doc = get_model('core.Doc')(type=self.doc_type, registered_at=registered_at)
+        doc.save()
+        rec = get_model('core.Record')(doc=doc, product=self.product, count=1, cost=cost, price=price)
+        rec.save()
+        return rec
+
+    def get_last(self):
+        return get_model('core.ProductStock').objects.filter(product=self.product).values_list('last_record_id', 'last_cost', 'last_price').first()
+
+    def add_docs(self, count_docs, count_recs):
+        get_model('refs.DocType').objects.filter(id=self.doc_type.id).update(auto_register=False)
+        now = timezone.now()
+        for d in range(count_docs):
+            doc = get_model('core.Doc').objects.create(type_id=self.doc_type.id, registered_at=now - timedelta(days=d + 1))
+            get_model('core.Record').objects.bulk_create([get_model('core.Record')(doc=doc, product=self.product, count=r + 1) for r in range(count_recs)])
+        get_model('refs.DocType').objects.filter(id=self.doc_type.id).update(auto_register=True)
+
+    def add_rows(self, count):
+        Doc, Record, Register = get_model('core.Doc'), get_model('core.Record'), get_model('core.Register')
+        docs = Doc.objects.bulk_create([Doc(type=self.doc_type, registered_at=timezone.now() - timedelta(minutes=d)) for d in range(count - Record.objects.count())])
+        recs = Record.objects.bulk_create([Record(doc=doc, product=self.product, count=1, cost=1, price=2) for doc in docs])
+        Register.objects.bulk_create([Register(rec=rec) for rec in recs])
+
+    def action(self, name):
+        docs = list(get_model('core.Doc').objects.values_list('id', flat=True))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/admin/core/doc/', {'action':name, '_selected_action':docs})
+        self.assertEqual(response.status_code, 302)
+        return len(queries)
+
+
+class LastRecord(ProductFixture, TransactionTestCase):
+    'Last registered record of product'
+
+    def test_back_dated(self):
+        Register = get_model('core.Register')
+        now = timezone.now()
+        rec_old = self.add_record(now - timedelta(days=2), 10, 15)
+        rec_new = self.add_record(now - timedelta(days=1), 20, 25)
+        rec_future = self.add_record(now, 30, 35)
+        reg_new = Register(rec=rec_new)
+        reg_new.save()
+        self.assertEqual(self.get_last(), (rec_new.id, 20, 25))
+        Register(rec=rec_old).save()
+        self.assertEqual(self.get_last(), (rec_new.id, 20, 25))
+        reg_new.delete()
+        self.assertEqual(self.get_last(), (rec_old.id, 10, 15))
+        rec_old.price = 16
+        rec_old.save()
+        self.assertEqual(self.get_last(), (rec_old.id, 10, 16))
+        Register(rec=rec_future).save()
+        self.assertEqual(self.get_last(), (rec_future.id, 30, 35))
+        rec_future.doc.registered_at = now - timedelta(days=3)
+        rec_future.doc.extinfo['not_use_post_save_auto_register'] = True
+        rec_future.doc.save()
+        self.assertEqual(self.get_last(), (rec_old.id, 10, 16))
+        get_model('core.ProductStock').rebuild()
+        self.assertEqual(self.get_last(), (rec_old.id, 10, 16))
+
+    def test_forward_without_scan(self):
+        Record, ProductStock = get_model('core.Record'), get_model('core.ProductStock')
+        now = timezone.now()
+        rec_old = self.add_record(now - timedelta(days=1), 10, 15)
+        rec_new = self.add_record(now, 20, 25)
+        rec_same = self.add_record(now, 30, 35)
+        for records, last in ((Record.objects.filter(id__in=[rec_old.id, rec_new.id]), rec_new), (Record.objects.filter(id=rec_same.id), rec_same)):
+            with CaptureQueriesContext(connection) as queries:
+                ProductStock.register(records)
+            self.assertEqual(self.get_last(), (last.id, last.cost, last.price))
+            self.assertFalse([q['sql'] for q in queries.captured_queries if 'FROM "core_register"' in q['sql']])
+        ProductStock.unregister(Record.objects.filter(id=rec_old.id))
+        self.assertEqual(self.get_last(), (rec_same.id, 30, 35))
+        ProductStock.unregister(Record.objects.filter(id=rec_same.id))
+        self.assertEqual(self.get_last(), (rec_new.id, 20, 25))
+
+
+class BalanceSnapshot(ProductFixture, TransactionTestCase):
+    'Balance of product at date from snapshots'
+
+    def test_balance_at(self):
+        Register, Snapshot = get_model('core.Register'), get_model('core.ProductBalanceSnapshot')
+        now = timezone.now()
+        days = [now - timedelta(days=d) for d in (5, 4, 3, 2, 1)]
+        recs = [self.add_record(at, 1, 1) for at in days]
+        for rec, count in zip(recs, (10, 20, 30, 40, 50)):
+            rec.count = count
+            rec.save()
+        for rec in (recs[0], recs[2], recs[4]):
+            Register(rec=rec).save()
+        self.assertEqual(Snapshot.take(days[2]), 1)
+        self.assertEqual(Snapshot.objects.get().quantity, 40)
+        self.assertEqual(Snapshot.get_balance(self.product.id, days[3]), 40)
+        self.assertEqual(Snapshot.get_balance(self.product.id, now), 90)
+        self.assertEqual(Snapshot.get_balance(self.product.id, days[0] - timedelta(days=1)), 0)
+        #back-dated registration and cancel before snapshot
+        reg = Register(rec=recs[1])
+        reg.save()
+        self.assertEqual(Snapshot.objects.get().quantity, 60)
+        self.assertEqual(Snapshot.balances_at(now), {self.product.id: 110})
+        Register.objects.filter(rec=recs[0]).delete()
+        self.assertEqual(Snapshot.objects.get().quantity, 50)
+        recs[1].count = 25
+        recs[1].save()
+        self.assertEqual(Snapshot.objects.get().quantity, 55)
+        Register(rec=recs[3]).save()
+        self.assertEqual(Snapshot.get_balance(self.product.id, days[3]), 95)
+        recs[3].doc.registered_at = days[0]
+        recs[3].doc.extinfo['not_use_post_save_auto_register'] = True
+        recs[3].doc.save()
+        self.assertEqual(Snapshot.objects.get().quantity, 95)
+        self.assertEqual(Snapshot.refresh(), 1)
+        self.assertEqual(Snapshot.objects.get().quantity, 95)
+        self.assertEqual(Snapshot.get_balance(self.product.id, now), 145)
+
+    def test_api(self):
+        user = get_user_model().objects.get(username='admin')
+        user.role = get_model('users.Role').objects.create(value='test')
+        user.save()
+        self.client.force_login(user)
+        self.add_record(timezone.now() - timedelta(days=2), 1, 1)
+        get_model('core.Register')(rec=get_model('core.Record').objects.get()).save()
+        get_model('core.ProductBalanceSnapshot').take()
+        at = (timezone.now() - timedelta(days=3)).date().isoformat()
+        response = self.client.get(f'/api/product/{self.product.id}/balance', {'at':at})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(float(response.json()['balance']), 0)
+        response = self.client.get(f'/api/product/{self.product.id}/balance')
+        self.assertEqual(float(response.json()['balance']), 1)
+        response = self.client.get('/api/products/balance/', {'ids':f'{self.product.id}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(p['id'], float(p['balance'])) for p in response.json()['products']], [(self.product.id, 1)])
+
+
+class DocRegistration(ProductFixture, TransactionTestCase):
+    'Set-based registration actions of documents'
+
+    def test_actions(self):
+        Stock, Snapshot = get_model('core.ProductStock'), get_model('core.ProductBalanceSnapshot')
+        self.client.force_login(get_user_model().objects.get(username='admin'))
+        self.add_docs(2, 3)
+        Snapshot(product=self.product, period_end=timezone.now() - timedelta(days=1, hours=12), quantity=0).save()
+        queries_register = self.action('registration')
+        self.assertEqual(get_model('core.Register').objects.count(), 6)
+        self.assertEqual(Stock.get_quantity(self.product.id), 12)
+        self.assertEqual(Snapshot.objects.get().quantity, 6)
+        queries_unregister = self.action('unregistration')
+        self.assertEqual(get_model('core.Register').objects.count(), 0)
+        self.assertEqual(Stock.get_quantity(self.product.id), 0)
+        self.assertEqual(Snapshot.objects.get().quantity, 0)
+        self.add_docs(4, 10)
+        self.assertEqual(self.action('registration'), queries_register)
+        self.assertEqual(Stock.get_quantity(self.product.id), 232)
+        self.assertEqual(Stock.verify(), [])
+        self.assertEqual(Snapshot.objects.get().quantity, 171)
+        self.assertEqual(self.action('unregistration'), queries_unregister)
+        self.assertEqual(Stock.get_quantity(self.product.id), 0)
+        self.assertEqual(Stock.objects.get().last_record_id, None)
+
+    def test_idempotent(self):
+        Stock = get_model('core.ProductStock')
+        self.add_docs(2, 3)
+        records = get_model('core.Record').objects.all()
+        self.assertEqual(Stock.register(records)[0], 6)
+        self.assertEqual(Stock.register(records), (0, set()))
+        self.assertEqual(Stock.get_quantity(self.product.id), 12)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            get_model('core.Register').objects.create(rec=records.first())
+        get_model('core.Register').objects.bulk_create([get_model('core.Register')(rec=rec) for rec in records], ignore_conflicts=True)
+        self.assertEqual(get_model('core.Register').objects.count(), 6)
+
+
+class SumFinal(ProductFixture, TransactionTestCase):
+    'Set-based recalculation of final sum of documents'
+
+    def test_recalculate(self):
+        Doc = get_model('core.Doc')
+        sale = get_model('refs.DocType').objects.create(alias='sale', name='Sale', income=False, auto_register=False)
+        now = timezone.now()
+        for d in range(6):
+            doc = Doc.objects.create(type=self.doc_type if d % 2 else sale, registered_at=now - timedelta(days=d * 20))
+            get_model('core.Record').objects.bulk_create([get_model('core.Record')(doc=doc, product=self.product, count=r + 1, cost=10, price=15) for r in range(3)])
+        Doc.objects.create(type=sale, sum_final=7)
+        Doc.objects.update(sum_final=1)
+        self.assertEqual(Doc.recalculate_sum_final(Doc.objects.filter(type=sale)), 3)
+        self.assertEqual(Doc.recalculate_sum_final(Doc.objects.filter(type=sale)), 0)
+        out = StringIO()
+        call_command('recalculate_final_sum', '--days', '30', stdout=out)
+        self.assertIn('UPDATED 3 DOCUMENTS', out.getvalue())
+        self.assertEqual(sorted(Doc.objects.order_by().values_list('type__income', 'sum_final').distinct()), [(False, 1), (False, 90), (True, 60)])
+
+
+class Posting(ProductFixture, TransactionTestCase):
+    'Set-based posting of document records without signals'
+
+    def post(self, count, price=20):
+        doc = get_model('core.Doc')(type=self.doc_type, registered_at=timezone.now())
+        records = [get_model('core.Record')(product=self.product, count=1, cost=10, price=price) for r in range(count)]
+        return doc, records, post_doc(doc, records)
+
+    def test_post(self):
+        get_model('refs.DocType').objects.filter(id=self.doc_type.id).update(auto_register=True)
+        self.doc_type.refresh_from_db()
+        get_model('refs.Product').objects.filter(id=self.product.id).update(cost=10)
+        ProductStock = get_model('core.ProductStock')
+        with CaptureQueriesContext(connection) as queries:
+            self.post(2)
+        with self.assertNumQueries(len(queries)):
+            doc, records, result = self.post(50, 21)
+        self.assertEqual(result['records'], 50)
+        self.assertEqual(result['registered'], 50)
+        doc.refresh_from_db()
+        self.assertEqual(doc.sum_final, 500)
+        self.assertEqual(ProductStock.get_quantity(self.product.id), 52)
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.cost, self.product.price), (10, 21))
+        records[0].count = 5
+        records[1].price = 30
+        result = post_doc(doc, records[:2], delete=records[2:4], update_sum_final=False)
+        self.assertEqual((result['records'], result['changed'], result['registered']), (0, 2, 2))
+        self.assertEqual(ProductStock.get_quantity(self.product.id), 54)
+        self.assertEqual(get_model('core.Register').objects.filter(rec__doc=doc).count(), 48)
+        self.assertEqual(get_model('core.Record').objects.filter(doc=doc).count(), 48)
+        post_doc(doc, [get_model('core.Record')(product=self.product, count=2, cost=10, price=21)])
+        doc.refresh_from_db()
+        self.assertEqual(doc.sum_final, 520)
+        self.assertEqual(ProductStock.verify(), [])
+
+    def test_command(self):
+        for d in range(3):
+            self.add_record(timezone.now() - timedelta(days=d), 10, 15)
+        self.assertEqual(get_model('core.Register').objects.count(), 0)
+        get_model('refs.DocType').objects.filter(id=self.doc_type.id).update(auto_register=True)
+        out = StringIO()
+        call_command('post_docs', '--batch-size', '2', stdout=out)
+        self.assertIn('POSTED 3 DOCUMENTS; REGISTERED 3 RECORDS', out.getvalue())
+        self.assertEqual(get_model('core.ProductStock').get_quantity(self.product.id), 3)
+
+
+class DocAdminFormset(ProductFixture, TransactionTestCase):
+    'Inline records of document admin are saved by posting'
+
+    def post_form(self, path, doc_id, rows, deleted=()):
+        now = timezone.localtime()
+        data = {'registered_at_0':now.date().isoformat(), 'registered_at_1':now.time().strftime('%H:%M:%S'), 'sum_final':'0', 'owner':'1', 'contractor':'2', 'type':f'{self.doc_type.id}', 'tax':'1', 'extinfo':'{}'}
+        initial = [rec_id for rec_id, count in rows if rec_id]
+        data.update({'record_set-TOTAL_FORMS':f'{len(rows)}', 'record_set-INITIAL_FORMS':f'{len(initial)}', 'record_set-MIN_NUM_FORMS':'0', 'record_set-MAX_NUM_FORMS':'1000'})
+        for i, (rec_id, count) in enumerate(rows):
+            data.update({f'record_set-{i}-id':f'{rec_id or ""}', f'record_set-{i}-doc':f'{doc_id or ""}', f'record_set-{i}-product':f'{self.product.id}', f'record_set-{i}-count':f'{count}', f'record_set-{i}-cost':'8', f'record_set-{i}-price':'10'})
+            if rec_id in deleted:
+                data[f'record_set-{i}-DELETE'] = 'on'
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(path, data)
+        self.assertEqual(response.status_code, 302, getattr(response, 'context_data', {}).get('errors'))
+        return [q['sql'] for q in queries]
+
+    def count(self, sqls, statement, table):
+        return len([sql for sql in sqls if sql.startswith(statement) and f'"{table}"' in sql.split('(')[0]])
+
+    def test_save(self):
+        Doc, Record, Stock = get_model('core.Doc'), get_model('core.Record'), get_model('core.ProductStock')
+        get_model('refs.DocType').objects.filter(id=self.doc_type.id).update(auto_register=True)
+        self.client.force_login(get_user_model().objects.get(username='admin'))
+        sqls = self.post_form('/admin/core/doc/add/', None, [(None, 1)] * 30)
+        self.assertEqual(self.count(sqls, 'INSERT', 'core_record'), 1)
+        self.assertEqual(self.count(sqls, 'INSERT', 'core_register'), 1)
+        doc = Doc.objects.get()
+        self.assertEqual(doc.sum_final, 240)
+        self.assertEqual(Stock.get_quantity(self.product.id), 30)
+        ids = list(Record.objects.filter(doc=doc).order_by('id').values_list('id', flat=True))
+        rows = [(rec_id, 2) for rec_id in ids] + [(None, 5)] * 10
+        sqls = self.post_form(f'/admin/core/doc/{doc.id}/change/', doc.id, rows, deleted=ids[:5])
+        self.assertEqual(self.count(sqls, 'INSERT', 'core_record'), 1)
+        self.assertEqual(self.count(sqls, 'UPDATE', 'core_record'), 1)
+        self.assertEqual(Record.objects.filter(doc=doc).count(), 35)
+        self.assertEqual(Doc.objects.get().sum_final, 800)
+        self.assertEqual(Stock.get_quantity(self.product.id), 25 * 2 + 10 * 5)
+        self.assertEqual(Stock.verify(), [])
+
+
+class References(ProductFixture, TransactionTestCase):
+    'Deferred update of product reference cost and price'
+
+    def auto_register(self):
+        get_model('refs.DocType').objects.filter(id=self.doc_type.id).update(auto_register=True)
+        self.doc_type.refresh_from_db()
+
+    def test_commit(self):
+        self.auto_register()
+        now = timezone.now()
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                for d, (cost, price) in enumerate(((10, 15), (11, 16), (12, 17))):
+                    self.add_record(now - timedelta(days=3 - d), cost, price)
+                self.product.refresh_from_db()
+                self.assertEqual((self.product.cost, self.product.price), (0, 0))
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('UPDATE "refs_product"')]), 2)
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.cost, self.product.price), (12, 17))
+        #back-dated registration keeps reference
+        self.add_record(now - timedelta(days=5), 7, 8)
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.cost, self.product.price), (12, 17))
+
+    def test_periodic(self):
+        self.auto_register()
+        with override_settings(REFERENCE_UPDATE='periodic'):
+            self.add_record(timezone.now(), 10, 15)
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.cost, self.product.price), (0, 0))
+        self.assertTrue(get_model('core.ProductStock').objects.get().reference_pending)
+        out = StringIO()
+        call_command('update_references', stdout=out)
+        self.assertIn('UPDATED 1 PRODUCTS', out.getvalue())
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.cost, self.product.price), (10, 15))
+        self.assertFalse(get_model('core.ProductStock').objects.get().reference_pending)
+
+
+class DocMerge(ProductFixture, TransactionTestCase):
+    'Grouped merge of documents records'
+
+    def merge(self, count_docs, count_recs):
+        Doc, Record = get_model('core.Doc'), get_model('core.Record')
+        Doc.objects.all().delete()
+        other, created = get_model('refs.Product').objects.get_or_create(name='P2')
+        self.add_docs(count_docs, count_recs)
+        doc_main = Doc.objects.first()
+        Record.objects.create(doc=Doc.objects.last(), product=other, count=3)
+        get_model('core.ProductStock').register(Record.objects.filter(doc=doc_main))
+        queries = self.action('merge_items')
+        return doc_main, queries
+
+    def test_merge(self):
+        Doc, Record, Stock = get_model('core.Doc'), get_model('core.Record'), get_model('core.ProductStock')
+        self.client.force_login(get_user_model().objects.get(username='admin'))
+        doc_main, queries = self.merge(2, 3)
+        self.assertEqual(list(Doc.objects.values_list('id', flat=True)), [doc_main.id])
+        self.assertEqual(sorted(Record.objects.values_list('product__name', 'count')), [('P1', 1), ('P1', 2), ('P1', 3), ('P1', 6), ('P2', 3)])
+        self.assertEqual(Stock.get_quantity(self.product.id), 6)
+        self.assertEqual(Stock.verify(), [])
+        doc_main, queries_more = self.merge(5, 20)
+        self.assertEqual(queries_more, queries)
+        self.assertEqual(Record.objects.count(), 22)
+        self.assertEqual(Stock.get_quantity(self.product.id), 210)
+
+    def test_registered_extra(self):
+        Doc, Record, Stock = get_model('core.Doc'), get_model('core.Record'), get_model('core.ProductStock')
+        self.client.force_login(get_user_model().objects.get(username='admin'))
+        self.add_docs(3, 3)
+        doc_main = Doc.objects.first()
+        Stock.register(Record.objects.exclude(doc=doc_main))
+        self.action('merge_items')
+        self.assertEqual(sorted(Record.objects.filter(register__isnull=False).values_list('count', flat=True)), [12])
+        self.assertEqual(Record.objects.filter(register__isnull=True).count(), 3)
+        self.assertEqual(Stock.get_quantity(self.product.id), 12)
+        self.assertEqual(Stock.verify(), [])
+
+    def test_partially_registered_main(self):
+        Doc, Record, Stock = get_model('core.Doc'), get_model('core.Record'), get_model('core.ProductStock')
+        self.client.force_login(get_user_model().objects.get(username='admin'))
+        self.add_docs(2, 3)
+        doc_main = Doc.objects.first()
+        first = Record.objects.filter(doc=doc_main).order_by('id').first()
+        Stock.register(Record.objects.filter(Q(id=first.id) | ~Q(doc=doc_main)))
+        self.action('merge_items')
+        self.assertEqual(list(Record.objects.filter(register__isnull=False).values_list('id', 'count')), [(first.id, 7)])
+        self.assertEqual(sorted(Record.objects.filter(register__isnull=True).values_list('count', flat=True)), [2, 3])
+        self.assertEqual(Stock.get_quantity(self.product.id), 7)
+        self.assertEqual(Stock.verify(), [])
+
+
+class IncomingFromOrders(ProductFixture, TransactionTestCase):
+    'Receipt from orders aggregated by database'
+
+    def incoming(self, count_docs, count_recs):
+        Doc, Record = get_model('core.Doc'), get_model('core.Record')
+        Doc.objects.all().delete()
+        order, created = get_model('refs.DocType').objects.get_or_create(alias='order', defaults={'name':'Order', 'income':True, 'auto_register':False})
+        other, created = get_model('refs.Product').objects.get_or_create(name='P2', defaults={'cost':4, 'price':5})
+        for d in range(count_docs):
+            doc = Doc.objects.create(type=order, registered_at=timezone.now())
+            Record.objects.bulk_create([Record(doc=doc, product=self.product if r % 2 else other, count=1) for r in range(count_recs)])
+        return self.action('new_incoming_from_orders')
+
+    def test_incoming(self):
+        Doc, Record, Stock = get_model('core.Doc'), get_model('core.Record'), get_model('core.ProductStock')
+        self.client.force_login(get_user_model().objects.get(username='admin'))
+        get_model('refs.Product').objects.filter(id=self.product.id).update(cost=10, price=12)
+        queries = self.incoming(2, 3)
+        doc = Doc.objects.get(type=self.doc_type)
+        self.assertEqual(sorted(Record.objects.filter(doc=doc).values_list('product__name', 'count', 'cost', 'price')), [('P1', 2, 10, 12), ('P2', 4, 4, 5)])
+        self.assertEqual(doc.sum_final, 36)
+        self.assertEqual(Stock.get_quantity(self.product.id), 2)
+        self.assertEqual(self.incoming(6, 20), queries)
+        doc = Doc.objects.get(type=self.doc_type)
+        self.assertEqual(doc.sum_final, 60 * 10 + 60 * 4)
+        self.assertEqual(Stock.verify(), [])
+
+
+class DocChangelist(ProductFixture, TransactionTestCase):
+    'Queries of document changelist do not depend on count of rows'
+
+    def changelist(self, count_docs):
+        get_model('core.Doc').objects.all().delete()
+        self.add_docs(count_docs, 3)
+        get_model('core.Record').objects.update(price=2)
+        get_model('core.ProductStock').register(get_model('core.Record').objects.all())
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/admin/core/doc/')
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_changelist(self):
+        self.client.force_login(get_user_model().objects.get(username='admin'))
+        response, queries = self.changelist(5)
+        self.assertContains(response, '<details><summary>P1</summary>', count=5)
+        self.assertContains(response, '>12.00</font>', count=5)
+        response, queries_more = self.changelist(50)
+        self.assertEqual(queries_more, queries)
+        cl = response.context['cl']
+        self.assertFalse(cl.model_admin.get_queryset(response.wsgi_request).query.annotations)
+        get_model('core.Record').objects.filter(id=get_model('core.Record').objects.order_by('id').values('id')[:1]).update(price=5)
+        response = self.client.get('/admin/core/doc/', {'o':f"-{cl.list_display.index('get_sum_price')}"})
+        sums = [doc.records_sum_price for doc in response.context['cl'].result_list]
+        self.assertEqual((sums[0], sums[1:]), (15, [12] * 49))
+
+    def test_list_editable(self):
+        Doc = get_model('core.Doc')
+        self.client.force_login(get_user_model().objects.get(username='admin'))
+        sale = get_model('refs.DocType').objects.create(alias='sale', name='Sale', income=False)
+        self.add_docs(1, 1)
+        doc = Doc.objects.get()
+        response = self.client.post('/admin/core/doc/', {'form-TOTAL_FORMS':'1', 'form-INITIAL_FORMS':'1', 'form-0-id':f'{doc.id}', 'form-0-type':f'{sale.id}', '_save':'Save'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Doc.objects.get().type_id, sale.id)
+
+
+class ChangelistQueries(ProductFixture, TransactionTestCase):
+    'Fixed count of queries of changelist pages with 10, 100 and 500 rows'
+
+    def budget(self, path):
+        get_model('core.Doc').objects.all().delete()
+        counts = []
+        for count in (10, 100, 500):
+            self.add_rows(count)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(path)
+            self.assertEqual(response.status_code, 200)
+            counts.append(len(queries))
+        self.assertEqual(counts, counts[:1] * 3, path)
+
+    def test_budget(self):
+        self.client.force_login(get_user_model().objects.get(username='admin'))
+        for path in ('/admin/core/record/', '/admin/core/register/', '/admin/core/doc/'):
+            self.budget(path)
+
+
+class KeysetPagination(ProductFixture, TransactionTestCase):
+    'Pages of keyset paginator equal pages of OFFSET, pages after capped count stay reachable'
+
+    def test_pages(self):
+        get_model('core.Doc').objects.all().delete()
+        self.add_rows(45)
+        Doc, Record = get_model('core.Doc'), get_model('core.Record')
+        Doc.objects.filter(id__in=Doc.objects.order_by('id').values('id')[:10]).update(registered_at=timezone.now())
+        for queryset, keyset in ((Record.objects.order_by('-id'), ('id',)), (Doc.objects.order_by('-registered_at', '-pk'), ('registered_at', 'id')), (Doc.objects.order_by('registered_at', 'id'), ('registered_at', 'id'))):
+            offset, after = Paginator(queryset, 10), None
+            for number in offset.page_range:
+                keyed = EstimatedCountPaginator(queryset, 10, keyset=keyset, after=after)
+                self.assertEqual(keyed.count, 45)
+                with CaptureQueriesContext(connection) as queries:
+                    rows = list(keyed.page(number).object_list)
+                self.assertEqual(rows, list(offset.page(number).object_list), (keyset, number))
+                self.assertFalse([q['sql'] for q in queries.captured_queries if 'OFFSET' in q['sql'].upper()])
+                after = keyed.format_key(rows[-1])
+
+    def test_capped_count(self):
+        get_model('core.Doc').objects.all().delete()
+        self.add_rows(45)
+        queryset = get_model('core.Record').objects.order_by('-id')
+        with override_settings(ADMIN_PAGINATOR={'count_limit':20}):
+            paginator = EstimatedCountPaginator(queryset, 10)
+            self.assertEqual((paginator.count, paginator.truncated), (20, True))
+            self.assertEqual(len(paginator.page(3).object_list), 10)
+            self.assertEqual(paginator.num_pages, 4)
+            self.assertEqual(list(paginator.page(5).object_list), list(queryset[40:]))
+            self.assertEqual(paginator.num_pages, 5)
+            with self.assertRaises(EmptyPage):
+                paginator.page(6)
+            self.client.force_login(get_user_model().objects.get(username='admin'))
+            with mock.patch.object(admin.site._registry[get_model('core.Record')], 'list_per_page', 10):
+                response = self.client.get('/admin/core/record/?p=3')
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, '20+')
+            self.assertContains(response, f'?k={queryset[29].id}&amp;p=4')
+
+    def test_changelist(self):
+        self.client.force_login(get_user_model().objects.get(username='admin'))
+        get_model('core.Doc').objects.all().delete()
+        self.add_rows(250)
+        ids = list(get_model('core.Doc').objects.order_by('-registered_at', '-id').values_list('id', flat=True)[100:200])
+        next_key = self.client.get('/admin/core/doc/').context['cl'].next_key
+        for query in ({'p':2}, {'p':2, 'k':next_key}):
+            response = self.client.get('/admin/core/doc/', query)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([doc.id for doc in response.context['cl'].result_list], ids)
+        self.assertIsNone(response.context['cl'].full_result_count)
@@ -15,14 +15,15 @@ from django.urls import reverse
 from django.utils.safestring import mark_safe
 from django.contrib import admin, messages
 from django import forms
-from django.http import StreamingHttpResponse, FileResponse, HttpResponseRedirect
+from django.http import StreamingHttpResponse, FileResponse, HttpResponseRedirect, JsonResponse
 from django.contrib.auth.forms import ReadOnlyPasswordHashField
 from django.db.models import F, Q, Min, Max, Sum, When, Value, Count, IntegerField, TextField, CharField, OuterRef, Subquery
-from django.db.models.query import QuerySet
+from django.db.models.query import QuerySet, prefetch_related_objects
 from django.db import connections
 from django.contrib.admin.models import LogEntry
 from django.contrib.admin.widgets import AutocompleteSelect
 from django.contrib.admin.helpers import ACTION_CHECKBOX_NAME
+from django.contrib.admin.views.main import ORDER_VAR
 from django.shortcuts import render
 from django.views.generic.edit import FormView
 from django.core.cache import caches
@@ -30,8 +31,9 @@ from django.conf import settings
 from django.apps import apps as django_apps
 from django.template import Context, Template
 
-from .models import PrintTemplates, Unit, Currency, Country, Region, City, Tax, CompanyType, Company, SalePoint, Manufacturer, ProductModel, BarCode, QrCode, DocType, ProductGroup, Product, Customer, ProductImage
-from users.models import User
+from .models import PrintTemplates, Unit, Currency, Country, Region, City, Tax, CompanyType, Company, SalePoint, Manufacturer, ProductModel, BarCode, QrCode, DocType, ProductGroup, Product, ProductSearch, Customer, ProductImage
+from users.models import User, RoleMatrix
+from core.invalidation import LRUCache, invalidate_products
 
 
 def get_model(app_model):
@@ -96,6 +98,80 @@ class DropDownFilter(admin.SimpleListFilter):
     template = 'dropdown_filter_from_memory.html'
 
 
+class SearchFilter(admin.SimpleListFilter):
+    '''
+    select2 box of large table, options are loaded by pages from filter_search_view instead of all rows in page,
+    search_model - "app.Model", search_fields - fields of prefix search (indexed), digits are searched also as id
+    '''
+    template = 'search_filter_from_memory.html'
+    search_model = None
+    search_fields = ('name',)
+    search_ordering = ('name', 'id')
+    page_size = 20
+    __filters__ = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        SearchFilter.__filters__[cls.__name__] = cls
+
+    @classmethod
+    def get_filter(cls, name):
+        return cls.__filters__.get(name)
+
+    @classmethod
+    def search_queryset(cls, request):
+        return get_model(cls.search_model).objects.all()
+
+    @classmethod
+    def label(cls, obj):
+        return f'{obj}'
+
+    @classmethod
+    def search(cls, request, term='', page=1):
+        '''result - ([{'id', 'text'}], more pages)'''
+        queryset = cls.search_queryset(request)
+        term = term.strip()
+        if term:
+            conditions = Q()
+            for field in cls.search_fields:
+                conditions |= Q(**{f'{field}__istartswith':term})
+            if term.isdigit():
+                conditions |= Q(id=int(term))
+            queryset = queryset.filter(conditions) if conditions else queryset.none()
+        offset = (page - 1) * cls.page_size
+        objs = list(queryset.order_by(*cls.search_ordering)[offset:offset + cls.page_size + 1])
+        return [{'id':f'{obj.id}', 'text':cls.label(obj)} for obj in objs[:cls.page_size]], len(objs) > cls.page_size
+
+    def has_output(self):
+        return True
+
+    def lookups(self, request, model_admin):
+        '''only selected item, others are searched by select2'''
+        value = self.value()
+        if not value or not value.isdigit():
+            return []
+        obj = self.search_queryset(request).filter(id=value).first()
+        return [(value, self.label(obj) if obj else value)]
+
+    def choices(self, changelist):
+        self.search_url = f'{reverse("admin_filter_search")}?filter={self.__class__.__name__}'
+        self.search_query_string = changelist.get_query_string({self.parameter_name:'__value__'})
+        yield from super().choices(changelist)
+
+
+def filter_search_view(request):
+    '''paginated options of SearchFilter for select2: ?filter=ProductFilter&term=abc&page=2'''
+    filter_class = SearchFilter.get_filter(request.GET.get('filter', ''))
+    if not filter_class:
+        return JsonResponse({'error':'FILTER NOT FOUND'}, status=404)
+    try:
+        page = max(int(request.GET.get('page') or 1), 1)
+    except ValueError:
+        page = 1
+    results, more = filter_class.search(request, request.GET.get('term', ''), page)
+    return JsonResponse({'results':results, 'pagination':{'more':more}})
+
+
 class UploadFileForm(forms.Form):
     _selected_action = forms.CharField(widget=forms.MultipleHiddenInput)
     file = forms.FileField(widget=forms.ClearableFileInput(attrs={'allow_multiple_selected': True}))
@@ -248,19 +324,22 @@ class CompanyTypeFilter(DropDownFilter):
             return queryset.filter(type=self.value())
 
 
-class CompanyFilter(DropDownFilter):
+class CompanyFilter(SearchFilter):
     title = _('Company')
     parameter_name = 'company'
+    search_model = 'refs.Company'
 
-    def lookups(self, request, model_admin):
+    @classmethod
+    def search_queryset(cls, request):
         user = request.user
-        res = []
         queryset = Company.objects.only('id', 'name')
         if not user.is_superuser:
             queryset = queryset.filter(Q(pk__in=user.companies.all()) | Q(id__in=user.sale_points.values_list('company_id', flat=True)))
-        for it in queryset:
-            res.append((it.id, it.name))
-        return res
+        return queryset
+
+    @classmethod
+    def label(cls, obj):
+        return obj.name
 
     def queryset(self, request, queryset):
         if not self.value():
@@ -380,16 +459,19 @@ class ProductManufacturerFilter(DropDownFilter):
             return queryset.filter(model__manufacturer=self.value())
 
 
-class ProductFilter(DropDownFilter):
+class ProductFilter(SearchFilter):
     title = _('Product')
     parameter_name = 'product'
+    search_model = 'refs.Product'
+    search_fields = ('name', 'article')
 
-    def lookups(self, request, model_admin):
-        res = []
-        queryset = Product.objects.only('id', 'name')
-        for it in queryset:
-            res.append((it.id, it.name))
-        return res
+    @classmethod
+    def search_queryset(cls, request):
+        return Product.objects.only('id', 'name')
+
+    @classmethod
+    def label(cls, obj):
+        return obj.name
 
     def queryset(self, request, queryset):
         if not self.value():
@@ -416,16 +498,18 @@ class DocTypeFilter(DropDownFilter):
             return queryset.filter(type=self.value())
 
 
-class CustomerFilter(DropDownFilter):
+class CustomerFilter(SearchFilter):
     title = _('Customer')
     parameter_name = 'customer'
+    search_model = 'refs.Customer'
 
-    def lookups(self, request, model_admin):
-        res = []
-        queryset = Customer.objects.only('id', 'name')
-        for it in queryset:
-            res.append((it.id, it.name))
-        return res
+    @classmethod
+    def search_queryset(cls, request):
+        return Customer.objects.only('id', 'name')
+
+    @classmethod
+    def label(cls, obj):
+        return obj.name
 
     def queryset(self, request, queryset):
         if not self.value():
@@ -843,12 +927,12 @@ setTimeout(() => {
 
 
 class ProductAdmin(CustomModelAdmin):
-    __objs__ = {}
+    __objs__ = LRUCache(getattr(settings, 'ADMIN_PRODUCT_CACHE_SIZE', 10000), 'product')
     user = None
     list_display = ['id', 'article', 'name', 'get_barcodes', 'get_qrcodes', 'get_price', 'get_count', 'get_sum', 'get_prod_model', 'get_group', 'get_thumbnail', 'extinfo', 'tax']
     list_display_links = ('id', 'article', 'name')
     search_fields = ('id', 'name', 'article', 'extinfo', 'barcodes__id', 'qrcodes__id', 'group__name', 'model__name', 'model__manufacturer__name')
-    list_select_related = ('tax', 'model', 'group')
+    list_select_related = ('tax', 'model', 'model__manufacturer', 'group', 'unit', 'currency')
     raw_id_fields = ['barcodes', 'qrcodes', 'images']
     list_editable = ['tax']
     autocomplete_fields = ['model', 'tax', 'group']
@@ -880,9 +964,7 @@ class ProductAdmin(CustomModelAdmin):
         if self.user.is_superuser:
             return True
         model_name = self.__class__.__name__.replace('Admin', '')
-        if get_model('users.RoleField').objects.filter(role=self.user.role, role_model__app='core', role_model__model=model_name, read=True, value='cost').exists():
-            return True
-        return False
+        return RoleMatrix.get(self.user.role_id).can_read(f'core.{model_name}', 'cost')
 
     def changelist_view(self, request, extra_context=None):
         self.user = request.user
@@ -904,6 +986,51 @@ class ProductAdmin(CustomModelAdmin):
         #self.logi(cl.result_list)
         return template_response
 
+    def get_changelist_instance(self, request):
+        cl = super().get_changelist_instance(request)
+        self.preload_page(cl.result_list)
+        return cl
+
+    def get_search_results(self, request, queryset, search_term):
+        '''search by document of ProductSearch without joins of codes, group and model and without DISTINCT, ranked unless changelist is sorted by column'''
+        if not search_term.strip():
+            return queryset, False
+        queryset = ProductSearch.filter(queryset, search_term)
+        if ORDER_VAR not in request.GET:
+            queryset = queryset.order_by('-search_rank', 'id')
+        return queryset, False
+
+    def get_changelist_formset(self, request, **kwargs):
+        formset = super().get_changelist_formset(request, **kwargs)
+        if 'tax' in formset.form.base_fields:
+            tax = forms.ModelChoiceField(queryset=Tax.objects.all(), required=False, label=_('tax'))
+            tax.choices = [('', '---------')] + list(Tax.objects.values_list('id', 'name'))
+            formset.form = type(formset.form.__name__, (formset.form,), {'tax':tax})
+        return formset
+
+    def preload_page(self, products):
+        '''load balances, last register values, codes and groups for all products of changelist page'''
+        if not products:
+            return
+        ids = [obj.id for obj in products]
+        prefetch_related_objects(products, 'barcodes', 'qrcodes')
+        stocks, last_values = {}, {}
+        for product_id, quantity, last_cost, last_price in get_model('core.ProductStock').objects.filter(product_id__in=ids).values_list('product_id', 'quantity', 'last_cost', 'last_price'):
+            stocks[product_id] = quantity
+            last_values[product_id] = (last_cost, last_price)
+        groups = {}
+        group_ids = {obj.group_id for obj in products if obj.group_id}
+        if group_ids:
+            groups = {grp.id: grp for grp in ProductGroup.objects.filter(id__in=group_ids)}
+            for grp in groups.values():
+                if grp.parent_id in groups:
+                    grp.parent = groups[grp.parent_id]
+        for obj in products:
+            obj.stock_count = stocks.get(obj.id, 0)
+            obj.last_values = last_values.get(obj.id, (None, None))
+            if obj.group_id in groups:
+                obj.group = groups[obj.group_id]
+
     def get_form(self, request, obj=None, **kwargs):
         self.user = request.user
         if settings.DEBUG:
@@ -921,34 +1048,35 @@ class ProductAdmin(CustomModelAdmin):
                 form.base_fields['article'].initial = ''.join([f'{int(it)+1}' if it.isdigit() else it for it in re.split(r'\W+', last_prod.article)])
         return form
 
-    def get_last_reg(self, obj):
-        if obj.id in self.__objs__ and 'lreg' in self.__objs__[obj.id]:
-            return self.__objs__[obj.id]['lreg']
-        else:
-            if obj.id not in self.__objs__:
-                self.__objs__[obj.id] = {}
-            try:
-                self.__objs__[obj.id]['lreg'] = get_model('core.Register').objects.filter(rec__product_id=obj.id).order_by('-rec__doc__registered_at').select_related('rec').first()
-            except Exception as e:
-                self.loge(e)
-            else:
-                return self.__objs__[obj.id]['lreg']
+    def get_last_values(self, obj):
+        if hasattr(obj, 'last_values'):
+            return obj.last_values
+        cached = self.__objs__.get(obj.id, {})
+        if 'last' in cached:
+            return cached['last']
+        try:
+            last_values = get_model('core.ProductStock').get_last_values(obj.id)
+        except Exception as e:
+            self.loge(e)
+            return None, None
+        self.__objs__.setdefault(obj.id, {})['last'] = last_values
+        return last_values
 
     def get_price_value(self, obj):
         if settings.BEHAVIOR_PRICE.get('select_from_register', False):
-            last_reg = self.get_last_reg(obj)
-            if last_reg:
-                return last_reg.rec.price
+            last_cost, last_price = self.get_last_values(obj)
+            if last_price is not None:
+                return last_price
         return obj.price
 
     def get_cost(self, obj):
-        if not self.user.is_superuser and not get_model('users.RoleField').objects.filter(role=self.user.role, role_model__app='core', role_model__model=obj.__class__.__name__, read=True, value='cost').exists():
+        if not self.user.is_superuser and not RoleMatrix.get(self.user.role_id).can_read(f'core.{obj.__class__.__name__}', 'cost'):
             return ''
         value = obj.cost
         if settings.BEHAVIOR_COST.get('select_from_register', False):
-            last_reg = self.get_last_reg(obj)
-            if last_reg:
-                value = last_reg.rec.cost
+            last_cost, last_price = self.get_last_values(obj)
+            if last_cost is not None:
+                value = last_cost
         return format_html('<font color="green" face="Verdana, Geneva, sans-serif">{} {}</font>', value, obj.currency.name if obj.currency else '')
     get_cost.short_description = _('cost')
     get_cost.admin_order_field = 'cost'
@@ -960,7 +1088,7 @@ class ProductAdmin(CustomModelAdmin):
 
     def get_barcodes(self, obj):
         try:
-            idxs = BarCode.objects.filter(product__in=[obj]).annotate(admin_path_prefix=Value(settings.ADMIN_PATH_PREFIX, CharField())).values_list('admin_path_prefix', 'id')
+            idxs = [(settings.ADMIN_PATH_PREFIX, it.id) for it in obj.barcodes.all()]
         except Exception as e:
             return ''
         else:
@@ -972,7 +1100,7 @@ class ProductAdmin(CustomModelAdmin):
 
     def get_qrcodes(self, obj):
         try:
-            idxs = QrCode.objects.filter(product__in=[obj]).annotate(admin_path_prefix=Value(settings.ADMIN_PATH_PREFIX, CharField())).values_list('admin_path_prefix', 'id')
+            idxs = [(settings.ADMIN_PATH_PREFIX, it.id) for it in obj.qrcodes.all()]
         except Exception as e:
             return ''
         else:
@@ -983,25 +1111,25 @@ class ProductAdmin(CustomModelAdmin):
     get_qrcodes.short_description = _('Qr Codes')
 
     def refresh_count_from_reg(self, obj):
-        if obj.id not in self.__objs__:
-            self.__objs__[obj.id] = {}
-        SumIncome=Sum('rec__count', filter=Q(rec__doc__type__income=True), default=0)
-        SumExpense=Sum('rec__count', filter=Q(rec__doc__type__income=False), default=0)
         try:
-            self.__objs__[obj.id]['count'] = get_model('core.Register').objects.filter(rec__product_id=obj.id).aggregate(count=SumIncome-SumExpense)['count']
+            count = get_model('core.ProductStock').get_quantity(obj.id)
         except Exception as e:
             self.loge(e)
         else:
+            self.__objs__.setdefault(obj.id, {})['count'] = count
             if settings.DEBUG:
-                self.logi('FROM BASE', self.__objs__[obj.id]['count'])
-            return self.__objs__[obj.id]['count']
+                self.logi('FROM BASE', count)
+            return count
         return 0
 
     def get_count_from_reg(self, obj):
-        if obj.id in self.__objs__ and 'count' in self.__objs__[obj.id]:
+        if hasattr(obj, 'stock_count'):
+            return obj.stock_count
+        cached = self.__objs__.get(obj.id, {})
+        if 'count' in cached:
             if settings.DEBUG:
-                self.logi('FROM BUFFER', self.__objs__[obj.id]['count'])
-            return self.__objs__[obj.id]['count']
+                self.logi('FROM BUFFER', cached['count'])
+            return cached['count']
         return self.refresh_count_from_reg(obj)
 
     def get_min_styles_reversed(self, grp, min_styles = {}):
@@ -1066,7 +1194,7 @@ class ProductAdmin(CustomModelAdmin):
     get_group.admin_order_field = 'group'
 
     def reset_cached(self, request, queryset):
-        self.__objs__ = {}
+        invalidate_products()
     reset_cached.short_description = f'↻💦{_("reset cached values")}'
 
     def get_thumbnail(self, obj):
@@ -1448,6 +1576,7 @@ class ProductAdmin(CustomModelAdmin):
                             msg_err = f'{e}'
                         else:
                             count_created = len(objs)
+                            ProductSearch.refresh([o.id for o in objs])
                             doc_income, income_mybe_saved = None, True
                             if count_created:
                                 for o in objs:
@@ -1522,8 +1651,7 @@ class ProductAdmin(CustomModelAdmin):
     to_xls.short_description = f'⚔{_("export to XLS file")}↘'
 
     def price_to_xls(self, request, queryset):
-        last_register = get_model('core.Register').objects.filter(rec__product_id=OuterRef('pk')).order_by('-rec__doc__registered_at')[:1]
-        queryset = queryset.annotate(last_price=Subquery(last_register.values('rec__price')))
+        queryset = queryset.annotate(last_price=F('stock__last_price'))
         output = self.queryset_to_xls(queryset, {'article':{'width':30}, 'name':{'width':50}, 'last_price':{'width':20, 'title':'price'}})
         if output:
             fn = '{}.xlsx'.format(django_timezone.now().strftime('%Y%m%d%H%M%S'))
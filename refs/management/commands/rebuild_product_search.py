@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from refs.models import ProductSearch
+
+
+class Command(BaseCommand):
+    help = 'create search index of products and rebuild search documents of all products'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='count of products per upsert')
+
+    def handle(self, *args, **options):
+        count = ProductSearch.rebuild(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'REBUILT {count} PRODUCT SEARCH DOCUMENTS'))
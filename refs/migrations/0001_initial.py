@@ -0,0 +1,357 @@
+# Generated by Django 5.2.18 on 2026-10-17 09:02
+
+import django.db.models.deletion
+import refs.models
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Product',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('article', models.CharField(default=uuid.uuid4, help_text='product article', max_length=191, verbose_name='article')),
+                ('name', models.CharField(db_index=True, default='', help_text='Caption of item', max_length=191, verbose_name='name')),
+                ('cost', models.DecimalField(decimal_places=3, default=0, help_text='default cost', max_digits=15, verbose_name='cost')),
+                ('price', models.DecimalField(decimal_places=3, default=0, help_text='default price', max_digits=15, verbose_name='price')),
+                ('extinfo', models.JSONField(blank=True, default=dict)),
+                ('thumbnail', models.TextField(blank=True, default=None, help_text='image as BASE64', null=True, verbose_name='thumbnail')),
+            ],
+            options={
+                'verbose_name': '📦Product',
+                'verbose_name_plural': '📦Products',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='BarCode',
+            fields=[
+                ('id', models.CharField(default=refs.models.ean13, help_text='product barcode', max_length=191, primary_key=True, serialize=False, unique=True, verbose_name='value')),
+            ],
+            options={
+                'verbose_name': 'ⅢBar Code',
+                'verbose_name_plural': 'ⅢBar Codes',
+            },
+        ),
+        migrations.CreateModel(
+            name='City',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(default='', help_text='name of city', max_length=191, verbose_name='name')),
+            ],
+            options={
+                'verbose_name': '🌎City',
+                'verbose_name_plural': '🌎Cities',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='CompanyType',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(default='', help_text='Type of company', max_length=191, unique=True, verbose_name='name')),
+            ],
+            options={
+                'verbose_name': '™️Company Type',
+                'verbose_name_plural': '™️Company Types',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Country',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(default='', help_text='name of country', max_length=191, unique=True, verbose_name='name')),
+            ],
+            options={
+                'verbose_name': '🌎Country',
+                'verbose_name_plural': '🌎Countries',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Currency',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(default='₽', max_length=191, unique=True)),
+                ('alias', models.CharField(blank=True, default='rub', max_length=191, null=True)),
+            ],
+            options={
+                'verbose_name': '💱Currency',
+                'verbose_name_plural': '💱Currencies',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Customer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(default='', help_text='Caption of item', max_length=191, unique=True, verbose_name='name')),
+                ('extinfo', models.JSONField(blank=True, default=dict)),
+            ],
+            options={
+                'verbose_name': '🕵Customer',
+                'verbose_name_plural': '🕵Customers',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='DocType',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('alias', models.CharField(default='receipt', max_length=191, unique=True)),
+                ('name', models.CharField(default='Receipt', help_text='name of type document', max_length=191, verbose_name='name')),
+                ('income', models.BooleanField(default=True, help_text='income or expense', verbose_name='income')),
+                ('auto_register', models.BooleanField(default=True, help_text='auto register when save document', verbose_name='auto register')),
+                ('description', models.CharField(blank=True, default=None, help_text='description of type document', max_length=191, null=True, verbose_name='description')),
+            ],
+            options={
+                'verbose_name': '🏷️Doc Type',
+                'verbose_name_plural': '🏷️Doc Types',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='PrintTemplates',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('alias', models.CharField(default='refs.doctype.sale', max_length=191, unique=True, verbose_name='alias')),
+                ('content', models.TextField(default='<table class="page-pad" style="border:1px solid black;margin-left:auto;margin-right:auto;border-collapse:collapse;"><caption>{{doc.type.name}} N{{doc.id}} from {{doc.registered_at}}<p style="text-align:left;margin:0;padding:0;">seler: {{doc.owner}}</p><p style="text-align:left;margin:0;padding:0;">purchaser: {{doc.contractor.name}}</p></caption><thead><tr><th style="width:5%;border:2px solid black;">number</th><th style="width:15%;border:2px solid black;">article</th><th style="width:50%;border:2px solid black;">product</th><th style="width:10%;border:2px solid black;">count</th><th style="width:10%;border:2px solid black;">price</th><th style="width:10%;border:2px solid black;">sum</th></tr></thead><tbody>{% for r in records %}<tr><td style="border:2px solid black;">{{forloop.counter}}</td><td style="border:2px solid black;">{{r.product.article}}</td><td style="border:2px solid black;">{%if \'label\' in r.product.extinfo%}{{r.product.extinfo.label}}{%else%}{{r.product.name}}{%endif%}</td><td style="border:2px solid black;">{{r.count}}</td><td style="border:2px solid black;">{{r.price}}</td><td style="border:2px solid black;">{{r.sum_price}}</td></tr>{% endfor %}<tr><td style="border:2px solid black;text-align:right;" colspan=6>Total: {{doc.sum_final}}</td></tr></tbody></table>', verbose_name='content')),
+                ('extinfo', models.JSONField(blank=True, default=refs.models.default_ptmpl_dict)),
+            ],
+            options={
+                'verbose_name': '🖶Print Template',
+                'verbose_name_plural': '🖶Print Templates',
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductImage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FileField(blank=True, default=None, max_length=255, null=True, upload_to=refs.models.ProductImage.uploadto, verbose_name='file')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='date created')),
+                ('extinfo', models.JSONField(blank=True, default=dict)),
+            ],
+            options={
+                'verbose_name': '📄Product Image',
+                'verbose_name_plural': '📄Product Images',
+            },
+        ),
+        migrations.CreateModel(
+            name='QrCode',
+            fields=[
+                ('id', models.CharField(default=uuid.uuid4, help_text='product qrcode', max_length=191, primary_key=True, serialize=False, unique=True, verbose_name='value')),
+            ],
+            options={
+                'verbose_name': '𝍌Qr Code',
+                'verbose_name_plural': '𝍌Qr Codes',
+            },
+        ),
+        migrations.CreateModel(
+            name='Tax',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(default='', max_length=191, unique=True, verbose_name='name')),
+                ('alias', models.CharField(blank=True, default='', max_length=191, null=True, verbose_name='alias')),
+                ('value', models.IntegerField(blank=True, default=None, help_text='percentage value of tax', null=True, verbose_name='value')),
+            ],
+            options={
+                'verbose_name': '\U000e0025\U000e0025\U000e0025\U000e0025\U000e0025\U000e0025💯Tax',
+                'verbose_name_plural': '💯Taxes',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Unit',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('label', models.CharField(default='', max_length=191, unique=True, verbose_name='label of unit')),
+                ('name', models.CharField(max_length=191, verbose_name='name of unit')),
+            ],
+            options={
+                'verbose_name': '👾Unit',
+                'verbose_name_plural': '👾Units',
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductSearchIndex',
+            fields=[
+                ('product', models.OneToOneField(db_column='rowid', on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search_index', serialize=False, to='refs.product')),
+                ('document', refs.models.SearchDocumentField()),
+            ],
+            options={
+                'db_table': 'refs_productsearch_fts',
+                'managed': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductSearch',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='refs.product')),
+                ('document', models.TextField(blank=True, default='', help_text='text of product for search', verbose_name='document')),
+            ],
+            options={
+                'verbose_name': '🔎Product Search',
+                'verbose_name_plural': '🔎Product Search',
+            },
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='barcodes',
+            field=models.ManyToManyField(blank=True, default=None, help_text='list barcodes of product', to='refs.barcode', verbose_name='barcodes'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='currency',
+            field=models.ForeignKey(blank=True, default=1, null=True, on_delete=django.db.models.deletion.SET_NULL, to='refs.currency'),
+        ),
+        migrations.CreateModel(
+            name='Company',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(default='', help_text='Caption of company', max_length=191, unique=True, verbose_name='caption')),
+                ('created_date', models.DateTimeField(auto_now_add=True, help_text='Date of creation on server', verbose_name='created date')),
+                ('contact_people', models.CharField(blank=True, default=None, help_text='Contact people of company', max_length=191, null=True, verbose_name='contact people')),
+                ('phone', models.CharField(blank=True, default=None, help_text='Contact people phone of company', max_length=191, null=True, verbose_name='phone')),
+                ('emails', models.EmailField(blank=True, default=None, help_text='Email of company', max_length=191, null=True, verbose_name='email')),
+                ('extinfo', models.JSONField(blank=True, default=dict)),
+                ('city', models.ForeignKey(blank=True, default=None, help_text='city of company', null=True, on_delete=django.db.models.deletion.SET_NULL, to='refs.city', verbose_name='city')),
+                ('type', models.ForeignKey(blank=True, default=None, help_text='type of company', null=True, on_delete=django.db.models.deletion.SET_NULL, to='refs.companytype', verbose_name='type')),
+                ('currency', models.ForeignKey(blank=True, default=1, help_text='currency of company', null=True, on_delete=django.db.models.deletion.SET_NULL, to='refs.currency', verbose_name='currency')),
+            ],
+            options={
+                'verbose_name': '™️Company',
+                'verbose_name_plural': '™️Companies',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Manufacturer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(default='', help_text='Caption of manufacturer', max_length=191, unique=True, verbose_name='caption')),
+                ('city', models.ForeignKey(blank=True, default=None, help_text='city of manufacturer', null=True, on_delete=django.db.models.deletion.SET_NULL, to='refs.city', verbose_name='city')),
+            ],
+            options={
+                'verbose_name': '🖥️Manufacturer',
+                'verbose_name_plural': '🖥️Manufacturers',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductGroup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(default='Products', help_text='name of products group', max_length=191, unique=True, verbose_name='name')),
+                ('alias', models.CharField(blank=True, default=None, help_text='alias of products group', max_length=191, null=True, verbose_name='alias')),
+                ('description', models.CharField(blank=True, default=None, help_text='description of products group', max_length=191, null=True, verbose_name='description')),
+                ('extinfo', models.JSONField(blank=True, default=dict)),
+                ('parent', models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.CASCADE, to='refs.productgroup')),
+            ],
+            options={
+                'verbose_name': '📚Product Group',
+                'verbose_name_plural': '📚Product Groups',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='group',
+            field=models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, to='refs.productgroup'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='images',
+            field=models.ManyToManyField(blank=True, default=None, help_text='list images of product', to='refs.productimage', verbose_name='images'),
+        ),
+        migrations.CreateModel(
+            name='ProductModel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(default='', help_text='Caption of model', max_length=191, unique=True, verbose_name='caption')),
+                ('manufacturer', models.ForeignKey(blank=True, default=None, help_text='manufacturer of model', null=True, on_delete=django.db.models.deletion.PROTECT, to='refs.manufacturer', verbose_name='manufacturer')),
+            ],
+            options={
+                'verbose_name': '🖥Product Model',
+                'verbose_name_plural': '🖥Product Models',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='model',
+            field=models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, to='refs.productmodel'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='qrcodes',
+            field=models.ManyToManyField(blank=True, default=None, help_text='list qrcodes of product', to='refs.qrcode', verbose_name='qrcodes'),
+        ),
+        migrations.CreateModel(
+            name='Region',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(default='', help_text='name of region', max_length=191, verbose_name='name')),
+                ('country', models.ForeignKey(default=1, help_text='country of region', on_delete=django.db.models.deletion.CASCADE, to='refs.country', verbose_name='country')),
+            ],
+            options={
+                'verbose_name': '🌎Region',
+                'verbose_name_plural': '🌎Regions',
+                'ordering': ['name'],
+                'unique_together': {('name', 'country')},
+            },
+        ),
+        migrations.AddField(
+            model_name='city',
+            name='region',
+            field=models.ForeignKey(default=1, help_text='region of city', on_delete=django.db.models.deletion.CASCADE, to='refs.region', verbose_name='region'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='tax',
+            field=models.ForeignKey(blank=True, default=None, help_text='default tax', null=True, on_delete=django.db.models.deletion.SET_NULL, to='refs.tax', verbose_name='tax'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='unit',
+            field=models.ForeignKey(blank=True, default=1, null=True, on_delete=django.db.models.deletion.SET_NULL, to='refs.unit'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='city',
+            unique_together={('name', 'region')},
+        ),
+        migrations.CreateModel(
+            name='SalePoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(default='', help_text='Caption of object', max_length=191, verbose_name='caption')),
+                ('created_date', models.DateTimeField(auto_now_add=True, help_text='Date of creation on server', verbose_name='created date')),
+                ('address', models.CharField(blank=True, default=None, help_text='Address of object', max_length=191, null=True, verbose_name='address')),
+                ('map_point', models.CharField(blank=True, default=None, help_text='Coords on map', max_length=191, null=True, verbose_name='map point')),
+                ('person', models.CharField(blank=True, default=None, help_text='Person on object', max_length=191, null=True, verbose_name='person')),
+                ('emails', models.EmailField(blank=True, default=None, help_text='Email on object', max_length=191, null=True, verbose_name='email')),
+                ('phone', models.CharField(blank=True, default=None, help_text='Phone on object', max_length=191, null=True, verbose_name='phone')),
+                ('extinfo', models.JSONField(blank=True, default=dict)),
+                ('city', models.ForeignKey(blank=True, default=1, null=True, on_delete=django.db.models.deletion.SET_NULL, to='refs.city')),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='refs.company', verbose_name='company')),
+            ],
+            options={
+                'verbose_name': '™️Sale Point',
+                'verbose_name_plural': '™️Sale Points',
+                'ordering': ['name'],
+                'unique_together': {('name', 'company')},
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='product',
+            unique_together={('article', 'name')},
+        ),
+    ]
@@ -0,0 +1,68 @@
+from django.db import migrations, router
+
+
+class VendorRunSQL(migrations.RunSQL):
+    '''RunSQL with statements by database vendor {vendor: [sql]}, other vendors are skipped'''
+
+    def __init__(self, sql, reverse_sql, **kwargs):
+        self.vendor_sql, self.vendor_reverse_sql = sql, reverse_sql
+        super().__init__(migrations.RunSQL.noop, migrations.RunSQL.noop, **kwargs)
+
+    def deconstruct(self):
+        name, args, kwargs = super().deconstruct()
+        kwargs.update(sql=self.vendor_sql, reverse_sql=self.vendor_reverse_sql)
+        return name, args, kwargs
+
+    def describe(self):
+        return 'Raw SQL operation of database vendor'
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if router.allow_migrate(schema_editor.connection.alias, app_label, **self.hints):
+            self._run_sql(schema_editor, self.vendor_sql.get(schema_editor.connection.vendor, []))
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if router.allow_migrate(schema_editor.connection.alias, app_label, **self.hints):
+            self._run_sql(schema_editor, self.vendor_reverse_sql.get(schema_editor.connection.vendor, []))
+
+
+class Migration(migrations.Migration):
+    '''
+    indexes of ProductSearch: PostgreSQL - GIN of tsvector (expression of SearchVector) and GIN of trigrams (icontains),
+    SQLite - FTS5 table with trigram tokenizer (ProductSearchIndex) kept by triggers,
+    extension pg_trgm is left on reverse because other schemas can use it
+    '''
+
+    dependencies = [
+        ('refs', '0001_initial'),
+    ]
+
+    operations = [
+        VendorRunSQL(
+            sql={
+                'postgresql': [
+                    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+                    "CREATE INDEX refs_productsearch_vector ON refs_productsearch USING gin (to_tsvector('simple'::regconfig, COALESCE(document, ''::text)))",
+                    'CREATE INDEX refs_productsearch_trgm ON refs_productsearch USING gin (UPPER(document) gin_trgm_ops)',
+                ],
+                'sqlite': [
+                    "CREATE VIRTUAL TABLE refs_productsearch_fts USING fts5(document, content='refs_productsearch', content_rowid='product_id', tokenize='trigram')",
+                    'CREATE TRIGGER refs_productsearch_ai AFTER INSERT ON refs_productsearch BEGIN INSERT INTO refs_productsearch_fts(rowid, document) VALUES (new.product_id, new.document); END',
+                    "CREATE TRIGGER refs_productsearch_ad AFTER DELETE ON refs_productsearch BEGIN INSERT INTO refs_productsearch_fts(refs_productsearch_fts, rowid, document) VALUES ('delete', old.product_id, old.document); END",
+                    "CREATE TRIGGER refs_productsearch_au AFTER UPDATE ON refs_productsearch BEGIN INSERT INTO refs_productsearch_fts(refs_productsearch_fts, rowid, document) VALUES ('delete', old.product_id, old.document); INSERT INTO refs_productsearch_fts(rowid, document) VALUES (new.product_id, new.document); END",
+                    "INSERT INTO refs_productsearch_fts(refs_productsearch_fts) VALUES ('rebuild')",
+                ],
+            },
+            reverse_sql={
+                'postgresql': [
+                    'DROP INDEX IF EXISTS refs_productsearch_trgm',
+                    'DROP INDEX IF EXISTS refs_productsearch_vector',
+                ],
+                'sqlite': [
+                    'DROP TRIGGER IF EXISTS refs_productsearch_au',
+                    'DROP TRIGGER IF EXISTS refs_productsearch_ad',
+                    'DROP TRIGGER IF EXISTS refs_productsearch_ai',
+                    'DROP TABLE IF EXISTS refs_productsearch_fts',
+                ],
+            },
+        ),
+    ]
@@ -1,17 +1,21 @@
-import logging, os, sys, time
+import json, logging, os, sys, time
 from uuid import uuid4
 from itertools import chain
 from datetime import datetime, timedelta, timezone
 from barcode import EAN13
 
-from django.db import models, transaction
-from django.db.models import F, Q, Max, Subquery, Value, IntegerField, JSONField
-from django.db.models.signals import pre_save, post_save, post_init, post_delete
+from django.db import connections, models, transaction
+from django.db.models import F, Q, Max, Subquery, Value, FloatField, IntegerField, JSONField
+from django.db.models.expressions import RawSQL
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, TrigramSimilarity
+from django.db.models.signals import pre_save, post_save, post_init, post_delete, pre_delete, m2m_changed
 from django.dispatch import receiver
 from django.utils import timezone as django_timezone
 from django.utils.translation import gettext as _
 from django.core.cache import caches
 from django.db.utils import IntegrityError
+
+from core.invalidation import LRUCache, get_invalidation_bus
 try:
     from zoneinfo import available_timezones, ZoneInfo
 except:
@@ -244,6 +248,9 @@ class Company(CustomAbstractModel):
     currency = models.ForeignKey(Currency, null=True, blank=True, default=1, on_delete=models.SET_NULL, verbose_name=_('currency'), help_text=_('currency of company'))
     extinfo = JSONField(default=dict, blank=True)
 
+    lookups = LRUCache(64, 'company')
+    DEFAULT_CONTRACTOR_FLAGS = {'order':'default_order_contractor', 'order_customer':'default_order_customer_contractor'}
+
     class Meta:
         verbose_name = f'™️{_("Company")}'
         verbose_name_plural = f'™️{_("Companies")}'
@@ -252,6 +259,26 @@ class Company(CustomAbstractModel):
     def __str__(self):
         return self.name
 
+    @classmethod
+    def get_default_contractor_id(cls, doc_type_alias):
+        '''id of company marked in extinfo as default contractor for type of document or None, cached for all processes till company changed'''
+        flag = cls.DEFAULT_CONTRACTOR_FLAGS.get(doc_type_alias, 'default_cash_contractor')
+        if flag not in cls.lookups:
+            cls.lookups[flag] = cls.objects.filter(**{f'extinfo__{flag}':True}).values_list('id', flat=True).first()
+        return cls.lookups.get(flag)
+
+    @classmethod
+    async def aget_default_contractor_id(cls, doc_type_alias):
+        flag = cls.DEFAULT_CONTRACTOR_FLAGS.get(doc_type_alias, 'default_cash_contractor')
+        if flag not in cls.lookups:
+            cls.lookups[flag] = await cls.objects.filter(**{f'extinfo__{flag}':True}).values_list('id', flat=True).afirst()
+        return cls.lookups.get(flag)
+
+@receiver(post_save, sender=Company)
+@receiver(post_delete, sender=Company)
+def company_post_save(sender, instance, **kwargs):
+    get_invalidation_bus().publish('company')
+
 
 class SalePoint(CustomAbstractModel):
     company = models.ForeignKey(Company, on_delete=models.CASCADE, verbose_name=_('company'))
@@ -298,6 +325,8 @@ class DocType(CustomAbstractModel):
     auto_register = models.BooleanField(default=True, null=False, blank=False, verbose_name=_('auto register'), help_text=_('auto register when save document'))
     description = models.CharField(max_length=191, default=None, null=True, blank=True, verbose_name=_('description'), help_text=_('description of type document'))
 
+    lookups = LRUCache(64, 'doctype')
+
     def __str__(self):
         return self.name
 
@@ -306,6 +335,28 @@ class DocType(CustomAbstractModel):
         verbose_name_plural = f'🏷️{_("Doc Types")}'
         ordering = ['name']
 
+    @classmethod
+    def get_by_alias(cls, alias):
+        '''get or create type of document by alias, cached for all processes till type changed'''
+        obj = cls.lookups.get(alias)
+        if obj is None:
+            obj, created = cls.objects.get_or_create(alias=alias, defaults={'alias':alias, 'name':alias.title()})
+            cls.lookups[alias] = obj
+        return obj
+
+    @classmethod
+    async def aget_by_alias(cls, alias):
+        obj = cls.lookups.get(alias)
+        if obj is None:
+            obj, created = await cls.objects.aget_or_create(alias=alias, defaults={'alias':alias, 'name':alias.title()})
+            cls.lookups[alias] = obj
+        return obj
+
+@receiver(post_save, sender=DocType)
+@receiver(post_delete, sender=DocType)
+def doc_type_post_save(sender, instance, **kwargs):
+    get_invalidation_bus().publish('doctype')
+
 
 class ProductImage(CustomAbstractModel):
 
@@ -362,7 +413,7 @@ class ProductGroup(CustomAbstractModel):
 
 class Product(CustomAbstractModel):
     article = models.CharField(max_length=191, default=uuid4, null=False, blank=False, verbose_name=_('article'), help_text=_('product article'))
-    name = models.CharField(max_length=191, default='', verbose_name=_('name'), help_text=_('Caption of item'))
+    name = models.CharField(max_length=191, default='', db_index=True, verbose_name=_('name'), help_text=_('Caption of item'))
     cost = models.DecimalField(max_digits=15, decimal_places=3, default=0, null=False, blank=False, verbose_name=_('cost'), help_text=_('default cost'))
     price = models.DecimalField(max_digits=15, decimal_places=3, default=0, null=False, blank=False, verbose_name=_('price'), help_text=_('default price'))
     currency = models.ForeignKey(Currency, default=1, null=True, blank=True, on_delete=models.SET_NULL)
@@ -386,6 +437,140 @@ class Product(CustomAbstractModel):
         return self.name
 
 
+class ProductSearch(CustomAbstractModel):
+    '''
+    denormalized search document of product: id, name, article, barcodes, qrcodes, group, model, manufacturer and extinfo,
+    PostgreSQL - GIN indexes of tsvector and trigrams of document, SQLite - FTS5 table with trigram tokenizer filled by triggers (ProductSearchIndex),
+    vendor structures are created by migration 0002_product_search, documents are updated by signals or ./manage.py rebuild_product_search
+    '''
+    product = models.OneToOneField(Product, primary_key=True, on_delete=models.CASCADE, related_name='search_document')
+    document = models.TextField(default='', blank=True, verbose_name=_('document'), help_text=_('text of product for search'))
+
+    class Meta:
+        verbose_name = f'🔎{_("Product Search")}'
+        verbose_name_plural = f'🔎{_("Product Search")}'
+
+    def __str__(self):
+        return self.document
+
+    @classmethod
+    def documents(cls, product_ids):
+        '''{product_id: document}, one query for products with group, model and manufacturer and one query for each kind of codes'''
+        docs = {}
+        for pid, name, article, extinfo, group, model, manufacturer in Product.objects.filter(id__in=product_ids).values_list('id', 'name', 'article', 'extinfo', 'group__name', 'model__name', 'model__manufacturer__name'):
+            docs[pid] = [f'{pid}', name, article, group, model, manufacturer, json.dumps(extinfo, ensure_ascii=False) if extinfo else '']
+        for through, field in ((Product.barcodes.through, 'barcode_id'), (Product.qrcodes.through, 'qrcode_id')):
+            for pid, code in through.objects.filter(product_id__in=docs.keys()).values_list('product_id', field):
+                docs[pid].append(code)
+        return {pid: ' '.join(v for v in values if v) for pid, values in docs.items()}
+
+    @classmethod
+    def refresh(cls, product_ids, batch_size=1000):
+        '''save documents of products by upsert, result - count of documents'''
+        product_ids, count = list(product_ids), 0
+        for i in range(0, len(product_ids), batch_size):
+            docs = cls.documents(product_ids[i:i + batch_size])
+            cls.objects.bulk_create([cls(product_id=pid, document=doc) for pid, doc in docs.items()], update_conflicts=True, unique_fields=['product'], update_fields=['document'])
+            count += len(docs)
+        return count
+
+    @classmethod
+    def refresh_on_commit(cls, product_ids):
+        product_ids = list(product_ids)
+        if product_ids:
+            transaction.on_commit(lambda: cls.refresh(product_ids))
+
+    @classmethod
+    def rebuild(cls, batch_size=1000, using='default'):
+        cls.objects.exclude(product__in=Product.objects.all()).delete()
+        count = cls.refresh(Product.objects.order_by('id').values_list('id', flat=True), batch_size)
+        if connections[using].vendor == 'sqlite':
+            table = ProductSearchIndex._meta.db_table
+            with connections[using].cursor() as cursor:
+                cursor.execute(f"INSERT INTO {table}({table}) VALUES ('rebuild')")
+        return count
+
+    @classmethod
+    def filter(cls, queryset, term):
+        '''products of queryset found by search document with rank search_rank (greater is better), document or its index is joined once'''
+        words, vendor = term.split(), connections[queryset.db].vendor
+        if not words:
+            return queryset.annotate(search_rank=Value(0.0, FloatField())).none()
+        if vendor == 'postgresql':
+            query = SearchQuery(term, config='simple', search_type='websearch')
+            matched = Q(search_vector=query) | Q(search_document__document__icontains=term)
+            return queryset.alias(search_vector=SearchVector('search_document__document', config='simple')).filter(matched).annotate(search_rank=SearchRank(F('search_vector'), query) + TrigramSimilarity('search_document__document', term))
+        if vendor == 'sqlite':
+            #trigram tokenizer matches words of 3 and more characters, shorter ones are found by LIKE
+            match = ' '.join('"' + w.replace('"', '""') + '"' for w in words if len(w) >= 3)
+            matched = Q(search_index__document__match=match) if match else Q()
+            for word in words:
+                if len(word) < 3:
+                    matched &= Q(search_index__document__icontains=word)
+            rank = RawSQL(f'-bm25({ProductSearchIndex._meta.db_table})', (), output_field=FloatField()) if match else Value(0.0, FloatField())
+            return queryset.filter(matched).annotate(search_rank=rank)
+        matched = Q()
+        for word in words:
+            matched &= Q(search_document__document__icontains=word)
+        return queryset.filter(matched).annotate(search_rank=Value(0.0, FloatField()))
+
+
+class SearchDocumentField(models.TextField):
+    '''text column of SQLite FTS5 table with lookup "match"'''
+
+
+@SearchDocumentField.register_lookup
+class FullTextMatch(models.Lookup):
+    lookup_name = 'match'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} MATCH {rhs}', (*lhs_params, *rhs_params)
+
+
+class ProductSearchIndex(CustomAbstractModel):
+    '''SQLite FTS5 table of ProductSearch (rowid is id of product) kept by triggers, created by migration and used by ProductSearch.filter only'''
+    product = models.OneToOneField(Product, primary_key=True, db_column='rowid', on_delete=models.DO_NOTHING, related_name='search_index')
+    document = SearchDocumentField()
+
+    class Meta:
+        managed = False
+        db_table = 'refs_productsearch_fts'
+
+
+@receiver(post_save, sender=Product)
+def product_search_post_save(sender, instance, **kwargs):
+    ProductSearch.refresh([instance.pk])
+
+
+@receiver(m2m_changed, sender=Product.barcodes.through)
+@receiver(m2m_changed, sender=Product.qrcodes.through)
+def product_search_codes_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            ProductSearch.refresh([instance.pk])
+    elif action == 'pre_clear':
+        ProductSearch.refresh_on_commit(instance.product_set.values_list('id', flat=True))
+    elif action in ('post_add', 'post_remove'):
+        ProductSearch.refresh(pk_set)
+
+
+@receiver(post_save, sender=ProductGroup)
+@receiver(post_save, sender=ProductModel)
+@receiver(post_save, sender=Manufacturer)
+@receiver(pre_delete, sender=ProductGroup)
+@receiver(pre_delete, sender=ProductModel)
+@receiver(pre_delete, sender=BarCode)
+@receiver(pre_delete, sender=QrCode)
+def product_search_related_changed(sender, instance, created=False, **kwargs):
+    '''name of group, model or manufacturer is part of document, deleted codes and SET_NULL of group or model change document after commit'''
+    if created:
+        return
+    lookup = {ProductGroup:'group', ProductModel:'model', Manufacturer:'model__manufacturer', BarCode:'barcodes', QrCode:'qrcodes'}[sender]
+    ProductSearch.refresh_on_commit(Product.objects.filter(**{lookup:instance}).values_list('id', flat=True))
+
+
 class Customer(CustomAbstractModel):
     name = models.CharField(max_length=191, default='', null=False, blank=False, unique=True, verbose_name=_('name'), help_text=_('Caption of item'))
     extinfo = JSONField(default=dict, blank=True)
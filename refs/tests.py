@@ -1,6 +1,13 @@
+import json
 from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.apps import apps as django_apps
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
 from django.db.models.functions import Length
+from django.contrib.auth import get_user_model
+from django.conf import settings
+from django.urls import reverse
 
 
 def get_model(app_model):
@@ -26,3 +33,162 @@ class Usr(TransactionTestCase):
         product = get_model('refs.Product').objects.filter(article__regex=r'^Y[0-9]{1,4}$').order_by('-article').first()
         self.assertIsNotNone(product)
         print(product.to_dict())
+
+
+class ProductsFixture():
+    'Products with group, model, codes and records shared by test cases'
+    maxDiff = None
+    reset_sequences = True
+
+    def setUp(self):
+        get_model('refs.Currency')().save()
+        get_model('refs.Unit')(label='pcs', name='pieces').save()
+        get_model('refs.Tax')(name='Without tax', alias='NO').save()
+        get_model('refs.Company')(name='Own Company').save()
+        get_model('refs.Company')(name='Contractor').save()
+        get_model('refs.DocType')(alias='receipt', name='Receipt', income=True, auto_register=True).save()
+        self.user = get_user_model()(username='test_product_admin', is_staff=True, is_active=True, is_superuser=True)
+        self.user.set_password('t0#e9@s8$t7')
+        self.user.save()
+        self.client.force_login(self.user)
+        grp_parent = get_model('refs.ProductGroup')(name='Products', extinfo={'min_styles':{'0':'color:red;'}})
+        grp_parent.save()
+        self.group = get_model('refs.ProductGroup')(name='Child Products', parent=grp_parent, extinfo={'min_styles':{'5':'color:orange;'}})
+        self.group.save()
+        manufacturer = get_model('refs.Manufacturer')(name='Manufacturer')
+        manufacturer.save()
+        self.prod_model = get_model('refs.ProductModel')(name='Model', manufacturer=manufacturer)
+        self.prod_model.save()
+        self.doc = get_model('core.Doc')(type_id=1, owner_id=1, contractor_id=2, author=self.user)
+        self.doc.save()
+
+    def add_products(self, count):
+        start = get_model('refs.Product').objects.count()
+        for i in range(start, start + count):
+            product = get_model('refs.Product')(article=f'A{i}', name=f'product {i}', cost=i, price=i * 2, group=self.group, model=self.prod_model, tax_id=1)
+            product.save()
+            barcode = get_model('refs.BarCode')(id=f'{4600000000000 + i}')
+            barcode.save()
+            qrcode = get_model('refs.QrCode')(id=f'qr{i}')
+            qrcode.save()
+            product.barcodes.add(barcode)
+            product.qrcodes.add(qrcode)
+            get_model('core.Record')(doc=self.doc, product=product, count=i, cost=product.cost, price=product.price).save()
+
+
+class ProductAdminQueries(ProductsFixture, TransactionTestCase):
+    'Product changelist must not run queries per row'
+
+    def test_changelist_constant_queries(self):
+        url = reverse('admin:refs_product_changelist')
+        select_from_register = {'select_from_register':True}
+        for behavior_cost, behavior_price in ((settings.BEHAVIOR_COST, settings.BEHAVIOR_PRICE), (settings.BEHAVIOR_COST | select_from_register, settings.BEHAVIOR_PRICE | select_from_register)):
+            with self.settings(BEHAVIOR_COST=behavior_cost, BEHAVIOR_PRICE=behavior_price):
+                self.add_products(5)
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.add_products(40)
+                with self.assertNumQueries(len(queries)):
+                    response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertContains(response, 'product 44')
+        self.assertIsInstance(response.context['cl'].formset.form.base_fields['tax'].choices, list)
+
+
+class SearchFilters(ProductsFixture, TransactionTestCase):
+    'Filters of large tables render selected item only and search by pages'
+
+    def search(self, name, term='', page=1):
+        response = self.client.get(reverse('admin_filter_search'), {'filter':name, 'term':term, 'page':page})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return [item['text'] for item in data['results']], data['pagination']['more']
+
+    def test_search(self):
+        self.add_products(45)
+        texts, more = self.search('ProductFilter', 'product 1')
+        self.assertEqual(texts, ['product 1'] + [f'product 1{i}' for i in range(10)])
+        self.assertFalse(more)
+        self.assertEqual(self.search('ProductFilter', 'A44'), (['product 44'], False))
+        self.assertEqual(len(self.search('ProductFilter')[0]), 20)
+        self.assertEqual(self.search('ProductFilter', page=3), (['product 5', 'product 6', 'product 7', 'product 8', 'product 9'], False))
+        self.assertEqual(len(self.search('DocFilter', f'{self.doc.id}')[0]), 1)
+        self.assertEqual(self.search('DocFilter', 'abc'), ([], False))
+        self.assertEqual(self.client.get(reverse('admin_filter_search'), {'filter':'Unknown'}).status_code, 404)
+        product = get_model('refs.Product').objects.get(name='product 3')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('admin:core_record_changelist'), {'product':product.id})
+        self.assertContains(response, f'<option selected="selected" value="{product.id}">product 3</option>', html=False)
+        self.assertNotContains(response, 'product 44')
+        self.add_products(100)
+        with self.assertNumQueries(len(queries)):
+            self.client.get(reverse('admin:core_record_changelist'), {'product':product.id})
+
+
+class ProductSearchTests(ProductsFixture, TransactionTestCase):
+    'Search document of products is kept by signals and used by admin and api'
+
+    def search(self, term):
+        response = self.client.get('/api/products/search', {'q':term, 'limit':100})
+        self.assertEqual(response.status_code, 200)
+        return [item['name'] for item in json.loads(response.json())]
+
+    def test_search(self):
+        self.add_products(12)
+        self.assertEqual(self.search('4600000000011'), ['product 11'])
+        self.assertEqual(self.search('qr7'), ['product 7'])
+        self.assertEqual(self.search('A11'), ['product 11'])
+        self.assertEqual(len(self.search('Manufacturer')), 12)
+        self.assertEqual(self.search(''), [])
+        self.group.name = 'Beverages'
+        self.group.save()
+        self.prod_model.manufacturer.name = 'Brewery'
+        self.prod_model.manufacturer.save()
+        self.assertEqual(len(self.search('beverages brewery')), 12)
+        self.assertEqual(self.search('Child'), [])
+        get_model('refs.BarCode').objects.get(id='4600000000005').delete()
+        self.assertEqual(self.search('4600000000005'), [])
+        product = get_model('refs.Product').objects.get(name='product 3')
+        product.extinfo = {'label':'sparkling water'}
+        product.save()
+        self.assertEqual(self.search('sparkling'), ['product 3'])
+        product.barcodes.clear()
+        self.assertEqual(self.search('4600000000003'), [])
+        product.delete()
+        self.assertEqual(get_model('refs.ProductSearch').objects.count(), 11)
+
+    def test_rank(self):
+        self.add_products(3)
+        get_model('refs.Product')(article='B1', name='water cola', group=self.group).save()
+        get_model('refs.Product')(article='B2', name='cola cola cola', group=self.group).save()
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.search('cola'), ['cola cola cola', 'water cola'])
+        self.assertEqual({q['sql'].count('MATCH') for q in context.captured_queries if 'MATCH' in q['sql']}, {1})
+
+    def test_migration(self):
+        executor = MigrationExecutor(connection)
+        if 'refs' not in executor.loader.migrated_apps:
+            self.skipTest('migrations of refs are disabled')
+        def structures():
+            names = set(connection.introspection.table_names()) | set(connection.introspection.get_constraints(connection.cursor(), 'refs_productsearch'))
+            return names & {'refs_productsearch_fts', 'refs_productsearch_vector', 'refs_productsearch_trgm'}
+        self.assertTrue(structures())
+        executor.migrate([('refs', '0001_initial')])
+        self.assertEqual(structures(), set())
+        executor.loader.build_graph()
+        executor.migrate([('refs', '0002_product_search')])
+        self.add_products(2)
+        self.assertEqual(self.search('product'), ['product 0', 'product 1'])
+
+    def test_admin(self):
+        self.add_products(12)
+        get_model('refs.ProductSearch').objects.all().delete()
+        self.assertEqual(get_model('refs.ProductSearch').rebuild(), 12)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('admin:refs_product_changelist'), {'q':'4600000000004'})
+        self.assertContains(response, 'product 4')
+        self.assertNotContains(response, 'product 11')
+        self.assertFalse([q for q in context.captured_queries if 'DISTINCT' in q['sql']])
+        response = self.client.get(reverse('admin:autocomplete'), {'term':'qr1', 'app_label':'core', 'model_name':'record', 'field_name':'product'})
+        self.assertEqual({item['text'] for item in response.json()['results']}, {'product 1', 'product 10', 'product 11'})
@@ -2,7 +2,7 @@ from django.core.management.base import BaseCommand, CommandError
 from django.contrib.auth.models import Group
 from django.utils.translation import gettext_lazy as _
 
-from users.models import Role, RoleField, User
+from users.models import Role, RoleField, RoleMatrix, User
 from users.apps import create_default_role_models
 from refs.models import Company, CompanyType, Currency, DocType, PrintTemplates, Tax, Unit
 
@@ -56,6 +56,7 @@ class Command(BaseCommand):
         create_default_role_models()
         RoleField.objects.filter(role=role_admin).update(read=True, write=True)
         RoleField.objects.filter(role=role_kassa).update(read=False, write=False)
+        RoleMatrix.bump()
 
         user_admin = User(
             username = 'admin',
@@ -62,6 +62,8 @@ TEMPLATES = [
                 ]),
                 ('django.template.loaders.locmem.Loader', {
                     'dropdown_filter_from_memory.html': '''{%load i18n%}<script type="text/javascript">var $=django.jQuery; var jQuery=django.jQuery; var go_from_select=function(opt){window.location=window.location.pathname+opt;}; $(document).ready(function(){try{$(".second-style-selector").select2();}catch(e){console.log(e);};});</script><h3>{%blocktrans with title as filter_title%} By {{filter_title}} {%endblocktrans %}</h3><ul class="admin-filter-{{title|cut:' '}}">{%if choices|slice:"4:"%}<li><select class="form-control second-style-selector" style="width:95%;margin-left:2%;" onchange="go_from_select(this.options[this.selectedIndex].value)">{%for choice in choices%}<option {%if choice.selected%} selected="selected"{%endif%} value="{{choice.query_string|iriencode}}">{{choice.display}}</option>{%endfor%}</select></li>{% else%}{%for choice in choices%}<li {%if choice.selected%} class="selected"{%endif%}><a href="{{choice.query_string|iriencode}}">{{choice.display}}</a></li>{%endfor%}{%endif%}</ul>''',
+                    'search_filter_from_memory.html': '''{%load i18n static%}<link href="{%static 'admin/css/vendor/select2/select2.min.css'%}" media="screen" rel="stylesheet"><script type="text/javascript">(function(){var $=django.jQuery; var init=function(){$("#search-filter-{{spec.parameter_name}}").select2({ajax:{url:"{{spec.search_url|escapejs}}", dataType:"json", delay:250, data:function(params){return {term:params.term||"", page:params.page||1};}}, allowClear:true, placeholder:"{%trans 'All'%}"}).on("select2:select", function(evt){window.location=window.location.pathname+"{{spec.search_query_string|escapejs}}".replace("__value__", encodeURIComponent(evt.params.data.id));}).on("select2:clear", function(evt){window.location=window.location.pathname+"{{choices.0.query_string|escapejs}}";});}; $(document).ready(function(){if($.fn.select2){init();return;} window.jQuery=$; var s=document.createElement("script"); s.src="{%static 'admin/js/vendor/select2/select2.full.min.js'%}"; s.onload=init; document.head.appendChild(s);});})();</script><h3>{%blocktrans with title as filter_title%} By {{filter_title}} {%endblocktrans %}</h3><ul class="admin-filter-{{title|cut:' '}}"><li><select id="search-filter-{{spec.parameter_name}}" style="width:95%;margin-left:2%;"><option value=""></option>{%for choice in choices%}{%if choice.selected and not forloop.first%}<option selected="selected" value="{{spec.value}}">{{choice.display}}</option>{%endif%}{%endfor%}</select></li></ul>''',
+                    'admin/core/pagination.html':'''{%load admin_list i18n%}<p class="paginator">{%if pagination_required%}{%for i in page_range%}{%paginator_number cl i%}{%endfor%}{%endif%}{{cl.result_count}}{%if cl.paginator.truncated%}+{%endif%} {%if cl.result_count == 1%}{{cl.opts.verbose_name}}{%else%}{{cl.opts.verbose_name_plural}}{%endif%}{%if show_all_url%} <a href="{{show_all_url}}" class="showall">{%translate 'Show all'%}</a>{%endif%}{%if cl.formset and cl.result_count%} <input type="submit" name="_save" class="default" value="{%translate 'Save'%}">{%endif%}</p>''',
                     'admin_select_file_form.html':'''{%extends "admin/base_site.html"%}{%block content%}<form enctype="multipart/form-data" action="" method="post">{%csrf_token%}{{form}}<ul>{{items|unordered_list}}</ul><input type="hidden" name="action" value="{{current_action}}" /><input type="submit" name="apply" value="Save" /><button onclick="window.location.href='{{request.path}}'">GoBack</button></form>{%endblock%}'''
                 }),
             ],
@@ -216,6 +218,26 @@ ADMIN_SET_DOCUMENT_RECORD_PRICES = {'check_empty_cost':False, 'check_empty_price
 BEHAVIOR_COST = {'register_change_referece':True, 'select_from_register':False, 'select_during_incoming':True, 'select_during_sale':False}
 BEHAVIOR_PRICE = {'register_change_referece':True, 'select_from_register':False, 'select_during_incoming':True, 'select_during_sale':True}
 BEHAVIOR_COUNT = {'select_from_register':True, 'select_during_incoming':True, 'select_during_sale':True, 'select_focus':'elem_count.focus();'}
+#update of product reference by register_change_referece
+#commit - one update of all registered products after commit of transaction
+#periodic - products are marked and updated by ./manage.py update_references (cron or --loop), no product row lock during checkout
+REFERENCE_UPDATE = 'commit'
+
+#invalidation of cached product values in admin for all processes (workers)
+#core.invalidation.PostgresInvalidationBus - LISTEN/NOTIFY, fallback to LocalInvalidationBus when database is not postgresql
+#core.invalidation.FileInvalidationBus - shared file (OPTIONS path, interval), for SQLite and several workers on one host
+#core.invalidation.LocalInvalidationBus - current process only
+INVALIDATION_BUS = {'BACKEND':'core.invalidation.PostgresInvalidationBus', 'OPTIONS':{'channel':'prod_invalidation'}}
+ADMIN_PRODUCT_CACHE_SIZE = 10000
+
+#changelists of records, registers and documents (CustomModelAdmin.keyset)
+#count of unfiltered table is taken from PostgreSQL statistics when table contains more than estimate_min rows,
+#exact count of filtered changelist stops at count_limit rows (shown as count_limit+), next pages stay reachable while rows go on
+ADMIN_PAGINATOR = {'count_limit':10000, 'estimate_min':100000}
+
+#/api/doc/cash/ validates receipt, appends it to ReceiptQueue and returns 202 with ticket,
+#documents are saved by worker "./manage.py drain_receipts --loop"
+API_CASH_WRITE_BEHIND = False
 
 def NEW_ARTICLE_GENERATOR(obj_model, default=''):
     try:
@@ -4,12 +4,15 @@ from django.conf import settings
 from django.http import HttpResponse
 from django.conf.urls.static import static
 
+from refs.admin import filter_search_view
+
 
 def favicon(request):
     return HttpResponse(settings.FAVICON_BASE64, content_type='image/svg+xml')
 
 urlpatterns = [
     path('api/', include('api.urls')),
+    path('admin/filter_search/', admin.site.admin_view(filter_search_view), name='admin_filter_search'),
     path('admin/', admin.site.urls),
     path('favicon.ico', favicon)
 ]
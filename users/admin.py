@@ -22,7 +22,7 @@ from django.contrib.contenttypes.models import ContentType
 from django.contrib.sessions.models import Session
 #from django.contrib.sessions.backends.db import SessionStore
 
-from .models import get_users_by_owner, Role, RoleModel, RoleField, User
+from .models import get_users_by_owner, Role, RoleMatrix, RoleModel, RoleField, User
 
 admin.site.subtitle = _('Users')
 
@@ -98,18 +98,22 @@ class RoleFieldAdmin(admin.ModelAdmin):
 
     def set_read(self, request, queryset):
         queryset.update(read=True)
+        RoleMatrix.bump()
     set_read.short_description = f'☑{_("set role field for read")}√'
 
     def reset_read(self, request, queryset):
         queryset.update(read=False)
+        RoleMatrix.bump()
     reset_read.short_description = f'☒{_("make role field unreadable")}☐'
 
     def set_write(self, request, queryset):
         queryset.update(write=True)
+        RoleMatrix.bump()
     set_write.short_description = f'☑{_("set role field for write")}√'
 
     def reset_write(self, request, queryset):
         queryset.update(write=False)
+        RoleMatrix.bump()
     reset_write.short_description = f'☒{_("make role field unwritable")}☐'
 
 admin.site.register(RoleField, RoleFieldAdmin)
@@ -1,5 +1,8 @@
 import logging, sys
 from itertools import chain
+from types import MappingProxyType
+
+from asgiref.sync import sync_to_async
 
 from django.core.cache import caches
 from django.db import models, transaction
@@ -7,9 +10,11 @@ from django.contrib.auth.models import AbstractUser, Group, Permission
 from django.utils.translation import gettext_lazy as _
 from django.apps import apps as django_apps
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.db.models import Q
 
+from core.invalidation import LRUCache, get_invalidation_bus
+
 
 def create_default_role_fields(r, rmodel, fread = False, fwrite = False):
     if r.value == 'superadmin':
@@ -201,6 +206,74 @@ class RoleField(models.Model, BaseModelWithLogger):
     #     return data
 
 
+class RoleMatrix():
+    '''
+    immutable permissions of role compiled from RoleField rows: {"app.Model": (frozenset of readable fields, frozenset of writable fields)},
+    compiled once by process, saving of Role or RoleField publishes topic "role" of invalidation bus and compiled matrices of all processes are dropped
+    '''
+    topic = 'role'
+    __compiled__ = LRUCache(10000, topic)
+    EMPTY = (frozenset(), frozenset())
+
+    def __init__(self, role_id=None, fields=None):
+        self.role_id = role_id
+        self.fields = MappingProxyType(fields or {})
+
+    def readable(self, model_key):
+        return self.fields.get(model_key, self.EMPTY)[0]
+
+    def writable(self, model_key):
+        return self.fields.get(model_key, self.EMPTY)[1]
+
+    def can_read(self, model_key, field):
+        return field in self.readable(model_key)
+
+    def can_write(self, model_key, field):
+        return field in self.writable(model_key)
+
+    @classmethod
+    def bump(cls):
+        '''drop compiled matrices of all processes after commit'''
+        get_invalidation_bus().publish(cls.topic)
+
+    @classmethod
+    def compile(cls, role_id):
+        fields = {}
+        for app, model, value, read, write in RoleField.objects.filter(Q(read=True) | Q(write=True), role_id=role_id).values_list('role_model__app', 'role_model__model', 'value', 'read', 'write'):
+            readable, writable = fields.setdefault(f'{app}.{model}', (set(), set()))
+            if read:
+                readable.add(value)
+            if write:
+                writable.add(value)
+        return cls(role_id, {key: (frozenset(readable), frozenset(writable)) for key, (readable, writable) in fields.items()})
+
+    @classmethod
+    def get(cls, role_id):
+        '''role_id=None - nothing is permitted'''
+        if role_id is None:
+            return cls()
+        matrix = cls.__compiled__.get(role_id)
+        if matrix is None:
+            matrix = cls.__compiled__[role_id] = cls.compile(role_id)
+        return matrix
+
+    @classmethod
+    async def aget(cls, role_id):
+        if role_id is None:
+            return cls()
+        matrix = cls.__compiled__.get(role_id)
+        if matrix is None:
+            matrix = cls.__compiled__[role_id] = await sync_to_async(cls.compile)(role_id)
+        return matrix
+
+@receiver(post_save, sender=Role)
+@receiver(post_delete, sender=Role)
+@receiver(post_save, sender=RoleField)
+@receiver(post_delete, sender=RoleField)
+def on_role_changed(sender, **kwargs):
+    RoleMatrix.bump()
+
+
 class User(AbstractUser, BaseModelWithLogger):
     cache = caches['users']
     role = models.ForeignKey(Role, null=True, on_delete=models.SET_NULL, verbose_name=_('role'))
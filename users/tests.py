@@ -1,3 +1,56 @@
+import os, tempfile
+
 from django.test import TestCase
 
-# Create your tests here.
+from core.invalidation import FileInvalidationBus
+from .models import Role, RoleModel, RoleField, RoleMatrix
+
+
+class RoleMatrixTests(TestCase):
+    'Compiled permissions of role'
+
+    def setUp(self):
+        RoleMatrix.__compiled__.invalidate()
+        self.role = Role.objects.create(value='cashier')
+        self.record = RoleModel.objects.create(app='core', model='Record')
+        self.product = RoleModel.objects.create(app='refs', model='Product')
+        RoleField.objects.create(role=self.role, role_model=self.record, value='cost', read=True)
+        RoleField.objects.create(role=self.role, role_model=self.product, value='name', read=True, write=True)
+        RoleField.objects.create(role=self.role, role_model=self.product, value='price', read=False)
+
+    def test_matrix(self):
+        matrix = RoleMatrix.get(self.role.id)
+        self.assertEqual(matrix.readable('refs.Product'), frozenset({'name'}))
+        self.assertEqual(matrix.writable('refs.Product'), frozenset({'name'}))
+        self.assertTrue(matrix.can_read('core.Record', 'cost'))
+        self.assertFalse(matrix.can_write('core.Record', 'cost'))
+        self.assertEqual(matrix.readable('core.Doc'), frozenset())
+        with self.assertNumQueries(0):
+            self.assertIs(RoleMatrix.get(self.role.id), matrix)
+            self.assertFalse(RoleMatrix.get(None).can_read('core.Record', 'cost'))
+        with self.assertRaises(TypeError):
+            matrix.fields['core.Doc'] = RoleMatrix.EMPTY
+
+    def test_bump(self):
+        matrix = RoleMatrix.get(self.role.id)
+        RoleField.objects.filter(role_model=self.product, value='price').update(read=True)
+        self.assertFalse(RoleMatrix.get(self.role.id).can_read('refs.Product', 'price'))
+        with self.captureOnCommitCallbacks(execute=True):
+            RoleField.objects.get(role_model=self.record, value='cost').delete()
+            self.assertIs(RoleMatrix.get(self.role.id), matrix)
+        self.assertIsNot(RoleMatrix.get(self.role.id), matrix)
+        self.assertTrue(RoleMatrix.get(self.role.id).can_read('refs.Product', 'price'))
+        self.assertFalse(RoleMatrix.get(self.role.id).can_read('core.Record', 'cost'))
+
+    def test_other_process(self):
+        path = os.path.join(tempfile.mkdtemp(), 'test.bus')
+        worker1, worker2 = FileInvalidationBus(path=path), FileInvalidationBus(path=path)
+        worker2.subscribe(RoleMatrix.topic, RoleMatrix.__compiled__.invalidate)
+        worker2.poll()
+        matrix = RoleMatrix.get(self.role.id)
+        RoleField.objects.filter(role_model=self.record, value='cost').update(read=False)
+        with self.captureOnCommitCallbacks(execute=True):
+            worker1.publish(RoleMatrix.topic)
+        self.assertIs(RoleMatrix.get(self.role.id), matrix)
+        worker2.poll()
+        self.assertFalse(RoleMatrix.get(self.role.id).can_read('core.Record', 'cost'))